@@ -3,296 +3,221 @@ from users import (
     login_page,
     create_account_page,
     forgot_password_page,
-    load_users,
-    load_personnages,
-    load_all_stories,
+    current_user,
+    get_personnages,
 )
 import openai
 import os
 from make_prompt import make_prompt
 import uuid
+import json
 import re
-import requests
-import sqlite3
-import boto3
-import tempfile
-import time
-
-# Configuration de boto3 pour S3
-AWS_ACCESS_KEY_ID = os.getenv("AWS_ACCESS_KEY_ID")
-AWS_SECRET_ACCESS_KEY = os.getenv("AWS_SECRET_ACCESS_KEY")
-AWS_REGION = os.getenv("AWS_DEFAULT_REGION")
-S3_BUCKET_NAME = "jujul"
-
-try:
-    s3 = boto3.client(
-        "s3",
-        region_name=AWS_REGION,
-        aws_access_key_id=AWS_ACCESS_KEY_ID,
-        aws_secret_access_key=AWS_SECRET_ACCESS_KEY,
-    )
-    s3.head_bucket(Bucket=S3_BUCKET_NAME)
-except Exception as e:
-    st.error(f"Erreur de configuration S3 : {e}. Vérifiez vos credentials et le bucket.")
-    st.stop()
-
-# Chemin local temporaire pour stories.db
-LOCAL_DB_PATH = "stories.db"
-S3_DB_KEY = "database/stories.db"  # Chemin sur S3 : s3://jujul/database/stories.db
+import http_client
+import db
+import scheduler
+import jobs
+import llm
+import summary_cache
+import read_cache
+import story_codec
+import instrumentation
+from boto3.s3.transfer import TransferConfig
+from assets import load_source_images
+from bootstrap import ensure_ready, get_replication_flusher, S3_BUCKET_NAME
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+# Client S3 et base locale préparés une seule fois par processus
+s3 = ensure_ready()
 
 openai.api_key = st.secrets["openai"]["OPENAI_API_KEY"]
-
-def log_stories_table(step):
-    """Log l'état de la table stories à un moment donné."""
-    conn = sqlite3.connect(LOCAL_DB_PATH)
-    cursor = conn.cursor()
-    cursor.execute("SELECT id, titre, utilisateur FROM stories")
-    stories = cursor.fetchall()
-    print(f"État de la table stories à l'étape '{step}':")
-    for story in stories:
-        print(f"  ID: {story[0]}, Titre: {story[1]}, Utilisateur: {story[2]}")
-    conn.close()
-
-def download_db_from_s3():
-    """Télécharge stories.db depuis S3 s'il existe, sinon utilise une base vide."""
-    max_retries = 3
-    retry_delay = 1  # secondes
-    if os.path.exists(LOCAL_DB_PATH):
-        try:
-            os.remove(LOCAL_DB_PATH)
-            print(f"Fichier local {LOCAL_DB_PATH} supprimé avant le téléchargement.")
-        except Exception as e:
-            print(f"Erreur lors de la suppression de {LOCAL_DB_PATH} : {e}")
-            raise e
-
-    for attempt in range(max_retries):
-        try:
-            # Télécharger le fichier depuis S3
-            print(f"Tentative {attempt + 1}/{max_retries} de téléchargement depuis S3...")
-            s3.download_file("jujul", S3_DB_KEY, LOCAL_DB_PATH)
-            print(f"Base de données téléchargée depuis S3 : s3://jujul/{S3_DB_KEY}")
-
-            # Vérifier si le fichier existe et n'est pas vide
-            if not os.path.exists(LOCAL_DB_PATH):
-                print("Le fichier téléchargé n'existe pas.")
-                raise FileNotFoundError("Fichier téléchargé n'existe pas")
-            file_size = os.path.getsize(LOCAL_DB_PATH)
-            print(f"Taille du fichier téléchargé : {file_size} octets")
-            if file_size == 0:
-                print("Le fichier téléchargé est vide.")
-                raise FileNotFoundError("Fichier téléchargé est vide")
-
-            # Vérifier l'intégrité de la base de données
-            print("Vérification de l'intégrité de la base de données...")
-            try:
-                with sqlite3.connect(LOCAL_DB_PATH) as conn:
-                    cursor = conn.cursor()
-                    cursor.execute("PRAGMA integrity_check;")
-                    result = cursor.fetchone()
-                    print(f"Résultat de la vérification d'intégrité : {result}")
-                    if result[0] != "ok":
-                        print(f"Échec de la vérification d'intégrité : {result}")
-                        raise sqlite3.DatabaseError("Base de données corrompue")
-                    # Vérifier le contenu de la table stories
-                    cursor.execute("SELECT id, titre, utilisateur FROM stories")
-                    stories = cursor.fetchall()
-                    print("État de la table stories dans le fichier local après téléchargement :")
-                    for story in stories:
-                        print(f"  ID: {story[0]}, Titre: {story[1]}, Utilisateur: {story[2]}")
-            except sqlite3.Error as e:
-                print(f"Erreur lors de la vérification de la base de données : {e}")
-                raise e
-
-            print("Base de données téléchargée et vérifiée avec succès.")
-            return True
-
-        except s3.exceptions.ClientError as e:
-            if e.response['Error']['Code'] == "404":
-                print("Base de données non trouvée sur S3, création d'une nouvelle base locale.")
-                with sqlite3.connect(LOCAL_DB_PATH) as conn:
-                    conn.close()
-                return False
-            else:
-                print(f"Erreur S3 lors du téléchargement : {e}")
-                raise e
-        except PermissionError as e:
-            if attempt < max_retries - 1:
-                print(f"Erreur de permission lors du téléchargement de stories.db : {e}. Réessai dans {retry_delay} secondes...")
-                time.sleep(retry_delay)
-            else:
-                print(f"Échec après {max_retries} tentatives : {e}")
-                raise e
-        except (sqlite3.Error, FileNotFoundError) as e:
-            print(f"Erreur lors de la validation de la base de données : {e}")
-            # Supprimer le fichier corrompu et réessayer
-            if os.path.exists(LOCAL_DB_PATH):
-                os.remove(LOCAL_DB_PATH)
-            if attempt < max_retries - 1:
-                print(f"Réessai dans {retry_delay} secondes...")
-                time.sleep(retry_delay)
-            else:
-                print("Échec après toutes les tentatives, création d'une nouvelle base locale.")
-                with sqlite3.connect(LOCAL_DB_PATH) as conn:
-                    conn.close()
-                return False
+http_client.configure_openai(openai)
+
+log = instrumentation.get_logger("app")
+
+# Nombre maximal de paragraphes illustrés en parallèle
+ILLUSTRATION_MAX_WORKERS = int(os.getenv("ILLUSTRATION_MAX_WORKERS", "6"))
+# Génération en streaming : affichage progressif et illustration dès qu'un paragraphe est complet
+STREAMING_GENERATION = os.getenv("STREAMING_GENERATION", "1") != "0"
+# Génération en tâche de fond (file jobs.py) ; BACKGROUND_JOBS=0 pour générer dans la session
+BACKGROUND_JOBS = os.getenv("BACKGROUND_JOBS", "1") != "0"
+# Historique : nombre de titres par page
+HISTORY_PAGE_SIZE = int(os.getenv("HISTORY_PAGE_SIZE", "20"))
+# Résumés des paragraphes pour les prompts d'image : modèle, et un seul appel par histoire si activé
+SUMMARY_MODEL = os.getenv("SUMMARY_MODEL", "gpt-3.5")
+BATCHED_SUMMARIES = os.getenv("BATCHED_SUMMARIES", "1") != "0"
+# Transfert des images générées vers S3 : délai de téléchargement (s) et mémoire tampon bornée
+IMAGE_DOWNLOAD_TIMEOUT = float(os.getenv("IMAGE_DOWNLOAD_TIMEOUT", "30"))
+IMAGE_TRANSFER_CONFIG = TransferConfig(
+    multipart_threshold=8 * 1024 * 1024,
+    multipart_chunksize=8 * 1024 * 1024,
+    max_concurrency=2,
+    max_io_queue=4,
+)
+# Modèles de prompt des résumés (ils font partie de la clé du cache des résumés)
+SUMMARY_PROMPT = "Résumé ce paragraphe pour un prompt d'image : {paragraph}"
+BATCH_SUMMARY_PROMPT = (
+    "Résume chacun des {count} paragraphes suivants pour un prompt d'image. "
+    "Réponds uniquement par un tableau JSON de {count} chaînes, une par paragraphe, dans l'ordre.\n\n{paragraphs}"
+)
 
 def upload_db_to_s3():
-    """Téléverse stories.db sur S3 après une modification."""
-    try:
-        s3.upload_file(LOCAL_DB_PATH, "jujul", S3_DB_KEY)
-        print(f"Base de données téléversée sur S3 : s3://jujul/{S3_DB_KEY}")
-        log_stories_table("Après téléversement sur S3")  # Log après téléversement
-    except Exception as e:
-        print(f"Erreur lors de l'upload de la base de données sur S3 : {e}")
-
-def initialize_db():
-    """Crée les tables nécessaires si la base de données est nouvelle."""
-    conn = sqlite3.connect(LOCAL_DB_PATH)
-    cursor = conn.cursor()
-    cursor.execute("""
-        CREATE TABLE IF NOT EXISTS stories_user (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            utilisateur TEXT UNIQUE,
-            password TEXT,
-            email TEXT,
-            sexe TEXT,
-            age INTEGER,
-            reset_code TEXT
-        )
-    """)
-    cursor.execute("""
-        CREATE TABLE IF NOT EXISTS personnages (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            personnage TEXT UNIQUE,
-            description TEXT
-        )
-    """)
-    cursor.execute("""
-        CREATE TABLE IF NOT EXISTS stories (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            story_id TEXT,
-            titre TEXT NOT NULL,
-            theme TEXT,
-            keywords TEXT,
-            sexe TEXT,
-            age INTEGER,
-            story TEXT NOT NULL,
-            utilisateur TEXT NOT NULL,
-            FOREIGN KEY (utilisateur) REFERENCES stories_user (utilisateur)
-        )
-    """)
-    cursor.execute("""
-        CREATE TABLE IF NOT EXISTS images (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            story_id INTEGER NOT NULL,
-            image_name TEXT NOT NULL,
-            FOREIGN KEY (story_id) REFERENCES stories (id)
-        )
-    """)
-    conn.commit()
-    conn.close()
-    print("Tables de la base de données créées ou vérifiées.")
+    """Programme la réplication sur S3 des modifications de stories.db (envoi groupé en arrière-plan)."""
+    get_replication_flusher().mark_dirty()
 
-# Télécharger la base de données au démarrage et initialiser si nécessaire
-was_downloaded = download_db_from_s3()
-if not was_downloaded:
-    initialize_db()
+def shorten(text, max_length):
+    return text[:max_length] + "..." if len(text) > max_length else text.strip()
 
-# Log après initialisation
-log_stories_table("Après initialisation de la base")
-
-# Charger les données initiales
-st.session_state["personnages"] = load_personnages()
-st.session_state["users"] = load_users()
-st.session_state["all_stories"] = load_all_stories()
-
-# Log après chargement des données initiales
-log_stories_table("Après chargement des données initiales")
-
-def download_from_s3(bucket_name, s3_key, local_path):
-    """Télécharge un fichier depuis S3 vers un chemin local temporaire."""
+def summarize_paragraph(paragraph, max_length=1000):
+    cache_key = summary_cache.make_key(SUMMARY_MODEL, SUMMARY_PROMPT, paragraph)
+    cached = summary_cache.get(cache_key)
+    if cached is not None:
+        return shorten(cached, max_length)
     try:
-        s3.download_file(bucket_name, s3_key, local_path)
-        return local_path
+        log.debug("réduction paragraphes pour prompt image")
+        with instrumentation.span("summarize"):
+            response = scheduler.chat_completion(
+                model=SUMMARY_MODEL,
+                messages=[
+                    {"role": "system", "content": "Tu es un assistant qui résume des textes."},
+                    {"role": "user", "content": SUMMARY_PROMPT.format(paragraph=paragraph)},
+                ],
+                max_tokens=150,
+                temperature=0.7,
+            )
+        summary = response.choices[0].message["content"]
+        summary_cache.put(cache_key, summary)
+        return shorten(summary, max_length)
     except Exception as e:
-        print(f"Erreur lors du téléchargement depuis S3 : {e}")
-        return None
+        log.warning(f"Erreur lors du résumé du paragraphe : {e}")
+        return shorten(paragraph, max_length)
 
-def upload_to_s3(local_path, bucket_name, s3_key):
-    """Téléverse un fichier local vers S3."""
-    try:
-        s3.upload_file(local_path, bucket_name, s3_key)
-        print(f"Sauvegardé sur S3 : s3://jujul/{s3_key}")
-        s3_url = f"https://{bucket_name}.s3.amazonaws.com/{s3_key}"
-        return s3_url
-    except Exception as e:
-        print(f"Erreur lors de l'upload vers S3 : {e}")
+def parse_summaries(content, count):
+    """Extrait le tableau JSON de résumés de la réponse, ou None s'il est inexploitable."""
+    start, end = content.find("["), content.rfind("]")
+    if start == -1 or end < start:
         return None
-
-def summarize_paragraph(paragraph, max_length=1000):
     try:
-        print("réduction paragraphes pour prompt image")
-        response = openai.ChatCompletion.create(
-            model="gpt-3.5",
-            messages=[
-                {"role": "system", "content": "Tu es un assistant qui résume des textes."},
-                {"role": "user", "content": f"Résumé ce paragraphe pour un prompt d'image : {paragraph}"},
-            ],
-            max_tokens=150,
-            temperature=0.7,
-        )
-        summary = response.choices[0].message["content"]
-        return summary[:max_length] + "..." if len(summary) > max_length else summary.strip()
-    except Exception as e:
-        print(f"Erreur lors du résumé du paragraphe : {e}")
-        return paragraph[:max_length] + "..." if len(paragraph) > max_length else paragraph
+        summaries = json.loads(content[start:end + 1])
+    except ValueError:
+        return None
+    if (not isinstance(summaries, list) or len(summaries) != count
+            or not all(isinstance(summary, str) and summary.strip() for summary in summaries)):
+        return None
+    return summaries
+
+def summarize_paragraphs(paragraphs, max_length=1000):
+    """Résume tous les paragraphes d'une histoire en un seul appel.
+
+    Seuls les paragraphes absents du cache des résumés sont envoyés. Renvoie les prompts
+    d'image dans l'ordre des paragraphes, ou None si la réponse ne peut pas être
+    exploitée : l'appelant revient alors au résumé paragraphe par paragraphe.
+    """
+    keys = [summary_cache.make_key(SUMMARY_MODEL, BATCH_SUMMARY_PROMPT, paragraph) for paragraph in paragraphs]
+    cached = summary_cache.get_many(keys)
+    missing = [index for index, key in enumerate(keys) if key not in cached]
+    if missing:
+        numbered = "\n\n".join(f"{position}. {paragraphs[index]}" for position, index in enumerate(missing, start=1))
+        try:
+            log.debug(f"réduction de {len(missing)} paragraphes pour prompts image (un seul appel)")
+            with instrumentation.span("summarize.batch", paragraphs=len(missing)):
+                response = scheduler.chat_completion(
+                    model=SUMMARY_MODEL,
+                    messages=[
+                        {"role": "system", "content": "Tu es un assistant qui résume des textes."},
+                        {"role": "user", "content": BATCH_SUMMARY_PROMPT.format(count=len(missing),
+                                                                                paragraphs=numbered)},
+                    ],
+                    max_tokens=150 * len(missing),
+                    temperature=0.7,
+                )
+            summaries = parse_summaries(response.choices[0].message["content"], len(missing))
+        except Exception as e:
+            log.warning(f"Erreur lors du résumé groupé des paragraphes : {e}")
+            return None
+        if summaries is None:
+            instrumentation.increment("failures_total", operation="summarize.batch")
+            log.warning("Réponse du résumé groupé inexploitable, résumé paragraphe par paragraphe.")
+            return None
+        fresh = {keys[index]: summary for index, summary in zip(missing, summaries)}
+        summary_cache.put_many(fresh)
+        cached.update(fresh)
+    return [shorten(cached[key], max_length) for key in keys]
 
 def save_image(image_url, story_id, paragraph_index):
-    """Télécharge une image depuis une URL et la téléverse sur S3."""
+    """Transfère une image depuis son URL vers S3 en streaming, sans fichier temporaire."""
     unique_id = uuid.uuid4().hex
     s3_key = f"images/story_{story_id}_paragraph_{paragraph_index}_{unique_id}.png"
 
-    with tempfile.NamedTemporaryFile(delete=False, suffix=".png") as temp_file:
-        response = requests.get(image_url)
+    session = http_client.get_session()
+    with instrumentation.span("image.download"):  # jusqu'aux en-têtes de la réponse
+        response = session.get(image_url, stream=True,
+                               timeout=(http_client.HTTP_CONNECT_TIMEOUT, IMAGE_DOWNLOAD_TIMEOUT))
+    with response:
         response.raise_for_status()
-        temp_file.write(response.content)
-        temp_file_path = temp_file.name
-
-    s3_url = upload_to_s3(temp_file_path, "jujul", s3_key)
-    os.unlink(temp_file_path)
-    return s3_url if s3_url else None
-
-def edit_images_with_dalle(paragraphs, style, story_id, personnage):
-    with tempfile.NamedTemporaryFile(delete=False, suffix=".png") as base_temp, \
-            tempfile.NamedTemporaryFile(delete=False, suffix=".png") as mask_temp:
-        base_image_path = download_from_s3("jujul", "images_source/zouzou.png", base_temp.name)
-        mask_path = download_from_s3("jujul", "images_source/mask.png", mask_temp.name)
-
-        if not base_image_path or not mask_path:
-            print("Impossible de télécharger les fichiers de base depuis S3.")
-            return []
-
-        image_paths = []
-        for index, paragraph in enumerate(paragraphs):
-            summarized_prompt = summarize_paragraph(paragraph)
-            full_prompt = f"{personnage}: {summarized_prompt}. Style: {style}"
-            try:
-                response = openai.Image.create_edit(
-                    image=open(base_image_path, "rb"),
-                    mask=open(mask_path, "rb"),
-                    prompt=full_prompt,
-                    n=1,
-                    size="256x256",
-                )
-                image_url = response["data"][0]["url"]
-                s3_url = save_image(image_url, story_id, index + 1)
-                image_paths.append(s3_url)
-            except Exception as e:
-                print(f"Erreur lors de l'édition de l'image : {e}")
-                image_paths.append(None)
-
-    os.unlink(base_image_path)
-    os.unlink(mask_path)
+        response.raw.decode_content = True  # décompresse un éventuel Content-Encoding au fil de la lecture
+        content_type = response.headers.get("Content-Type", "image/png").split(";")[0].strip()
+        try:
+            # Le corps de l'image est lu pendant l'upload : cette étape comprend sa réception
+            with instrumentation.span("s3.upload"):
+                s3.upload_fileobj(response.raw, S3_BUCKET_NAME, s3_key,
+                                  ExtraArgs={"ContentType": content_type}, Config=IMAGE_TRANSFER_CONFIG)
+        except Exception as e:
+            log.error(f"Erreur lors de l'upload vers S3 : {e}")
+            return None
+    log.info(f"Sauvegardé sur S3 : s3://{S3_BUCKET_NAME}/{s3_key}")
+    return f"https://{S3_BUCKET_NAME}.s3.amazonaws.com/{s3_key}"
+
+def illustrate_paragraph(paragraph, index, style, story_id, personnage, base_image, mask,
+                         summarized_prompt=None):
+    """Résume un paragraphe (sauf si son résumé est fourni), génère son illustration et la sauvegarde sur S3."""
+    if summarized_prompt is None:
+        summarized_prompt = summarize_paragraph(paragraph)
+    full_prompt = f"{personnage}: {summarized_prompt}. Style: {style}"
+    with instrumentation.span("image.edit"):
+        response = scheduler.image_create_edit(
+            image=base_image,
+            mask=mask,
+            prompt=full_prompt,
+            n=1,
+            size="256x256",
+        )
+    image_url = response["data"][0]["url"]
+    return save_image(image_url, story_id, index + 1)
+
+def illustration_result(future, index):
+    """Renvoie l'URL produite par un paragraphe, ou None si son illustration a échoué."""
+    try:
+        return future.result()
+    except Exception as e:
+        instrumentation.increment("failures_total", operation="illustration")
+        log.error(f"Erreur lors de l'édition de l'image du paragraphe {index + 1} : {e}")
+        return None
+
+def edit_images_with_dalle(paragraphs, style, story_id, personnage, max_workers=None, indices=None):
+    """Illustre les paragraphes en parallèle et renvoie les URLs dans l'ordre des paragraphes.
+
+    Chaque paragraphe est traité indépendamment : un échec donne None à sa position
+    sans interrompre les autres. indices donne la position de chaque paragraphe dans
+    l'histoire lorsque seule une partie est illustrée (reprise d'une tâche).
+    """
+    base_image, mask = load_source_images()
+    if not base_image:
+        return []
+
+    summaries = summarize_paragraphs(paragraphs) if BATCHED_SUMMARIES else None
+    if summaries is None:
+        summaries = [None] * len(paragraphs)
+
+    indices = indices or range(len(paragraphs))
+    workers = max(1, min(max_workers or ILLUSTRATION_MAX_WORKERS, len(paragraphs) or 1))
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = [
+            executor.submit(illustrate_paragraph, paragraph, index, style, story_id, personnage,
+                            base_image, mask, summary)
+            for index, paragraph, summary in zip(indices, paragraphs, summaries)
+        ]
+        image_paths = [illustration_result(future, index) for index, future in zip(indices, futures)]
+
     return image_paths
 
 def options(theme_list, mode_list, style_images, personnages, personnage_names):
@@ -309,22 +234,79 @@ def options(theme_list, mode_list, style_images, personnages, personnage_names):
     st.sidebar.markdown("<br><br>", unsafe_allow_html=True)
     return theme, mode, user_keywords, "", selected_perso
 
+def count_stories(username):
+    """Renvoie le nombre d'histoires enregistrées par l'utilisateur."""
+    def load():
+        return db.query_one("SELECT COUNT(*) FROM stories WHERE utilisateur = ?", (username,))[0]
+    return read_cache.get_read_cache().get(read_cache.STORIES, ("count", username), load)
+
+def load_story_titles(username, page, page_size=None):
+    """Renvoie (id, titre) des histoires d'une page de l'historique, les plus récentes d'abord."""
+    page_size = page_size or HISTORY_PAGE_SIZE
+    def load():
+        return db.query(
+            "SELECT id, titre FROM stories WHERE utilisateur = ? ORDER BY id DESC LIMIT ? OFFSET ?",
+            (username, page_size, (page - 1) * page_size),
+        )
+    return read_cache.get_read_cache().get(read_cache.STORIES, ("titles", username, page, page_size), load)
+
+def fetch_story(story_id):
+    """Lit l'histoire (texte encore compressé), son auteur et ses images dans la base, ou None."""
+    row = db.query_one("SELECT titre, story, utilisateur FROM stories WHERE id = ?", (story_id,))
+    if row is None:
+        return None
+    images = db.query("SELECT image_name, paragraph_index FROM images WHERE story_id = ? ORDER BY id", (story_id,))
+    return {"titre": row[0], "story": row[1], "utilisateur": row[2], "images": images_by_paragraph(images)}
+
+def images_by_paragraph(rows):
+    """Place les images (nom, position) à la position de leur paragraphe, None pour un paragraphe sans image.
+
+    Les images enregistrées avant la migration 6 n'ont pas de position : elles restent
+    dans leur ordre d'insertion.
+    """
+    if any(index is None for _, index in rows):
+        return [name for name, _ in rows]
+    images = [None] * (max((index for _, index in rows), default=-1) + 1)
+    for name, index in rows:
+        images[index] = name
+    return images
+
+def load_story(story_id, username):
+    """Charge le texte et les images d'une histoire de l'utilisateur via le cache de lecture partagé."""
+    story = read_cache.get_read_cache().get(read_cache.STORY, story_id, lambda: fetch_story(story_id))
+    if story is None or story["utilisateur"] != username:
+        return None
+    return story
+
 def load_stories(username):
-    conn = sqlite3.connect(LOCAL_DB_PATH)
-    cursor = conn.cursor()
-    cursor.execute("SELECT titre, story FROM stories WHERE utilisateur = ?", (username,))
-    user_stories = cursor.fetchall()
-    if not user_stories:
+    """Affiche l'historique paginé ; seule l'histoire ouverte est chargée en entier."""
+    total = count_stories(username)
+    if not total:
         st.warning("Aucune histoire enregistrée pour cet utilisateur.")
         return
-    for titre, story_text in user_stories:
-        with st.expander(titre):
-            paragraphs = story_text.split("\n\n")
-            for paragraph in paragraphs:
-                st.write(paragraph.strip())
-    conn.close()
-
-def main_app(users, personnages):
+
+    pages = -(-total // HISTORY_PAGE_SIZE)
+    page = 1
+    if pages > 1:
+        page = st.number_input(f"Page (sur {pages})", min_value=1, max_value=pages, value=1, step=1,
+                               key="history_page")
+    titles = dict(load_story_titles(username, page))
+    story_id = st.selectbox("Quelle histoire veux-tu relire ?", list(titles), index=None,
+                            format_func=lambda story_id: titles[story_id], placeholder="Choisis une histoire",
+                            key=f"history_story_{page}")
+    if story_id is None:
+        return
+
+    story = load_story(story_id, username)
+    if story is None:
+        st.warning("Cette histoire n'existe plus.")
+        return
+    st.subheader(story["titre"])
+    # Le cache garde le texte compressé : il n'est décompressé que pour l'histoire affichée
+    text = story_codec.decode(story["story"])
+    display_story_with_images(story["images"], text.split("\n\n"))
+
+def main_app(user, personnages):
     st.title(f"Bienvenue {st.session_state['username']}")
     theme_list = ("Aventure", "Fantastique", "Science-fiction", "Comédie")
     mode_list = ("nouvelle histoire", "histoires enregistrées")
@@ -335,32 +317,32 @@ def main_app(users, personnages):
 
     if mode == "nouvelle histoire":
         if st.sidebar.button("Lancer"):
-            image_paths = []
-            username = st.session_state["username"]
-            generated_story = generate_story(theme, user_keywords, users, personnages, selected_perso)
-            paragraphs = generated_story.split("\n\n")
-            if not paragraphs:
-                st.error("L'histoire générée est vide.")
+            style = f"Illustration pour un livre pour enfants, cartoon, personnages constants."
+            if BACKGROUND_JOBS:
+                submit_story_job(theme, user_keywords, user, selected_perso, style)
+            elif STREAMING_GENERATION:
+                generated_story, image_paths, story_key = generate_and_illustrate_streaming(
+                    theme, user_keywords, user, personnages, selected_perso, style)
+                if not generated_story.strip():
+                    st.error("L'histoire générée est vide.")
+                    return
+                save_story(generated_story, theme, user_keywords, user, image_paths, story_key)
                 return
+            else:
+                generated_story = generate_story(theme, user_keywords, user, personnages, selected_perso)
+                paragraphs = generated_story.split("\n\n")
+                if not generated_story.strip():
+                    st.error("L'histoire générée est vide.")
+                    return
 
-            # Sauvegarder l'histoire pour obtenir un story_id
-            raw_title = generated_story.split("\n")[0].replace("Titre : ", "").strip()
-            title = re.sub(r'[\\/:"*?<>|]', "", raw_title)
-            conn = sqlite3.connect(LOCAL_DB_PATH)
-            cursor = conn.cursor()
-            cursor.execute("""
-                INSERT INTO stories (story_id, titre, theme, keywords, sexe, age, story, utilisateur)
-                VALUES (?, ?, ?, ?, ?, ?, ?, ?)
-            """, (None, title, theme, user_keywords, users[username]["sexe"], users[username]["age"], generated_story, username))
-            story_id = cursor.lastrowid
-            conn.commit()
-            conn.close()
-            upload_db_to_s3()  # Synchroniser avec S3 après modification
+                # La clé réservée nomme les images sur S3 ; l'histoire n'est enregistrée qu'une fois, avec ses images
+                story_key = reserve_story_key()
+                image_paths = edit_images_with_dalle(paragraphs, style, story_key, ', '.join(selected_perso))
+                display_story_with_images(image_paths, paragraphs)
+                save_story(generated_story, theme, user_keywords, user, image_paths, story_key)
 
-            style = f"Illustration pour un livre pour enfants, cartoon, personnages constants."
-            image_paths = edit_images_with_dalle(paragraphs, style, story_id, ', '.join(selected_perso))
-            display_story_with_images(image_paths, paragraphs)
-            save_story(generated_story, theme, user_keywords, users, image_paths)
+        if BACKGROUND_JOBS:
+            show_story_jobs(st.session_state["username"])
 
     elif mode == "histoires enregistrées":
         load_stories(st.session_state["username"])
@@ -370,12 +352,81 @@ def main_app(users, personnages):
         st.session_state["username"] = None
         st.rerun()
 
-def generate_story(theme, user_keywords, users, personnages, selected_perso):
-    username = st.session_state["username"]
-    messages = make_prompt(theme, user_keywords, users[username]["age"], users[username]["sexe"], personnages,
+def generate_story(theme, user_keywords, user, personnages, selected_perso):
+    messages = make_prompt(theme, user_keywords, user["age"], user["sexe"], personnages,
                            selected_perso)
-    response = openai.ChatCompletion.create(model="gpt-4", messages=messages, max_tokens=4000, temperature=0.7)
-    return response.choices[0].message["content"]
+    with instrumentation.span("llm.story"):
+        return llm.story_provider().complete(messages, max_tokens=4000, temperature=0.7)
+
+def stream_story(theme, user_keywords, user, personnages, selected_perso):
+    """Génère l'histoire en streaming et renvoie les fragments de texte au fil de l'eau."""
+    messages = make_prompt(theme, user_keywords, user["age"], user["sexe"], personnages,
+                           selected_perso)
+    with instrumentation.span("llm.story.stream"):
+        yield from llm.story_provider().stream(messages, max_tokens=4000, temperature=0.7)
+
+def split_paragraphs(chunks):
+    """Renvoie chaque paragraphe dès que sa fin (\\n\\n) a été reçue."""
+    buffer = ""
+    for chunk in chunks:
+        buffer += chunk
+        while "\n\n" in buffer:
+            paragraph, buffer = buffer.split("\n\n", 1)
+            yield paragraph
+    if buffer:
+        yield buffer
+
+def generate_and_illustrate_streaming(theme, user_keywords, user, personnages, selected_perso, style):
+    """Affiche l'histoire paragraphe par paragraphe et lance chaque illustration dès que possible.
+
+    Renvoie le texte complet, les URLs des images dans l'ordre des paragraphes et la clé
+    de l'histoire utilisée pour nommer les images sur S3. Le texte est reconstitué à partir
+    des seuls paragraphes non vides : une fois relu et découpé sur "\n\n", chaque
+    paragraphe retrouve l'image de même position.
+    """
+    story_key = reserve_story_key()
+    personnage = ', '.join(selected_perso)
+    base_image, mask = load_source_images()
+
+    paragraphs = []
+    image_slots = []
+    futures = {}
+    ready = {}
+
+    def show_ready_illustrations(block):
+        pending = [future for future in futures if future not in ready]
+        if not pending:
+            return
+        done, _ = wait(pending, timeout=None if block else 0, return_when=FIRST_COMPLETED)
+        for future in done:
+            index = futures[future]
+            ready[future] = illustration_result(future, index)
+            if ready[future]:
+                image_slots[index].image(ready[future], caption="Illustration", use_container_width=True)
+
+    with ThreadPoolExecutor(max_workers=max(1, ILLUSTRATION_MAX_WORKERS)) as executor:
+        chunks = stream_story(theme, user_keywords, user, personnages, selected_perso)
+        for paragraph in split_paragraphs(chunks):
+            paragraph = paragraph.strip()
+            if not paragraph:
+                continue
+            index = len(paragraphs)
+            paragraphs.append(paragraph)
+            st.write(paragraph)
+            image_slots.append(st.empty())
+            if base_image:
+                future = executor.submit(illustrate_paragraph, paragraph, index, style, story_key, personnage,
+                                         base_image, mask)
+                futures[future] = index
+            show_ready_illustrations(block=False)
+
+        while len(ready) < len(futures):
+            show_ready_illustrations(block=True)
+
+    image_paths = [None] * len(paragraphs)
+    for future, index in futures.items():
+        image_paths[index] = ready[future]
+    return "\n\n".join(paragraphs), image_paths, story_key
 
 def display_story_with_images(image_paths, paragraphs):
     for i, paragraph in enumerate(paragraphs):
@@ -383,40 +434,187 @@ def display_story_with_images(image_paths, paragraphs):
         if image_paths and i < len(image_paths) and image_paths[i]:
             st.image(image_paths[i], caption="Illustration", use_container_width=True)
 
-def save_story(story, theme, user_keywords, users, image_paths):
+def reserve_story_key():
+    """Réserve la clé d'une nouvelle histoire, utilisée pour nommer ses images sur S3 avant l'enregistrement."""
+    return uuid.uuid4().hex
+
+def story_title(story):
     raw_title = story.split("\n")[0].replace("Titre : ", "").strip()
-    title = re.sub(r'[\\/:"*?<>|]', "", raw_title)
-    username = st.session_state["username"]
-    conn = sqlite3.connect(LOCAL_DB_PATH)
-    cursor = conn.cursor()
-    cursor.execute("""
-        INSERT INTO stories (story_id, titre, theme, keywords, sexe, age, story, utilisateur)
-        VALUES (?, ?, ?, ?, ?, ?, ?, ?)
-    """, (None, title, theme, user_keywords, users[username]["sexe"], users[username]["age"], story, username))
-    story_id = cursor.lastrowid
-    for image_path in image_paths:
-        if image_path:
-            cursor.execute("INSERT INTO images (story_id, image_name) VALUES (?, ?)", (story_id, image_path))
-    conn.commit()
-    conn.close()
+    return re.sub(r'[\\/:"*?<>|]', "", raw_title)
+
+def persist_story(story, theme, user_keywords, user, username, image_paths, story_key=None):
+    """Enregistre l'histoire et ses images dans une seule transaction, réplique une seule fois et renvoie son id."""
+    story_codec.ensure_dictionary()  # entraînement éventuel hors de la transaction d'écriture
+    with instrumentation.span("persist"), db.transaction() as conn:
+        cursor = conn.execute("""
+            INSERT INTO stories (story_id, titre, theme, keywords, sexe, age, story, utilisateur)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+        """, (story_key, story_title(story), theme, user_keywords, user["sexe"], user["age"],
+              story_codec.encode(story, conn), username))
+        story_id = cursor.lastrowid
+        conn.executemany("INSERT INTO images (story_id, image_name, paragraph_index) VALUES (?, ?, ?)",
+                         [(story_id, image_path, index) for index, image_path in enumerate(image_paths) if image_path])
+    read_cache.get_read_cache().bump(read_cache.STORIES)
     upload_db_to_s3()  # Synchroniser avec S3 après modification
-    st.session_state["all_stories"][title] = {
+    return story_id
+
+def save_story(story, theme, user_keywords, user, image_paths, story_key=None):
+    """Enregistre l'histoire de l'utilisateur de la session courante et renvoie son id."""
+    return persist_story(story, theme, user_keywords, user, st.session_state["username"], image_paths, story_key)
+
+def stream_story_job(job, user):
+    """Étape "text" d'une tâche : écrit l'histoire en streaming et illustre chaque paragraphe dès sa fin.
+
+    Les paragraphes reçus et les images obtenues sont enregistrés dans l'état de la tâche
+    au fur et à mesure, pour que show_story_jobs les affiche pendant la génération.
+    Renvoie le texte (paragraphes non vides) et les URLs des images par paragraphe.
+    """
+    params = job["params"]
+    personnage = ', '.join(params["selected_perso"])
+    base_image, mask = load_source_images()
+    paragraphs = []
+    images = []
+    futures = {}
+
+    def collect(block):
+        if not futures:
+            return False
+        done, _ = wait(list(futures), timeout=None if block else 0, return_when=FIRST_COMPLETED)
+        for future in done:
+            index = futures.pop(future)
+            images[index] = illustration_result(future, index)
+        return bool(done)
+
+    with ThreadPoolExecutor(max_workers=max(1, ILLUSTRATION_MAX_WORKERS)) as executor:
+        chunks = stream_story(params["theme"], params["keywords"], user, get_personnages(), params["selected_perso"])
+        for paragraph in split_paragraphs(chunks):
+            paragraph = paragraph.strip()
+            if not paragraph:
+                continue
+            index = len(paragraphs)
+            paragraphs.append(paragraph)
+            images.append(None)
+            if base_image:
+                futures[executor.submit(illustrate_paragraph, paragraph, index, params["style"], job["key"],
+                                        personnage, base_image, mask)] = index
+            collect(block=False)
+            jobs.save_state(job, story="\n\n".join(paragraphs), images=images)
+        while futures:
+            if collect(block=True):
+                jobs.save_state(job, images=images)
+    return "\n\n".join(paragraphs), images
+
+def run_story_job(job):
+    """Fait avancer une tâche de génération : texte, puis illustrations, puis enregistrement.
+
+    En streaming, l'étape du texte lance déjà l'illustration de chaque paragraphe ;
+    l'étape des illustrations ne refait alors que celles qui ont échoué. Chaque étape
+    enregistre son résultat dans la tâche : une reprise repart de l'étape interrompue et
+    n'illustre que les paragraphes qui n'ont pas encore d'image.
+    """
+    params = job["params"]
+    user = {"sexe": params["sexe"], "age": params["age"]}
+
+    if job["stage"] == "text":
+        if STREAMING_GENERATION:
+            story, images = stream_story_job(job, user)
+        else:
+            story = generate_story(params["theme"], params["keywords"], user, get_personnages(),
+                                   params["selected_perso"])
+            images = [None] * len(story.split("\n\n"))
+        if not story.strip():
+            raise ValueError("L'histoire générée est vide.")
+        jobs.advance(job, "illustrations", story=story, images=images)
+
+    if job["stage"] == "illustrations":
+        paragraphs = job["state"]["story"].split("\n\n")
+        images = job["state"]["images"]
+        missing = [index for index, image in enumerate(images) if image is None]
+        if missing:
+            results = edit_images_with_dalle([paragraphs[index] for index in missing], params["style"], job["key"],
+                                             ', '.join(params["selected_perso"]), indices=missing)
+            if not results:
+                raise RuntimeError("Images sources indisponibles.")
+            for index, image in zip(missing, results):
+                images[index] = image
+            failed = sum(1 for index in missing if images[index] is None)
+            if failed and job["attempts"] < jobs.JOB_MAX_ATTEMPTS:
+                # Garder les images obtenues : la prochaine tentative ne refait que les autres
+                jobs.advance(job, "illustrations", images=images)
+                raise RuntimeError(f"{failed} illustration(s) en échec.")
+        jobs.advance(job, "persist", images=images)
+
+    if job["stage"] == "persist":
+        # L'histoire a pu être enregistrée juste avant une interruption : ne pas la dupliquer
+        row = db.query_one("SELECT id FROM stories WHERE story_id = ?", (job["key"],))
+        story_id = row[0] if row else persist_story(job["state"]["story"], params["theme"], params["keywords"],
+                                                    user, job["utilisateur"], job["state"]["images"], job["key"])
+        jobs.advance(job, "done", story_id=story_id)
+
+@st.cache_resource
+def get_job_workers():
+    """Démarre une seule fois par processus les threads qui exécutent les tâches de génération."""
+    return jobs.JobWorkers(run_story_job)
+
+def submit_story_job(theme, user_keywords, user, selected_perso, style):
+    """Met la génération d'une histoire en file d'attente et renvoie la clé de la tâche."""
+    params = {
         "theme": theme,
         "keywords": user_keywords,
-        "sexe": users[username]["sexe"],
-        "age": users[username]["age"],
-        "story": story,
-        "utilisateur": username,
-        "images": image_paths
+        "sexe": user["sexe"],
+        "age": user["age"],
+        "selected_perso": list(selected_perso),
+        "style": style,
     }
+    job_key = jobs.enqueue(st.session_state["username"], params, stage="text", job_key=reserve_story_key())
+    st.session_state.setdefault("story_jobs", []).append(job_key)
+    get_job_workers().notify()
+    return job_key
+
+JOB_STAGE_LABELS = {
+    "text": "écriture de l'histoire",
+    "illustrations": "illustrations",
+    "persist": "enregistrement",
+    "done": "terminée",
+}
+
+@st.fragment(run_every=jobs.JOB_POLL_SECONDS)
+def show_story_jobs(username):
+    """Affiche l'avancement des générations de l'utilisateur, rafraîchi périodiquement."""
+    session_jobs = st.session_state.setdefault("story_jobs", [])
+    for job in jobs.list_jobs(username):
+        if job["status"] in (jobs.QUEUED, jobs.RUNNING):
+            label = JOB_STAGE_LABELS.get(job["stage"], job["stage"])
+            images = job["state"].get("images")
+            if job["stage"] in ("text", "illustrations") and images:
+                done = sum(1 for image in images if image)
+                label = f"{label} ({done}/{len(images)} illustrations)"
+            st.info(f"Histoire en préparation : {label}…")
+            # Histoire en cours d'écriture : paragraphes et images déjà obtenus
+            if job["key"] in session_jobs and job["state"].get("story"):
+                display_story_with_images(images, job["state"]["story"].split("\n\n"))
+        elif job["status"] == jobs.FAILED:
+            st.error(f"La génération d'une histoire a échoué ({JOB_STAGE_LABELS.get(job['stage'], job['stage'])}) : "
+                     f"{job['error']}")
+            if st.button("Reprendre", key=f"retry_{job['key']}"):
+                jobs.retry(job["key"])
+                get_job_workers().notify()
+                st.rerun(scope="fragment")
+        elif job["key"] in session_jobs:
+            state = job["state"]
+            with st.expander(story_title(state["story"]), expanded=job["key"] == session_jobs[-1]):
+                display_story_with_images(state["images"], state["story"].split("\n\n"))
 
 if __name__ == "__main__":
+    if BACKGROUND_JOBS:
+        get_job_workers()  # reprend aussi les tâches laissées en file par un redémarrage
+
     if "authenticated" not in st.session_state:
         st.session_state["authenticated"] = False
         st.session_state["username"] = None
 
     if st.session_state["authenticated"]:
-        main_app(st.session_state["users"], st.session_state["personnages"])
+        main_app(current_user(), get_personnages())
     else:
         st.sidebar.title("Navigation")
         page = st.sidebar.radio("Accès à l'application", ["Connexion", "Créer un compte", "Mot de passe oublié"])
@@ -1,16 +1,14 @@
-import os
 from users import login_page, create_account_page, forgot_password_page
 import json
 import openai
 import make_prompt
 import streamlit as st
 from dotenv import load_dotenv
-import requests
+import llm
 
 load_dotenv()
 
-# Assumons que la clé API de Grok est configurée de manière similaire
-grok_api_key = os.getenv("GROK_API_KEY")
+# La clé API de Grok (GROK_API_KEY) est lue par llm.GrokProvider
 
 def options(theme_list, mode_list):
     mode = st.sidebar.radio(
@@ -55,35 +53,17 @@ def main_app(users):
 
 
 def generate_story(theme, user_keywords, users):
-    # Construire le message pour l'API Grok
+    username = st.session_state["username"]
+    # Construire le message pour l'API Grok (pas de personnages imposés dans cette version)
     messages = make_prompt.make_prompt(
-        theme, user_keywords, users[username]["age"], users[username]["sexe"]
+        theme, user_keywords, users[username]["age"], users[username]["sexe"], {}, []
     )
 
-    # Envoyer la requête à l'API Grok avec la bibliothèque requests
-    response = requests.post(
-        "https://api.x.ai/v1/chat/completions",
-        headers={
-            "Authorization": f"Bearer {grok_api_key}",
-            "Content-Type": "application/json"
-        },
-        json={
-            "model": "grok-beta",
-            "messages": messages,
-            "max_tokens": 2000,
-            "temperature": 0.7
-        }
-    )
-
-    # Vérifier si la requête a réussi
-    if response.status_code == 200:
-        data = response.json()
-        generated_story = data['choices'][0]['message']['content']
-        return generated_story
-    else:
-        raise Exception(f"Erreur lors de l'appel à l'API Grok: {response.status_code}")
+    # Envoyer la requête à l'API Grok via la couche des fournisseurs (llm.py)
+    return llm.get_provider("grok").complete(messages, max_tokens=2000, temperature=0.7)
 
 def record_story(generated_story, theme, user_keywords, users):
+    username = st.session_state["username"]
     with open("json/stories.json", "r") as f:
         stories = json.load(f)
 
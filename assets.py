@@ -0,0 +1,66 @@
+import os
+import threading
+import time
+import streamlit as st
+import instrumentation
+from bootstrap import get_s3_client, S3_BUCKET_NAME
+
+log = instrumentation.get_logger("assets")
+
+# Images sources des illustrations (personnage de base et masque d'édition).
+#
+# Elles ne changent pratiquement jamais : leurs octets sont gardés en mémoire une fois
+# par processus et passés directement à l'API d'édition d'image. Au-delà de
+# ASSET_REVALIDATE_SECONDS, l'objet S3 est revalidé par une requête conditionnelle
+# (If-None-Match) qui ne retélécharge l'image que si son ETag a changé.
+
+SOURCE_IMAGE_KEY = "images_source/zouzou.png"
+MASK_KEY = "images_source/mask.png"
+ASSET_REVALIDATE_SECONDS = float(os.getenv("ASSET_REVALIDATE_SECONDS", "300"))
+
+class AssetCache:
+    """Octets d'objets S3 gardés en mémoire, revalidés par ETag."""
+
+    def __init__(self, s3, bucket, revalidate_seconds):
+        self.s3 = s3
+        self.bucket = bucket
+        self.revalidate_seconds = revalidate_seconds
+        self._entries = {}
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """Renvoie les octets de l'objet, téléchargés ou revalidés au besoin."""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and time.monotonic() - entry["checked_at"] < self.revalidate_seconds:
+                return entry["body"]
+
+            request = {"Bucket": self.bucket, "Key": key}
+            if entry is not None:
+                request["IfNoneMatch"] = entry["etag"]
+            try:
+                response = self.s3.get_object(**request)
+            except self.s3.exceptions.ClientError as e:
+                if entry is not None and e.response["Error"]["Code"] == "304":
+                    entry["checked_at"] = time.monotonic()
+                    return entry["body"]
+                raise
+            body = response["Body"].read()
+            self._entries[key] = {"body": body, "etag": response.get("ETag"), "checked_at": time.monotonic()}
+            log.info(f"Image source chargée depuis S3 : s3://{self.bucket}/{key} ({len(body)} octets)")
+            return body
+
+@st.cache_resource
+def get_asset_cache():
+    """Cache des images sources partagé par toutes les sessions du processus."""
+    return AssetCache(get_s3_client(), S3_BUCKET_NAME, ASSET_REVALIDATE_SECONDS)
+
+def load_source_images():
+    """Renvoie les octets de l'image de base et du masque, ou (None, None) si S3 est inaccessible."""
+    try:
+        cache = get_asset_cache()
+        return cache.get(SOURCE_IMAGE_KEY), cache.get(MASK_KEY)
+    except Exception as e:
+        instrumentation.increment("failures_total", operation="source_images")
+        log.error(f"Impossible de charger les images sources depuis S3 : {e}")
+        return None, None
@@ -0,0 +1,108 @@
+"""Mesure le temps de load_all_stories en fonction de la taille du corpus.
+
+Compare l'ancien chargement (une requête SELECT titre par image) au chargement
+par requête groupée unique de users.load_all_stories, sur des bases synthétiques.
+
+    python benchmarks/bench_load_all_stories.py --sizes 100 1000 10000 --images 6
+"""
+import argparse
+import json
+import os
+import sqlite3
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import db  # noqa: E402
+from users import load_all_stories  # noqa: E402
+
+PARAGRAPH = "Il était une fois un petit renard curieux qui voulait voir la mer. " * 20
+
+def build_corpus(path, n_stories, images_per_story):
+    """Crée une base synthétique de n_stories histoires avec leurs images."""
+    conn = sqlite3.connect(path)
+    conn.executescript("""
+        CREATE TABLE stories (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            story_id TEXT,
+            titre TEXT NOT NULL,
+            theme TEXT,
+            keywords TEXT,
+            sexe TEXT,
+            age INTEGER,
+            story TEXT NOT NULL,
+            utilisateur TEXT NOT NULL
+        );
+        CREATE TABLE images (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            story_id INTEGER NOT NULL,
+            image_name TEXT NOT NULL
+        );
+    """)
+    story = "\n\n".join([PARAGRAPH] * 6)
+    conn.executemany(
+        "INSERT INTO stories (titre, theme, keywords, sexe, age, story, utilisateur) VALUES (?, ?, ?, ?, ?, ?, ?)",
+        ((f"Histoire {i}", "Aventure", "mer, renard", "une fille", 7, story, f"user{i % 50}")
+         for i in range(n_stories)),
+    )
+    conn.executemany(
+        "INSERT INTO images (story_id, image_name) VALUES (?, ?)",
+        ((story_id, f"https://jujul.s3.amazonaws.com/images/story_{story_id}_paragraph_{p}.png")
+         for story_id in range(1, n_stories + 1) for p in range(1, images_per_story + 1)),
+    )
+    conn.commit()
+    conn.close()
+
+def legacy_load_all_stories(path):
+    """Ancien chargement : une requête supplémentaire par image (N+1)."""
+    conn = sqlite3.connect(path)
+    cursor = conn.cursor()
+    cursor.execute("SELECT titre, theme, keywords, sexe, age, story, utilisateur FROM stories")
+    stories = {row[0]: {"story": row[5], "images": []} for row in cursor.fetchall()}
+    cursor.execute("SELECT story_id, image_name FROM images")
+    for story_id, image_name in cursor.fetchall():
+        cursor.execute("SELECT titre FROM stories WHERE id = ?", (story_id,))
+        stories[cursor.fetchone()[0]]["images"].append(image_name)
+    conn.close()
+    return stories
+
+def timed(function, repeat):
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--sizes", type=int, nargs="+", default=[100, 1000, 10000])
+    parser.add_argument("--images", type=int, default=6, help="images par histoire")
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--json", help="fichier de sortie des résultats")
+    args = parser.parse_args()
+
+    output = os.path.abspath(args.json) if args.json else None
+    results = []
+    with tempfile.TemporaryDirectory() as workdir:
+        os.chdir(workdir)
+        print(f"{'histoires':>10} {'images':>8} {'N+1 (s)':>10} {'groupée (s)':>13} {'gain':>6}")
+        for size in args.sizes:
+            db.remove_database()
+            build_corpus(db.LOCAL_DB_PATH, size, args.images)
+            db.query_one("SELECT 1")  # ouverture de la connexion du pool hors mesure
+            legacy = timed(lambda: legacy_load_all_stories(db.LOCAL_DB_PATH), args.repeat)
+            grouped = timed(load_all_stories, args.repeat)
+            results.append({"stories": size, "images": size * args.images,
+                            "legacy_seconds": legacy, "grouped_seconds": grouped})
+            print(f"{size:>10} {size * args.images:>8} {legacy:>10.4f} {grouped:>13.4f} {legacy / grouped:>5.1f}x")
+        db.close_all()
+
+    if output:
+        with open(output, "w", encoding="utf-8") as f:
+            json.dump(results, f, indent=2)
+
+if __name__ == "__main__":
+    main()
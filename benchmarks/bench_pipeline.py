@@ -0,0 +1,118 @@
+"""Mesure de bout en bout du démarrage et de la génération d'une histoire, hors ligne.
+
+S3 est remplacé par un répertoire local (stand_ins.LocalS3) et les API OpenAI par un
+serveur HTTP local à latence réglable (stand_ins.FakeLLMServer). Le corpus est
+synthétique. Étapes mesurées :
+
+    startup      download_db_from_s3 (à froid puis 304), préparation de la base,
+                 load_personnages, load_all_stories, get_user
+    generation   generate_story, edit_images_with_dalle, persist_story, réplication
+
+    python benchmarks/bench_pipeline.py --users 1000 --stories 5000 --images 6 --iterations 5 --json out.json
+"""
+import argparse
+import json
+import os
+import platform
+import tempfile
+import time
+
+from stand_ins import offline_environment, percentiles, sqlite_counts  # ajoute aussi la racine du dépôt au chemin
+
+def timed(timings, stage, function, *args, **kwargs):
+    start = time.perf_counter()
+    result = function(*args, **kwargs)
+    timings.setdefault(stage, []).append(time.perf_counter() - start)
+    return result
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--users", type=int, default=100)
+    parser.add_argument("--stories", type=int, default=1000)
+    parser.add_argument("--images", type=int, default=6, help="images par histoire du corpus")
+    parser.add_argument("--iterations", type=int, default=3, help="histoires générées")
+    parser.add_argument("--latency", type=float, default=0.5, help="latence des appels de texte (s)")
+    parser.add_argument("--image-latency", type=float, default=2.0, help="latence des éditions d'image (s)")
+    parser.add_argument("--jitter", type=float, default=0.1, help="variation aléatoire des latences (s)")
+    parser.add_argument("--summary-cache", action="store_true", help="garder le cache des résumés actif")
+    parser.add_argument("--json", help="fichier de sortie des résultats")
+    args = parser.parse_args()
+
+    output = os.path.abspath(args.json) if args.json else None
+    workdir = tempfile.mkdtemp(prefix="bench-pipeline-")
+    s3, server = offline_environment(workdir, args.users, args.stories, args.images, latency=args.latency,
+                                     image_latency=args.image_latency, jitter=args.jitter,
+                                     summary_cache=args.summary_cache)
+    import db
+    import replication
+    import bootstrap
+    timings = {}
+
+    # Démarrage
+    timed(timings, "startup.download_db_from_s3.cold", bootstrap.download_db_from_s3)
+    timed(timings, "startup.download_db_from_s3.not_modified", bootstrap.download_db_from_s3)
+    import migrations
+    timed(timings, "startup.migrate", migrations.migrate, bootstrap.LOCAL_DB_PATH)
+    timed(timings, "startup.replay_log", lambda: (replication.install_change_log(bootstrap.LOCAL_DB_PATH),
+                                                  replication.replay_log(s3, bootstrap.S3_BUCKET_NAME,
+                                                                         bootstrap.LOCAL_DB_PATH)))
+    import users
+    personnages = timed(timings, "startup.load_personnages", users.load_personnages)
+    timed(timings, "startup.load_all_stories", users.load_all_stories)
+    user = timed(timings, "startup.get_user", users.get_user, "user0")
+    timed(timings, "startup.find_username_by_email_hash", users.find_username_by_email_hash,
+          users.hash("user0@example.com"))
+
+    import app
+
+    selected_perso = list(personnages)[:1]
+    style = "Illustration pour un livre pour enfants, cartoon, personnages constants."
+    per_generation = []
+    flusher = bootstrap.get_replication_flusher()
+    for iteration in range(args.iterations):
+        rows_before = sqlite_counts(bootstrap.LOCAL_DB_PATH)
+        s3_before = s3.snapshot_counters()
+        start = time.perf_counter()
+        story = timed(timings, "generation.generate_story", app.generate_story, "Aventure", "mer, renard", user,
+                      personnages, selected_perso)
+        paragraphs = story.split("\n\n")
+        story_key = app.reserve_story_key()
+        image_paths = timed(timings, "generation.edit_images_with_dalle", app.edit_images_with_dalle, paragraphs,
+                            style, story_key, ", ".join(selected_perso))
+        timed(timings, "generation.persist_story", app.persist_story, story, "Aventure", "mer, renard", user,
+              "user0", image_paths, story_key)
+        timed(timings, "generation.replication_flush", flusher.flush)
+        timings.setdefault("generation.total", []).append(time.perf_counter() - start)
+
+        rows_after = sqlite_counts(bootstrap.LOCAL_DB_PATH)
+        s3_after = s3.snapshot_counters()
+        per_generation.append({
+            "rows": {table: rows_after[table] - rows_before[table] for table in rows_after},
+            "s3_calls": {operation: count - s3_before["calls"].get(operation, 0)
+                         for operation, count in s3_after["calls"].items()
+                         if count != s3_before["calls"].get(operation, 0)},
+            "s3_bytes_in": s3_after["bytes_in"] - s3_before["bytes_in"],
+            "images": sum(1 for image in image_paths if image),
+        })
+
+    server.stop()
+    db.close_all()
+
+    results = {
+        "config": vars(args),
+        "environment": {"python": platform.python_version(), "platform": platform.platform()},
+        "stages": {stage: percentiles(values) for stage, values in timings.items()},
+        "per_generation": per_generation,
+        "llm_requests": dict(server.requests),
+    }
+    print(f"{'étape':<45} {'n':>3} {'p50 (s)':>9} {'p95 (s)':>9} {'max (s)':>9}")
+    for stage, summary in results["stages"].items():
+        print(f"{stage:<45} {summary['count']:>3} {summary['p50']:>9.4f} {summary['p95']:>9.4f} {summary['max']:>9.4f}")
+    for index, generation in enumerate(per_generation, start=1):
+        print(f"histoire {index} : lignes {generation['rows']}, appels S3 {generation['s3_calls']}")
+    if output:
+        with open(output, "w", encoding="utf-8") as f:
+            json.dump(results, f, indent=2, ensure_ascii=False)
+
+if __name__ == "__main__":
+    main()
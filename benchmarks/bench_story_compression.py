@@ -0,0 +1,157 @@
+"""Mesure la taille de stories.db et le temps de lecture des histoires, compressées ou non.
+
+Pour chaque taille de corpus synthétique (environ 2000 mots de français par histoire),
+la base est construite avec les histoires en texte, puis convertie : migration 5 pour
+zlib, réencodage avec un dictionnaire entraîné pour zstd (si zstandard est installé).
+Sont mesurés la taille du fichier (celle du snapshot envoyé sur S3), le temps de
+conversion, la lecture d'histoires au hasard (requête + décompression) et
+users.load_all_stories.
+
+    python benchmarks/bench_story_compression.py --sizes 1000 5000 --methods none zlib zstd --json compression.json
+"""
+import argparse
+import json
+import os
+import random
+import sqlite3
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import db  # noqa: E402
+import migrations  # noqa: E402
+import story_codec  # noqa: E402
+from users import load_all_stories  # noqa: E402
+
+WORDS = (
+    "le petit renard curieux regardait la mer depuis la colline pendant que le vent soufflait doucement "
+    "sur les herbes hautes une étoile brillait au dessus de la forêt et la lune éclairait le chemin de "
+    "pierres blanches qui menait au village où vivaient ses amis le hérisson la chouette et le lapin "
+    "chaque matin ils partaient ensemble chercher des baies des champignons et des noisettes dans les "
+    "bois profonds mais ce jour là un bruit étrange résonna derrière les rochers alors ils décidèrent "
+    "de suivre la rivière jusqu'à la cascade magique dont parlait toujours grand mère tortue elle "
+    "racontait que les enfants courageux y trouvaient un trésor caché sous les racines du vieux chêne "
+    "soudain un oiseau multicolore apparut et chanta une chanson joyeuse pour les guider vers la grotte "
+    "où dormait un dragon gentil qui avait perdu son chapeau rouge et pleurait de grosses larmes bleues"
+).split()
+
+def synthetic_story(rng, words=2000):
+    """Histoire aléatoire en paragraphes, au vocabulaire réduit comme celui des contes générés."""
+    paragraphs = []
+    remaining = words
+    while remaining > 0:
+        sentences = []
+        for _ in range(rng.randint(3, 6)):
+            sentence = " ".join(rng.choice(WORDS) for _ in range(rng.randint(8, 20)))
+            sentences.append(sentence.capitalize() + ".")
+            remaining -= sentence.count(" ") + 1
+        paragraphs.append(" ".join(sentences))
+    return "Titre : Le renard et la mer\n\n" + "\n\n".join(paragraphs)
+
+def build_text_corpus(path, n_stories, seed=0):
+    """Base au schéma courant, histoires en TEXT comme avant la migration 5 (user_version = 4)."""
+    rng = random.Random(seed)
+    db.remove_database(path)
+    migrations.migrate(path)
+    with db.transaction(path) as conn:
+        conn.executemany(
+            "INSERT INTO stories (story_id, titre, theme, keywords, sexe, age, story, utilisateur) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+            ((None, f"Histoire {i}", "Aventure", "mer, renard", "une fille", 7, synthetic_story(rng),
+              f"user{i % 50}") for i in range(n_stories)),
+        )
+        conn.execute("PRAGMA user_version = 4")
+    with db.connection(path) as conn:
+        conn.execute("VACUUM")
+
+def convert(path, method):
+    """Convertit les histoires TEXT de la base avec la méthode donnée."""
+    if method == "zlib":
+        migrations.migrate(path)  # migration 5, suivie d'un VACUUM
+        return
+    story_codec.ensure_dictionary(path, method=method)
+    with db.transaction(path) as conn:
+        rows = conn.execute("SELECT id, story FROM stories ORDER BY id").fetchall()
+        conn.executemany("UPDATE stories SET story = ? WHERE id = ?",
+                         [(story_codec.encode(story, conn, method=method), story_id) for story_id, story in rows])
+        conn.execute("PRAGMA user_version = 5")
+    with db.connection(path) as conn:
+        conn.execute("VACUUM")
+
+def read_random_stories(path, ids):
+    for story_id in ids:
+        row = db.query_one("SELECT story FROM stories WHERE id = ?", (story_id,), path=path)
+        story_codec.decode(row[0])
+
+def timed(function, repeat):
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+def story_bytes(path):
+    conn = sqlite3.connect(path)
+    try:
+        return conn.execute("SELECT SUM(length(CAST(story AS BLOB))) FROM stories").fetchone()[0]
+    finally:
+        conn.close()
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1000, 5000])
+    parser.add_argument("--methods", nargs="+", default=["none", "zlib", "zstd"], choices=["none", "zlib", "zstd"])
+    parser.add_argument("--reads", type=int, default=200, help="histoires lues au hasard")
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--json", help="fichier de sortie des résultats")
+    args = parser.parse_args()
+
+    output = os.path.abspath(args.json) if args.json else None
+    methods = [method for method in args.methods if method != "zstd" or story_codec.zstandard is not None]
+    if methods != args.methods:
+        print("zstandard n'est pas installé : méthode zstd ignorée.")
+
+    results = []
+    with tempfile.TemporaryDirectory() as workdir:
+        os.chdir(workdir)
+        print(f"{'histoires':>10} {'méthode':>8} {'base (Mo)':>10} {'textes (Mo)':>12} {'conversion (s)':>15} "
+              f"{'lectures (s)':>13} {'load_all_stories (s)':>21}")
+        for size in args.sizes:
+            build_text_corpus(db.LOCAL_DB_PATH, size)
+            template = "template.db"
+            db.close_all()
+            os.replace(db.LOCAL_DB_PATH, template)
+            ids = random.Random(1).choices(range(1, size + 1), k=args.reads)
+            for method in methods:
+                db.remove_database()
+                with open(template, "rb") as source, open(db.LOCAL_DB_PATH, "wb") as target:
+                    target.write(source.read())
+                start = time.perf_counter()
+                if method != "none":
+                    convert(db.LOCAL_DB_PATH, method)
+                conversion = time.perf_counter() - start
+                db.checkpoint()
+                result = {
+                    "stories": size,
+                    "method": method,
+                    "db_bytes": os.path.getsize(db.LOCAL_DB_PATH),
+                    "story_bytes": story_bytes(db.LOCAL_DB_PATH),
+                    "conversion_seconds": conversion,
+                    "random_reads_seconds": timed(lambda: read_random_stories(db.LOCAL_DB_PATH, ids), args.repeat),
+                    "load_all_stories_seconds": timed(load_all_stories, args.repeat),
+                }
+                results.append(result)
+                print(f"{size:>10} {method:>8} {result['db_bytes'] / 2 ** 20:>10.2f} "
+                      f"{result['story_bytes'] / 2 ** 20:>12.2f} {conversion:>15.3f} "
+                      f"{result['random_reads_seconds']:>13.4f} {result['load_all_stories_seconds']:>21.4f}")
+        db.close_all()
+
+    if output:
+        with open(output, "w", encoding="utf-8") as f:
+            json.dump(results, f, indent=2)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,211 @@
+"""Charge simulée de plusieurs sessions Streamlit sur un même processus, hors ligne.
+
+Chaque session est une AppTest de app.py qui suit le parcours réel : ouverture,
+connexion (login_page), "Lancer" puis attente de l'histoire, "histoires enregistrées"
+et ouverture d'une histoire. S3 et les API OpenAI sont remplacés par les
+remplaçants locaux de stand_ins. Pour chaque nombre de sessions, on mesure le débit,
+les latences p50/p95/p99 de chaque interaction et la mémoire (RSS) du processus.
+
+AppTest n'est pas prévue pour tourner dans plusieurs threads à la fois (chaque
+exécution remplace le Runtime et st.secrets globaux) : les exécutions du script sont
+donc faites une à la fois. Les sessions se chevauchent pendant l'attente de leur
+histoire, générée par les tâches de fond et le serveur local.
+
+    python benchmarks/load_sessions.py --sessions 1 5 10 20 --concurrency 8 --json load.json
+"""
+import argparse
+import json
+import os
+import platform
+import resource
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from stand_ins import ROOT, offline_environment, percentiles  # ajoute aussi la racine du dépôt au chemin
+
+def current_rss():
+    """RSS courant du processus, en octets (Linux : /proc/self/status)."""
+    try:
+        with open("/proc/self/status", encoding="ascii") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+class RssSampler:
+    """Relève le RSS du processus à intervalle régulier et garde le maximum."""
+
+    def __init__(self, interval=0.1):
+        self.interval = interval
+        self.peak = current_rss()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self.peak = max(self.peak, current_rss())
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._stop.set()
+        self._thread.join()
+        self.peak = max(self.peak, current_rss())
+
+# Une seule exécution AppTest à la fois dans le processus
+_app_test_lock = threading.Lock()
+
+def find_button(at, label):
+    for button in list(at.sidebar.button) + list(at.button):
+        if button.label == label:
+            return button
+    raise LookupError(f"Bouton '{label}' introuvable")
+
+def run_session(index, args, timings, lock):
+    """Déroule le parcours complet d'une session et renvoie son AppTest (gardée en mémoire)."""
+    from streamlit.testing.v1 import AppTest
+    import db
+    import jobs
+
+    def step(name, action):
+        with _app_test_lock:
+            start = time.perf_counter()
+            result = action()
+            elapsed = time.perf_counter() - start
+        with lock:
+            timings.setdefault(name, []).append(elapsed)
+        return result
+
+    def new_app():
+        at = AppTest.from_file(os.path.join(ROOT, "app.py"), default_timeout=args.timeout)
+        at.secrets["openai"] = {"OPENAI_API_KEY": "sk-fake"}
+        return at
+
+    at = new_app()
+    step("open", at.run)
+
+    username = f"user{index % args.users}"
+    at.text_input[0].input(username)
+    at.text_input[1].input("password")
+    step("login", find_button(at, "Se connecter").click().run)
+    if not at.session_state["authenticated"]:
+        raise RuntimeError(f"Connexion impossible pour {username}")
+
+    # Après le st.rerun() de login_page, AppTest garde les widgets de la page de connexion
+    # dans son arbre et la réexécution suivante échoue sur leur état : la session connectée
+    # continue dans une nouvelle AppTest, comme la page rechargée par le navigateur
+    at = new_app()
+    at.session_state["authenticated"] = True
+    at.session_state["username"] = username
+    step("home", at.run)
+
+    for _ in range(args.stories_per_session):
+        step("lancer", find_button(at, "Lancer").click().run)
+        if "story_jobs" in at.session_state and at.session_state["story_jobs"]:
+            # Génération en tâche de fond : attendre la fin puis afficher le résultat
+            job_key = at.session_state["story_jobs"][-1]
+            start = time.perf_counter()
+            while jobs.get_job(job_key)["status"] not in (jobs.DONE, jobs.FAILED):
+                time.sleep(0.05)
+            with lock:
+                timings.setdefault("story_ready", []).append(time.perf_counter() - start)
+            step("show_story", at.run)
+
+    at.sidebar.radio(key="selected_mode").set_value("histoires enregistrées")
+    step("history", at.run)
+    history = [selectbox for selectbox in at.selectbox if selectbox.key and selectbox.key.startswith("history_story_")]
+    if history:
+        # Les options affichées sont des titres (format_func) : l'histoire est choisie par son id
+        story_id = db.query_one("SELECT MAX(id) FROM stories WHERE utilisateur = ?", (username,))[0]
+        history[0].set_value(story_id)
+        step("open_story", at.run)
+    return at
+
+def run_round(n_sessions, args):
+    timings = {}
+    lock = threading.Lock()
+    errors = []
+    sessions = []
+    rss_before = current_rss()
+    start = time.perf_counter()
+    with RssSampler() as sampler, ThreadPoolExecutor(max_workers=min(args.concurrency, n_sessions)) as executor:
+        futures = [executor.submit(run_session, index, args, timings, lock) for index in range(n_sessions)]
+        for future in futures:
+            try:
+                sessions.append(future.result())
+            except Exception as e:
+                errors.append(repr(e))
+    elapsed = time.perf_counter() - start
+    rss_after = current_rss()  # les sessions terminées sont encore en mémoire
+    interactions = sum(len(values) for values in timings.values())
+    result = {
+        "sessions": n_sessions,
+        "completed": len(sessions),
+        "errors": errors,
+        "elapsed_seconds": elapsed,
+        "sessions_per_second": len(sessions) / elapsed if elapsed else 0.0,
+        "stories_per_second": len(sessions) * args.stories_per_session / elapsed if elapsed else 0.0,
+        "interactions_per_second": interactions / elapsed if elapsed else 0.0,
+        "latency": {name: percentiles(values) for name, values in timings.items()},
+        "rss_before_bytes": rss_before,
+        "rss_after_bytes": rss_after,
+        "rss_peak_bytes": sampler.peak,
+        "rss_per_session_bytes": (rss_after - rss_before) / n_sessions if n_sessions else 0,
+    }
+    del sessions
+    return result
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--sessions", type=int, nargs="+", default=[1, 5, 10], help="sessions simulées par palier")
+    parser.add_argument("--concurrency", type=int, default=8, help="sessions actives en même temps")
+    parser.add_argument("--stories-per-session", type=int, default=1)
+    parser.add_argument("--users", type=int, default=100)
+    parser.add_argument("--stories", type=int, default=1000)
+    parser.add_argument("--images", type=int, default=6, help="images par histoire du corpus")
+    parser.add_argument("--latency", type=float, default=0.5, help="latence des appels de texte (s)")
+    parser.add_argument("--image-latency", type=float, default=2.0, help="latence des éditions d'image (s)")
+    parser.add_argument("--jitter", type=float, default=0.1, help="variation aléatoire des latences (s)")
+    parser.add_argument("--inline", action="store_true", help="générer dans la session (BACKGROUND_JOBS=0)")
+    parser.add_argument("--timeout", type=float, default=600, help="délai maximal d'une réexécution (s)")
+    parser.add_argument("--json", help="fichier de sortie des résultats")
+    args = parser.parse_args()
+
+    output = os.path.abspath(args.json) if args.json else None
+    if args.inline:
+        os.environ["BACKGROUND_JOBS"] = "0"
+    workdir = tempfile.mkdtemp(prefix="load-sessions-")
+    s3, server = offline_environment(workdir, args.users, args.stories, args.images, latency=args.latency,
+                                     image_latency=args.image_latency, jitter=args.jitter)
+
+    rounds = []
+    print(f"{'sessions':>8} {'durée (s)':>10} {'hist./s':>8} {'RSS pic (Mo)':>13} {'RSS/session (Ko)':>17}  interaction p50/p95/p99 (s)")
+    for n_sessions in args.sessions:
+        result = run_round(n_sessions, args)
+        rounds.append(result)
+        latencies = ", ".join(f"{name} {summary['p50']:.3f}/{summary['p95']:.3f}/{summary['p99']:.3f}"
+                              for name, summary in result["latency"].items())
+        print(f"{n_sessions:>8} {result['elapsed_seconds']:>10.2f} {result['stories_per_second']:>8.2f} "
+              f"{result['rss_peak_bytes'] / 2 ** 20:>13.1f} {result['rss_per_session_bytes'] / 1024:>17.1f}  {latencies}")
+        for error in result["errors"]:
+            print(f"  erreur : {error}")
+    server.stop()
+
+    if output:
+        with open(output, "w", encoding="utf-8") as f:
+            json.dump({
+                "config": vars(args),
+                "environment": {"python": platform.python_version(), "platform": platform.platform()},
+                "rounds": rounds,
+                "llm_requests": dict(server.requests),
+                "s3": s3.snapshot_counters(),
+            }, f, indent=2, ensure_ascii=False)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,421 @@
+"""Remplaçants locaux de S3 et des API OpenAI / Grok pour les benchmarks.
+
+    LocalS3        client S3 minimal (interface boto3) stocké dans un répertoire local
+    FakeLLMServer  serveur HTTP compatible Chat Completions et Images, avec latence réglable
+    build_corpus   base stories.db synthétique (N utilisateurs, M histoires, K images)
+
+Aucun accès réseau extérieur ni clé n'est nécessaire.
+"""
+import hashlib
+import io
+import json
+import os
+import random
+import re
+import shutil
+import sqlite3
+import sys
+import threading
+import time
+import uuid
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from types import SimpleNamespace
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import db  # noqa: E402
+import migrations  # noqa: E402
+import story_codec  # noqa: E402
+
+SOURCE_IMAGES = {
+    "images_source/zouzou.png": os.path.join(ROOT, "images_source", "zouzou.png"),
+    "images_source/mask.png": os.path.join(ROOT, "images_source", "mask.png"),
+}
+
+class LocalClientError(Exception):
+    """Erreur au format de botocore.exceptions.ClientError (e.response["Error"]["Code"])."""
+
+    def __init__(self, code, operation):
+        super().__init__(f"An error occurred ({code}) when calling the {operation} operation")
+        self.response = {"Error": {"Code": code, "Message": operation}}
+
+class _Body:
+    def __init__(self, path):
+        self._file = open(path, "rb")
+
+    def read(self, size=-1):
+        data = self._file.read(size)
+        if not data or size < 0:
+            self._file.close()
+        return data
+
+    def iter_chunks(self, chunk_size=1024 * 1024):
+        with self._file:
+            while True:
+                chunk = self._file.read(chunk_size)
+                if not chunk:
+                    return
+                yield chunk
+
+class LocalS3:
+    """Client S3 local : les objets sont des fichiers sous root/<bucket>/<clé>.
+
+    Implémente les opérations utilisées par l'application et compte les appels et les
+    octets transférés (calls, bytes_in, bytes_out).
+    """
+
+    def __init__(self, root):
+        self.root = root
+        self.exceptions = SimpleNamespace(ClientError=LocalClientError)
+        self.calls = Counter()
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self._lock = threading.Lock()
+
+    def _path(self, bucket, key):
+        return os.path.join(self.root, bucket, key)
+
+    def _meta_path(self, bucket, key):
+        return os.path.join(self.root, ".meta", bucket, key + ".json")
+
+    def _count(self, operation, bytes_in=0, bytes_out=0):
+        with self._lock:
+            self.calls[operation] += 1
+            self.bytes_in += bytes_in
+            self.bytes_out += bytes_out
+
+    def _store(self, bucket, key, fileobj, extra=None):
+        path = self._path(bucket, key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        digest = hashlib.md5()
+        size = 0
+        temp_path = f"{path}.{uuid.uuid4().hex}.part"
+        with open(temp_path, "wb") as f:
+            for chunk in iter(lambda: fileobj.read(1024 * 1024), b""):
+                digest.update(chunk)
+                size += len(chunk)
+                f.write(chunk)
+        os.replace(temp_path, path)
+        meta = {"ETag": f'"{digest.hexdigest()}"', "ContentLength": size,
+                "ContentType": (extra or {}).get("ContentType", "binary/octet-stream"),
+                "Metadata": (extra or {}).get("Metadata", {})}
+        meta_path = self._meta_path(bucket, key)
+        os.makedirs(os.path.dirname(meta_path), exist_ok=True)
+        with open(meta_path, "w", encoding="utf-8") as f:
+            json.dump(meta, f)
+        return size
+
+    def _head(self, bucket, key, operation):
+        try:
+            with open(self._meta_path(bucket, key), encoding="utf-8") as f:
+                return json.load(f)
+        except FileNotFoundError:
+            raise LocalClientError("NoSuchKey" if operation == "GetObject" else "404", operation) from None
+
+    def head_bucket(self, Bucket):
+        self._count("head_bucket")
+        os.makedirs(os.path.join(self.root, Bucket), exist_ok=True)
+        return {}
+
+    def head_object(self, Bucket, Key):
+        self._count("head_object")
+        return {**self._head(Bucket, Key, "HeadObject"), "VersionId": None}
+
+    def get_object(self, Bucket, Key, IfNoneMatch=None):
+        meta = self._head(Bucket, Key, "GetObject")
+        if IfNoneMatch and IfNoneMatch == meta["ETag"]:
+            self._count("get_object_304")
+            raise LocalClientError("304", "GetObject")
+        self._count("get_object", bytes_out=meta["ContentLength"])
+        return {**meta, "VersionId": None, "Body": _Body(self._path(Bucket, Key))}
+
+    def put_object(self, Bucket, Key, Body, ContentType=None, Metadata=None):
+        body = Body.encode("utf-8") if isinstance(Body, str) else Body
+        size = self._store(Bucket, Key, io.BytesIO(body), {"ContentType": ContentType or "binary/octet-stream",
+                                                           "Metadata": Metadata or {}})
+        self._count("put_object", bytes_in=size)
+        return {}
+
+    def upload_file(self, Filename, Bucket, Key, ExtraArgs=None, Config=None):
+        with open(Filename, "rb") as f:
+            size = self._store(Bucket, Key, f, ExtraArgs)
+        self._count("upload_file", bytes_in=size)
+
+    def upload_fileobj(self, Fileobj, Bucket, Key, ExtraArgs=None, Config=None):
+        size = self._store(Bucket, Key, Fileobj, ExtraArgs)
+        self._count("upload_fileobj", bytes_in=size)
+
+    def download_file(self, Bucket, Key, Filename):
+        meta = self._head(Bucket, Key, "GetObject")
+        shutil.copyfile(self._path(Bucket, Key), Filename)
+        self._count("download_file", bytes_out=meta["ContentLength"])
+
+    def get_paginator(self, operation):
+        client = self
+
+        class Paginator:
+            def paginate(self, Bucket, Prefix=""):
+                client._count("list_objects_v2")
+                base = os.path.join(client.root, Bucket)
+                keys = []
+                for directory, _, files in os.walk(base):
+                    for name in files:
+                        key = os.path.relpath(os.path.join(directory, name), base).replace(os.sep, "/")
+                        if key.startswith(Prefix) and not key.endswith(".part"):
+                            keys.append(key)
+                yield {"Contents": [{"Key": key} for key in sorted(keys)]}
+
+        return Paginator()
+
+    def delete_objects(self, Bucket, Delete):
+        self._count("delete_objects")
+        for obj in Delete["Objects"]:
+            for path in (self._path(Bucket, obj["Key"]), self._meta_path(Bucket, obj["Key"])):
+                if os.path.exists(path):
+                    os.remove(path)
+        return {}
+
+    def snapshot_counters(self):
+        with self._lock:
+            return {"calls": dict(self.calls), "bytes_in": self.bytes_in, "bytes_out": self.bytes_out}
+
+def seed_source_images(s3, bucket):
+    """Dépose l'image de base et le masque du dépôt dans le S3 local."""
+    for key, path in SOURCE_IMAGES.items():
+        s3.upload_file(path, bucket, key, ExtraArgs={"ContentType": "image/png"})
+
+FAKE_STORY = "\n\n".join(
+    ["Titre : Le petit renard et la mer"]
+    + [f"Paragraphe {index}. Il était une fois un petit renard curieux qui voulait voir la mer. " * 20
+       for index in range(1, 7)]
+)
+
+class FakeLLMServer:
+    """Serveur HTTP local imitant les API Chat Completions (OpenAI, Grok) et Images d'OpenAI.
+
+    Chaque requête attend latency ± jitter secondes (image_latency pour les images) ; en
+    streaming, les fragments sont espacés de chunk_delay secondes. Les images générées
+    sont servies par le même serveur.
+    """
+
+    def __init__(self, latency=0.5, jitter=0.1, image_latency=2.0, chunk_delay=0.005, story=FAKE_STORY, seed=0):
+        self.latency = latency
+        self.jitter = jitter
+        self.image_latency = image_latency
+        self.chunk_delay = chunk_delay
+        self.story = story
+        self.requests = Counter()
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self._server = None
+        with open(SOURCE_IMAGES["images_source/zouzou.png"], "rb") as f:
+            self.image_bytes = f.read()
+
+    @property
+    def url(self):
+        host, port = self._server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def delay(self, base):
+        with self._lock:
+            return max(0.0, base + self._random.uniform(-self.jitter, self.jitter))
+
+    def count(self, endpoint):
+        with self._lock:
+            self.requests[endpoint] += 1
+
+    def reply(self, messages):
+        """Texte renvoyé selon le prompt : histoire, tableau JSON de résumés ou résumé simple."""
+        prompt = messages[-1]["content"] if messages else ""
+        batch = re.search(r"tableau JSON de (\d+)", prompt)
+        if batch:
+            count = int(batch.group(1))
+            return json.dumps([f"Un petit renard au bord de la mer, scène {index}" for index in range(1, count + 1)],
+                              ensure_ascii=False)
+        if "histoire" in messages[0]["content"]:
+            return self.story
+        return "Un petit renard curieux regarde la mer au coucher du soleil"
+
+    def start(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, format, *args):
+                pass
+
+            def _json(self, payload, status=200):
+                body = json.dumps(payload, ensure_ascii=False).encode("utf-8")
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def do_POST(self):
+                body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+                if self.path.endswith("/chat/completions"):
+                    self._chat(json.loads(body))
+                elif self.path.endswith("/images/edits"):
+                    server.count("images/edits")
+                    time.sleep(server.delay(server.image_latency))
+                    self._json({"created": int(time.time()),
+                                "data": [{"url": f"{server.url}/files/{uuid.uuid4().hex}.png"}]})
+                else:
+                    self._json({"error": {"message": "not found"}}, status=404)
+
+            def do_GET(self):
+                if not self.path.startswith("/files/"):
+                    self._json({"error": {"message": "not found"}}, status=404)
+                    return
+                server.count("files")
+                self.send_response(200)
+                self.send_header("Content-Type", "image/png")
+                self.send_header("Content-Length", str(len(server.image_bytes)))
+                self.end_headers()
+                self.wfile.write(server.image_bytes)
+
+            def _chat(self, request):
+                server.count("chat/completions")
+                model = request.get("model", "fake")
+                text = server.reply(request.get("messages", []))
+                time.sleep(server.delay(server.latency))
+                if not request.get("stream"):
+                    tokens = len(text) // 4
+                    self._json({
+                        "id": f"chatcmpl-{uuid.uuid4().hex}", "object": "chat.completion",
+                        "created": int(time.time()), "model": model,
+                        "choices": [{"index": 0, "message": {"role": "assistant", "content": text},
+                                     "finish_reason": "stop"}],
+                        "usage": {"prompt_tokens": 0, "completion_tokens": tokens, "total_tokens": tokens},
+                    })
+                    return
+                self.send_response(200)
+                self.send_header("Content-Type", "text/event-stream")
+                self.send_header("Connection", "close")
+                self.end_headers()
+                self.close_connection = True
+                for start in range(0, len(text), 40):
+                    chunk = {"id": "chatcmpl-fake", "object": "chat.completion.chunk", "created": int(time.time()),
+                             "model": model,
+                             "choices": [{"index": 0, "delta": {"content": text[start:start + 40]},
+                                          "finish_reason": None}]}
+                    self.wfile.write(f"data: {json.dumps(chunk, ensure_ascii=False)}\n\n".encode("utf-8"))
+                    self.wfile.flush()
+                    time.sleep(server.chunk_delay)
+                self.wfile.write(b"data: [DONE]\n\n")
+
+        self._server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self._server.daemon_threads = True
+        threading.Thread(target=self._server.serve_forever, name="fake-llm", daemon=True).start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+def build_corpus(path, n_users, n_stories, images_per_story, n_personnages=5, seed=0):
+    """Crée une base stories.db synthétique au schéma courant.
+
+    Les utilisateurs user0..user{N-1} ont pour mot de passe "password" et pour email
+    user{i}@example.com (empreintes SHA-256, comme users.create_account).
+    """
+    rng = random.Random(seed)
+    db.remove_database(path)
+    migrations.migrate(path)
+
+    def digest(value):
+        return hashlib.sha256(value.encode()).hexdigest()
+
+    password = digest("password")
+    story = FAKE_STORY
+    with db.transaction(path) as conn:
+        conn.executemany(
+            "INSERT INTO stories_user (utilisateur, password, email, sexe, age, reset_code) VALUES (?, ?, ?, ?, ?, NULL)",
+            ((f"user{i}", password, digest(f"user{i}@example.com"), rng.choice(("une fille", "un garçon")),
+              rng.randint(3, 10)) for i in range(n_users)),
+        )
+        conn.executemany(
+            "INSERT INTO personnages (personnage, description) VALUES (?, ?)",
+            ((f"Personnage {i}", f"Un personnage de test numéro {i}, curieux et gentil.")
+             for i in range(n_personnages)),
+        )
+        conn.executemany(
+            "INSERT INTO stories (story_id, titre, theme, keywords, sexe, age, story, utilisateur) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+            ((uuid.UUID(int=rng.getrandbits(128)).hex, f"Histoire {i}", "Aventure", "mer, renard", "une fille", 7,
+              story_codec.encode(story, conn), f"user{i % max(1, n_users)}") for i in range(n_stories)),
+        )
+        conn.executemany(
+            "INSERT INTO images (story_id, image_name, paragraph_index) VALUES (?, ?, ?)",
+            ((story_id, f"https://jujul.s3.amazonaws.com/images/story_{story_id}_paragraph_{p}.png", p - 1)
+             for story_id in range(1, n_stories + 1) for p in range(1, images_per_story + 1)),
+        )
+    db.close_all()
+
+def write_streamlit_secrets(directory, openai_key="sk-fake"):
+    """Écrit le .streamlit/secrets.toml minimal attendu par app.py."""
+    os.makedirs(os.path.join(directory, ".streamlit"), exist_ok=True)
+    with open(os.path.join(directory, ".streamlit", "secrets.toml"), "w", encoding="utf-8") as f:
+        f.write(f'[openai]\nOPENAI_API_KEY = "{openai_key}"\n\n'
+                '[gmail]\nsender_email = "bench@example.com"\nsender_password = "x"\n')
+
+def offline_environment(workdir, n_users, n_stories, images_per_story, latency=0.5, image_latency=2.0, jitter=0.1,
+                        summary_cache=False):
+    """Prépare un répertoire de travail où l'application tourne sans AWS ni OpenAI.
+
+    Publie le corpus synthétique comme snapshot dans le S3 local, fait pointer bootstrap
+    et openai vers les remplaçants locaux et renvoie (s3, server). La base locale n'est
+    pas encore téléchargée : c'est le rôle du démarrage de l'application.
+    """
+    os.chdir(workdir)
+    write_streamlit_secrets(workdir)
+    # Configuration lue à l'import des modules de l'application
+    os.environ.setdefault("LLM_PROVIDER", "openai")
+    os.environ.setdefault("DB_FLUSH_WINDOW", "3600")  # réplication déclenchée explicitement par les mesures
+    if not summary_cache:
+        os.environ["SUMMARY_CACHE"] = "0"
+
+    import bootstrap
+    import openai
+    import replication
+
+    s3 = LocalS3(os.path.join(workdir, "s3"))
+    bootstrap.get_s3_client = lambda: s3
+    s3.head_bucket(Bucket=bootstrap.S3_BUCKET_NAME)
+    seed_source_images(s3, bootstrap.S3_BUCKET_NAME)
+
+    # Corpus publié comme snapshot S3, comme le ferait db_init.py
+    corpus_path = os.path.join(workdir, "corpus.db")
+    build_corpus(corpus_path, n_users, n_stories, images_per_story)
+    replication.install_change_log(corpus_path)
+    replication.upload_snapshot(s3, bootstrap.S3_BUCKET_NAME, corpus_path, bootstrap.S3_DB_KEY)
+    db.remove_database(corpus_path)
+    os.remove(corpus_path + ".meta.json")
+
+    server = FakeLLMServer(latency=latency, jitter=jitter, image_latency=image_latency).start()
+    openai.api_base = f"{server.url}/v1"
+    return s3, server
+
+def percentiles(values):
+    """Résumé d'une série de durées : nombre, moyenne, p50, p95, p99, min, max."""
+    if not values:
+        return {"count": 0}
+    ordered = sorted(values)
+
+    def rank(q):
+        return ordered[min(len(ordered) - 1, int(round(q * (len(ordered) - 1))))]
+
+    return {"count": len(ordered), "mean": sum(ordered) / len(ordered), "p50": rank(0.50), "p95": rank(0.95),
+            "p99": rank(0.99), "min": ordered[0], "max": ordered[-1]}
+
+def sqlite_counts(path):
+    """Nombre de lignes des tables stories et images (lecture directe, hors pool)."""
+    conn = sqlite3.connect(path)
+    try:
+        return {table: conn.execute(f"SELECT COUNT(*) FROM {table}").fetchone()[0] for table in ("stories", "images")}
+    finally:
+        conn.close()
@@ -0,0 +1,161 @@
+import os
+import sqlite3
+import tempfile
+import time
+import boto3
+import streamlit as st
+import db
+import instrumentation
+import migrations
+import replication
+
+log = instrumentation.get_logger("bootstrap")
+
+# Initialisation partagée par toutes les sessions Streamlit du processus.
+# Streamlit réexécute app.py à chaque interaction : le client S3 et la base locale
+# sont donc préparés une seule fois via st.cache_resource.
+
+# Configuration de boto3 pour S3
+AWS_ACCESS_KEY_ID = os.getenv("AWS_ACCESS_KEY_ID")
+AWS_SECRET_ACCESS_KEY = os.getenv("AWS_SECRET_ACCESS_KEY")
+AWS_REGION = os.getenv("AWS_DEFAULT_REGION")
+S3_BUCKET_NAME = "jujul"
+# Point d'accès S3 compatible (MinIO, stand-in local des benchmarks) ; vide pour AWS
+S3_ENDPOINT_URL = os.getenv("S3_ENDPOINT_URL") or None
+
+# Chemin local temporaire pour stories.db
+LOCAL_DB_PATH = db.LOCAL_DB_PATH
+S3_DB_KEY = "database/stories.db"  # Chemin sur S3 : s3://jujul/database/stories.db
+
+# Vérification de la base au démarrage : "quick" (quick_check), "full" (integrity_check) ou "none"
+DB_DOWNLOAD_CHECK = os.getenv("DB_DOWNLOAD_CHECK", "quick")
+DB_WARM_START_CHECK = os.getenv("DB_WARM_START_CHECK", "none")
+
+@st.cache_resource
+def get_s3_client():
+    """Crée le client S3 du processus et vérifie l'accès au bucket une seule fois."""
+    s3 = boto3.client(
+        "s3",
+        region_name=AWS_REGION,
+        aws_access_key_id=AWS_ACCESS_KEY_ID,
+        aws_secret_access_key=AWS_SECRET_ACCESS_KEY,
+        endpoint_url=S3_ENDPOINT_URL,
+    )
+    s3.head_bucket(Bucket=S3_BUCKET_NAME)
+    return s3
+
+def check_db_integrity(path, mode):
+    """Vérifie la base locale avec PRAGMA quick_check ou integrity_check ("none" pour ignorer)."""
+    if mode == "none":
+        return
+    pragma = "integrity_check" if mode == "full" else "quick_check"
+    conn = sqlite3.connect(path)
+    try:
+        result = conn.execute(f"PRAGMA {pragma};").fetchone()
+    finally:
+        conn.close()
+    log.debug(f"Résultat de PRAGMA {pragma} : {result[0]}")
+    if result[0] != "ok":
+        raise sqlite3.DatabaseError("Base de données corrompue")
+
+def download_db_from_s3():
+    """Télécharge stories.db depuis S3 s'il a changé, sinon réutilise la copie locale.
+
+    La copie locale garde l'ETag du snapshot dont elle provient ; le téléchargement est
+    conditionnel (If-None-Match) et n'a lieu que si le snapshot S3 a changé.
+    """
+    s3 = get_s3_client()
+    max_retries = 3
+    retry_delay = 1  # secondes
+    metadata = replication.read_snapshot_metadata(LOCAL_DB_PATH)
+    etag = metadata.get("etag") if os.path.exists(LOCAL_DB_PATH) else None
+
+    for attempt in range(max_retries):
+        temp_path = None
+        try:
+            log.info(f"Tentative {attempt + 1}/{max_retries} de téléchargement depuis S3...")
+            request = {"Bucket": S3_BUCKET_NAME, "Key": S3_DB_KEY}
+            if etag:
+                request["IfNoneMatch"] = etag
+            with instrumentation.span("s3.download_db"):
+                response = s3.get_object(**request)
+
+                # Écrire dans un fichier temporaire puis remplacer la copie locale d'un seul coup
+                fd, temp_path = tempfile.mkstemp(suffix=".db", dir=os.path.dirname(os.path.abspath(LOCAL_DB_PATH)))
+                with os.fdopen(fd, "wb") as temp_file:
+                    for chunk in response["Body"].iter_chunks(chunk_size=1024 * 1024):
+                        temp_file.write(chunk)
+            file_size = os.path.getsize(temp_path)
+            log.info(f"Taille du fichier téléchargé : {file_size} octets")
+            if file_size == 0:
+                raise FileNotFoundError("Fichier téléchargé est vide")
+            check_db_integrity(temp_path, DB_DOWNLOAD_CHECK)
+
+            db.replace_database(temp_path, LOCAL_DB_PATH)
+            replication.write_snapshot_metadata(LOCAL_DB_PATH, response.get("ETag"), response.get("VersionId"))
+            log.info(f"Base de données téléchargée et vérifiée depuis S3 : s3://{S3_BUCKET_NAME}/{S3_DB_KEY}")
+            return True
+
+        except s3.exceptions.ClientError as e:
+            code = e.response['Error']['Code']
+            if code == "304":
+                log.info("Snapshot S3 inchangé, réutilisation de la base locale.")
+                check_db_integrity(LOCAL_DB_PATH, DB_WARM_START_CHECK)
+                return True
+            if code in ("404", "NoSuchKey"):
+                log.warning("Base de données non trouvée sur S3, création d'une nouvelle base locale.")
+                db.query_one("PRAGMA user_version")  # crée la base vide, en mode WAL
+                return False
+            log.error(f"Erreur S3 lors du téléchargement : {e}")
+            raise e
+        except PermissionError as e:
+            if attempt < max_retries - 1:
+                log.warning(f"Erreur de permission lors du téléchargement de stories.db : {e}. Réessai dans {retry_delay} secondes...")
+                time.sleep(retry_delay)
+            else:
+                log.error(f"Échec après {max_retries} tentatives : {e}")
+                raise e
+        except (sqlite3.Error, FileNotFoundError) as e:
+            log.warning(f"Erreur lors de la validation de la base de données : {e}")
+            # Ne plus se fier à la copie locale : forcer un téléchargement complet
+            etag = None
+            if attempt < max_retries - 1:
+                log.info(f"Réessai dans {retry_delay} secondes...")
+                time.sleep(retry_delay)
+            else:
+                log.error("Échec après toutes les tentatives, création d'une nouvelle base locale.")
+                db.remove_database(LOCAL_DB_PATH)
+                replication.write_snapshot_metadata(LOCAL_DB_PATH, None, None)
+                db.query_one("PRAGMA user_version")  # crée la base vide, en mode WAL
+                return False
+        finally:
+            if temp_path and os.path.exists(temp_path):
+                os.remove(temp_path)
+
+@st.cache_resource
+def prepare_database():
+    """Télécharge, initialise et resynchronise stories.db une seule fois par processus."""
+    download_db_from_s3()
+    migrations.migrate(LOCAL_DB_PATH)
+
+    # Rejouer les modifications publiées dans le journal S3 depuis le dernier snapshot
+    replication.install_change_log(LOCAL_DB_PATH)
+    replication.replay_log(get_s3_client(), S3_BUCKET_NAME, LOCAL_DB_PATH)
+    return LOCAL_DB_PATH
+
+@st.cache_resource
+def get_replication_flusher():
+    """Démarre une seule fois par processus le thread de réplication de stories.db."""
+    return replication.ReplicationFlusher(get_s3_client(), S3_BUCKET_NAME, LOCAL_DB_PATH, S3_DB_KEY)
+
+def ensure_ready():
+    """Renvoie le client S3 une fois la base prête, ou arrête la page si S3 est inaccessible."""
+    try:
+        s3 = get_s3_client()
+    except Exception as e:
+        st.error(f"Erreur de configuration S3 : {e}. Vérifiez vos credentials et le bucket.")
+        st.stop()
+    prepare_database()
+    get_replication_flusher()
+    instrumentation.start_metrics_server()
+    return s3
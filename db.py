@@ -0,0 +1,224 @@
+import os
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+import instrumentation
+from instrumentation import metrics, span
+
+# Accès partagé à la base SQLite.
+#
+# Les connexions ouvertes sont gardées dans un petit pool du processus : chaque requête
+# en emprunte une et la rend à la fin, quel que soit le thread (Streamlit exécute chaque
+# réexécution d'une session dans un nouveau thread). Les sessions ne paient plus
+# l'ouverture d'une connexion à chaque requête et les requêtes préparées restent en cache
+# (cached_statements). La base est en mode WAL : les lectures ne bloquent plus les
+# écritures des autres sessions.
+
+# Chemin local de stories.db
+LOCAL_DB_PATH = "stories.db"
+
+# Attente maximale d'un verrou d'écriture avant "database is locked"
+BUSY_TIMEOUT = float(os.getenv("DB_BUSY_TIMEOUT", "10"))
+# Nombre de requêtes préparées gardées en cache par connexion
+STATEMENT_CACHE_SIZE = int(os.getenv("DB_STATEMENT_CACHE_SIZE", "256"))
+# Nombre de connexions inactives gardées ouvertes par base (les autres sont fermées à leur retour)
+POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "8"))
+
+PRAGMAS = (
+    "PRAGMA journal_mode=WAL",
+    "PRAGMA synchronous=NORMAL",
+    "PRAGMA temp_store=MEMORY",
+    "PRAGMA cache_size=-16000",
+    "PRAGMA mmap_size=134217728",
+)
+
+class _Borrowed:
+    """Connexion empruntée par le thread courant, et profondeur de ses transactions."""
+
+    def __init__(self, conn):
+        self.conn = conn
+        self.depth = 0
+
+_lock = threading.Lock()
+_idle = {}  # chemin -> connexions disponibles
+_open_connections = set()  # toutes les connexions ouvertes par le pool, empruntées ou non
+_counters = {"opened": 0, "checkouts": 0}
+# Connexions empruntées par le thread courant, par chemin : les blocs imbriqués les réutilisent
+_local = threading.local()
+
+def _open(path):
+    conn = sqlite3.connect(
+        path,
+        timeout=BUSY_TIMEOUT,
+        isolation_level=None,  # transactions explicites via transaction()
+        check_same_thread=False,  # connexions partagées par les threads via le pool
+        cached_statements=STATEMENT_CACHE_SIZE,
+    )
+    for pragma in PRAGMAS:
+        conn.execute(pragma)
+    return conn
+
+def _checkout(path):
+    with _lock:
+        _counters["checkouts"] += 1
+        idle = _idle.get(path)
+        if idle:
+            return idle.pop()
+    conn = _open(path)
+    with _lock:
+        _counters["opened"] += 1
+        _open_connections.add(conn)
+    return conn
+
+def _checkin(path, conn):
+    with _lock:
+        # Une connexion fermée par close_all() pendant l'emprunt ne revient pas dans le pool
+        pooled = conn in _open_connections
+    if pooled and conn.in_transaction:
+        try:
+            conn.execute("ROLLBACK")
+        except sqlite3.Error:
+            pass
+    with _lock:
+        if conn in _open_connections and len(_idle.setdefault(path, [])) < POOL_SIZE:
+            _idle[path].append(conn)
+            return
+        _open_connections.discard(conn)
+    conn.close()
+
+def _borrowed():
+    borrowed = getattr(_local, "borrowed", None)
+    if borrowed is None:
+        borrowed = _local.borrowed = {}
+    return borrowed
+
+@contextmanager
+def connection(path=LOCAL_DB_PATH):
+    """Emprunte une connexion du pool vers la base pour la durée du bloc.
+
+    Un bloc imbriqué dans le même thread (requête dans une transaction) réutilise la
+    connexion déjà empruntée et voit donc ses écritures non encore validées.
+    """
+    borrowed = _borrowed()
+    if path in borrowed:
+        yield borrowed[path].conn
+        return
+    conn = _checkout(path)
+    borrowed[path] = _Borrowed(conn)
+    try:
+        yield conn
+    finally:
+        del borrowed[path]
+        _checkin(path, conn)
+
+def pool_stats():
+    with _lock:
+        idle = sum(len(connections) for connections in _idle.values())
+        return {"open": len(_open_connections), "idle": idle, "in_use": len(_open_connections) - idle,
+                **_counters}
+
+instrumentation.register_collector("db_pool", pool_stats)
+
+def close_all():
+    """Ferme toutes les connexions du pool (avant de remplacer le fichier de la base)."""
+    with _lock:
+        connections = list(_open_connections)
+        _open_connections.clear()
+        _idle.clear()
+    for conn in connections:
+        try:
+            conn.close()
+        except sqlite3.Error:
+            pass
+
+def remove_database(path=LOCAL_DB_PATH):
+    """Ferme le pool et supprime la base ainsi que ses fichiers WAL."""
+    close_all()
+    for suffix in ("", "-wal", "-shm"):
+        if os.path.exists(path + suffix):
+            os.remove(path + suffix)
+
+def replace_database(source, path=LOCAL_DB_PATH):
+    """Remplace le fichier de la base par source, après avoir fermé le pool et écarté l'ancien WAL."""
+    close_all()
+    for suffix in ("-wal", "-shm"):
+        if os.path.exists(path + suffix):
+            os.remove(path + suffix)
+    os.replace(source, path)
+
+@contextmanager
+def transaction(path=LOCAL_DB_PATH):
+    """Ouvre une transaction d'écriture validée à la sortie du bloc, annulée en cas d'erreur.
+
+    Les transactions imbriquées utilisent des SAVEPOINT.
+    """
+    with connection(path) as conn:
+        borrowed = _borrowed()[path]
+        depth = borrowed.depth
+        start = time.perf_counter()
+        if depth == 0:
+            conn.execute("BEGIN IMMEDIATE")
+        else:
+            conn.execute(f"SAVEPOINT sp_{depth}")
+        borrowed.depth = depth + 1
+        try:
+            yield conn
+        except BaseException:
+            if depth == 0:
+                conn.execute("ROLLBACK")
+            else:
+                conn.execute(f"ROLLBACK TO sp_{depth}")
+                conn.execute(f"RELEASE sp_{depth}")
+            raise
+        else:
+            if depth == 0:
+                conn.execute("COMMIT")
+            else:
+                conn.execute(f"RELEASE sp_{depth}")
+        finally:
+            borrowed.depth = depth
+            if depth == 0:
+                # Durée de la transaction, attente du verrou d'écriture comprise
+                metrics.observe("stage_duration_seconds", time.perf_counter() - start, stage="db.transaction")
+
+def query(sql, params=(), path=LOCAL_DB_PATH):
+    """Exécute une requête de lecture et renvoie toutes les lignes."""
+    with span("db.query"), connection(path) as conn:
+        return conn.execute(sql, params).fetchall()
+
+def query_one(sql, params=(), path=LOCAL_DB_PATH):
+    """Exécute une requête de lecture et renvoie la première ligne (ou None)."""
+    with span("db.query"), connection(path) as conn:
+        return conn.execute(sql, params).fetchone()
+
+def iter_query(sql, params=(), path=LOCAL_DB_PATH, batch_size=500):
+    """Exécute une requête de lecture et renvoie ses lignes au fil de l'eau, par lots.
+
+    La connexion est empruntée jusqu'à la fin de l'itération (ou la fermeture du générateur),
+    sans être prêtée aux autres blocs du thread : le générateur peut être abandonné pendant
+    qu'une transaction est en cours sans l'interrompre.
+    """
+    borrowed = _borrowed().get(path)
+    conn = borrowed.conn if borrowed is not None else _checkout(path)
+    try:
+        with span("db.query"):
+            cursor = conn.execute(sql, params)
+        while True:
+            rows = cursor.fetchmany(batch_size)
+            if not rows:
+                return
+            yield from rows
+    finally:
+        if borrowed is None:
+            _checkin(path, conn)
+
+def execute(sql, params=(), path=LOCAL_DB_PATH):
+    """Exécute une écriture isolée dans sa propre transaction et renvoie le curseur."""
+    with transaction(path) as conn:
+        return conn.execute(sql, params)
+
+def checkpoint(path=LOCAL_DB_PATH):
+    """Reporte le contenu du WAL dans le fichier principal (avant de le copier tel quel)."""
+    with connection(path) as conn:
+        conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
@@ -0,0 +1,70 @@
+import os
+import threading
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+# Client HTTP partagé par le processus (OpenAI, téléchargement des images, Grok).
+#
+# Une seule requests.Session garde les connexions ouvertes (keep-alive) : les appels
+# successifs vers un même hôte ne repaient pas la poignée de main TCP + TLS. Le nombre
+# de connexions par hôte est borné et chaque requête a un délai maximal.
+
+# Nombre d'hôtes dont les connexions sont gardées, et connexions gardées par hôte
+HTTP_POOL_HOSTS = int(os.getenv("HTTP_POOL_HOSTS", "10"))
+HTTP_POOL_MAXSIZE = int(os.getenv("HTTP_POOL_MAXSIZE", "16"))
+# Délais (s) d'établissement de la connexion et de lecture de la réponse
+HTTP_CONNECT_TIMEOUT = float(os.getenv("HTTP_CONNECT_TIMEOUT", "5"))
+HTTP_READ_TIMEOUT = float(os.getenv("HTTP_READ_TIMEOUT", "120"))
+DEFAULT_TIMEOUT = (HTTP_CONNECT_TIMEOUT, HTTP_READ_TIMEOUT)
+
+_session = None
+_lock = threading.Lock()
+
+def _build_session():
+    session = requests.Session()
+    adapter = HTTPAdapter(
+        pool_connections=HTTP_POOL_HOSTS,
+        pool_maxsize=HTTP_POOL_MAXSIZE,
+        pool_block=True,  # au-delà de la limite par hôte, attendre une connexion libre
+        # Seuls les échecs de connexion sont réessayés : une requête envoyée n'est jamais rejouée
+        max_retries=Retry(total=2, connect=2, read=0, status=0, other=0, backoff_factor=0.3),
+    )
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
+def get_session():
+    """Renvoie la session HTTP partagée du processus, créée au premier appel."""
+    global _session
+    if _session is None:
+        with _lock:
+            if _session is None:
+                _session = _build_session()
+    return _session
+
+class _OpenAISession(requests.Session):
+    """Session remise à la bibliothèque openai : mêmes connexions que la session partagée.
+
+    openai (0.27) ferme sa session toutes les 180 s : close() est sans effet, pour ne pas
+    couper les connexions de tout le processus. Le délai par défaut d'openai (600 s),
+    envoyé quand l'appel ne fournit pas request_timeout (Image.create_edit ne l'accepte
+    pas), est remplacé par DEFAULT_TIMEOUT.
+    """
+
+    def __init__(self, shared, library_timeout):
+        super().__init__()
+        self.adapters = shared.adapters
+        self.library_timeout = library_timeout
+
+    def request(self, method, url, **kwargs):
+        if kwargs.get("timeout") in (None, self.library_timeout):
+            kwargs["timeout"] = DEFAULT_TIMEOUT
+        return super().request(method, url, **kwargs)
+
+    def close(self):
+        pass
+
+def configure_openai(openai_module):
+    """Fait passer les appels de la bibliothèque openai par la session partagée."""
+    openai_module.requestssession = _OpenAISession(get_session(), openai_module.api_requestor.TIMEOUT_SECS)
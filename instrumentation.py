@@ -0,0 +1,216 @@
+import json
+import logging
+import os
+import sys
+import threading
+import time
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Journaux et métriques du processus.
+#
+# Les journaux passent par le module logging, filtrés par LOG_LEVEL. Les étapes du
+# pipeline (appel LLM, résumé, édition d'image, téléchargement d'image, upload S3,
+# requête SQLite...) sont chronométrées par span() dans un histogramme par étape ; les
+# nouvelles tentatives et les échecs sont comptés par increment(). Les métriques sont
+# exposées au format texte Prometheus et en JSON sur METRICS_PORT (0 : pas de serveur).
+
+# DEBUG affiche aussi la durée de chaque étape
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
+# Port du serveur de métriques (/metrics et /metrics.json), 0 pour le désactiver
+METRICS_PORT = int(os.getenv("METRICS_PORT", "0"))
+METRICS_PREFIX = "stories"
+
+# Bornes (s) des histogrammes de durée, des requêtes SQLite aux générations d'histoire
+DURATION_BUCKETS = (0.001, 0.005, 0.025, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+
+class FieldsFormatter(logging.Formatter):
+    """Ajoute au message les champs structurés passés par extra={"fields": {...}}."""
+
+    def format(self, record):
+        message = super().format(record)
+        fields = getattr(record, "fields", None)
+        if fields:
+            message += " " + " ".join(f"{key}={value}" for key, value in fields.items())
+        return message
+
+_logger = logging.getLogger(METRICS_PREFIX)
+if not _logger.handlers:
+    _handler = logging.StreamHandler(sys.stdout)
+    _handler.setFormatter(FieldsFormatter("%(asctime)s %(levelname)s %(name)s : %(message)s"))
+    _logger.addHandler(_handler)
+    _logger.setLevel(LOG_LEVEL)
+    _logger.propagate = False
+
+def get_logger(name):
+    """Renvoie le journal d'un module (sous-journal de "stories", filtré par LOG_LEVEL)."""
+    return _logger.getChild(name)
+
+log = get_logger("instrumentation")
+
+def _labels_key(labels):
+    return tuple(sorted((key, str(value)) for key, value in labels.items()))
+
+class Histogram:
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.count += 1
+        self.sum += value
+        for index, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[index] += 1
+
+class Metrics:
+    """Compteurs et histogrammes du processus, indexés par nom et étiquettes."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counters = {}
+        self._histograms = {}
+        self._collectors = []
+
+    def increment(self, name, amount=1, **labels):
+        key = (name, _labels_key(labels))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + amount
+
+    def observe(self, name, value, **labels):
+        key = (name, _labels_key(labels))
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = Histogram(DURATION_BUCKETS)
+            histogram.observe(value)
+
+    def register_collector(self, name, collect):
+        """Ajoute des jauges lues à chaque export : collect() renvoie {nom: valeur}."""
+        with self._lock:
+            self._collectors.append((name, collect))
+
+    def _gauges(self):
+        gauges = {}
+        for name, collect in list(self._collectors):
+            try:
+                values = collect()
+            except Exception as e:
+                log.warning(f"Lecture des métriques '{name}' impossible : {e}")
+                continue
+            for key, value in values.items():
+                gauges[f"{name}_{key}"] = value
+        return gauges
+
+    def snapshot(self):
+        """Renvoie toutes les métriques sous forme de dictionnaire (export JSON)."""
+        with self._lock:
+            counters = [{"name": name, "labels": dict(labels), "value": value}
+                        for (name, labels), value in self._counters.items()]
+            histograms = [{"name": name, "labels": dict(labels), "count": histogram.count,
+                           "sum": histogram.sum, "buckets": dict(zip(histogram.buckets, histogram.counts))}
+                          for (name, labels), histogram in self._histograms.items()]
+        return {"counters": counters, "histograms": histograms, "gauges": self._gauges()}
+
+    def render_prometheus(self):
+        """Renvoie toutes les métriques au format d'exposition texte de Prometheus."""
+        lines = []
+        snapshot = self.snapshot()
+        for kind, items in (("counter", snapshot["counters"]), ("histogram", snapshot["histograms"])):
+            declared = set()
+            for item in sorted(items, key=lambda item: item["name"]):
+                name = f"{METRICS_PREFIX}_{item['name']}"
+                if name not in declared:
+                    lines.append(f"# TYPE {name} {kind}")
+                    declared.add(name)
+                if kind == "counter":
+                    lines.append(f"{name}{_format_labels(item['labels'])} {item['value']}")
+                    continue
+                for bound, count in item["buckets"].items():
+                    lines.append(f"{name}_bucket{_format_labels(item['labels'], le=bound)} {count}")
+                lines.append(f"{name}_bucket{_format_labels(item['labels'], le='+Inf')} {item['count']}")
+                lines.append(f"{name}_sum{_format_labels(item['labels'])} {item['sum']}")
+                lines.append(f"{name}_count{_format_labels(item['labels'])} {item['count']}")
+        for name, value in sorted(snapshot["gauges"].items()):
+            lines.append(f"# TYPE {METRICS_PREFIX}_{name} gauge")
+            lines.append(f"{METRICS_PREFIX}_{name} {value}")
+        return "\n".join(lines) + "\n"
+
+def _format_labels(labels, **extra):
+    labels = {**labels, **{key: str(value) for key, value in extra.items()}}
+    if not labels:
+        return ""
+    escaped = (value.replace("\\", "\\\\").replace('"', '\\"') for value in labels.values())
+    return "{" + ",".join(f'{key}="{value}"' for key, value in zip(labels, escaped)) + "}"
+
+metrics = Metrics()
+
+def increment(name, amount=1, **labels):
+    """Incrémente le compteur name (ex. increment("retries_total", operation="openai"))."""
+    metrics.increment(name, amount, **labels)
+
+def register_collector(name, collect):
+    metrics.register_collector(name, collect)
+
+class Span:
+    def __init__(self, stage):
+        self.stage = stage
+        self.start = time.perf_counter()
+        self.duration = None
+
+@contextmanager
+def span(stage, **fields):
+    """Chronomètre le bloc dans l'histogramme stage_duration_seconds{stage=...}.
+
+    Une exception compte un échec de l'étape (stage_errors_total) avant d'être relancée.
+    """
+    current = Span(stage)
+    try:
+        yield current
+    except BaseException as e:
+        increment("stage_errors_total", stage=stage, error=type(e).__name__)
+        raise
+    finally:
+        current.duration = time.perf_counter() - current.start
+        metrics.observe("stage_duration_seconds", current.duration, stage=stage)
+        if _logger.isEnabledFor(logging.DEBUG):
+            log.debug("étape terminée", extra={"fields": {"stage": stage, "seconds": f"{current.duration:.4f}",
+                                                           **fields}})
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path == "/metrics":
+            body, content_type = metrics.render_prometheus().encode(), "text/plain; version=0.0.4"
+        elif self.path == "/metrics.json":
+            body, content_type = json.dumps(metrics.snapshot()).encode(), "application/json"
+        else:
+            self.send_error(404)
+            return
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+_server = None
+_server_lock = threading.Lock()
+
+def start_metrics_server(port=METRICS_PORT):
+    """Démarre (une seule fois par processus) le serveur de métriques sur le port donné."""
+    global _server
+    with _server_lock:
+        if _server is not None or not port:
+            return _server
+        try:
+            _server = ThreadingHTTPServer(("0.0.0.0", port), _MetricsHandler)
+        except OSError as e:
+            log.warning(f"Serveur de métriques indisponible sur le port {port} : {e}")
+            return None
+        threading.Thread(target=_server.serve_forever, name="metrics-server", daemon=True).start()
+        log.info(f"Métriques exposées sur http://0.0.0.0:{port}/metrics")
+        return _server
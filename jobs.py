@@ -0,0 +1,248 @@
+import json
+import os
+import threading
+import time
+import uuid
+import db
+import instrumentation
+
+log = instrumentation.get_logger("jobs")
+
+# File de tâches de génération d'histoires, exécutées en arrière-plan.
+#
+# Les tâches sont stockées dans jobs.db, à côté de stories.db (état local au serveur,
+# non répliqué sur S3). Des threads de travail, démarrés une seule fois par processus,
+# les prennent dans l'ordre d'arrivée et les font avancer étape par étape. L'avancement
+# est enregistré après chaque étape : une tâche interrompue (erreur, redémarrage)
+# reprend à l'étape où elle s'était arrêtée au lieu de tout recommencer.
+
+JOBS_DB_PATH = os.path.join(os.path.dirname(db.LOCAL_DB_PATH), "jobs.db")
+# Nombre de threads de travail et attente (s) entre deux recherches de tâche
+JOB_WORKERS = int(os.getenv("JOB_WORKERS", "2"))
+JOB_POLL_SECONDS = float(os.getenv("JOB_POLL_SECONDS", "2"))
+# Tentatives automatiques avant de marquer une tâche en échec
+JOB_MAX_ATTEMPTS = int(os.getenv("JOB_MAX_ATTEMPTS", "3"))
+# Une tâche "running" sans nouvelle depuis ce délai (s) est considérée abandonnée et reprise
+JOB_STALE_SECONDS = float(os.getenv("JOB_STALE_SECONDS", "600"))
+# Intervalle (s) auquel une tâche en cours signale qu'elle avance encore, bien en deçà de JOB_STALE_SECONDS
+JOB_HEARTBEAT_SECONDS = float(os.getenv("JOB_HEARTBEAT_SECONDS", "60"))
+
+QUEUED, RUNNING, DONE, FAILED = "queued", "running", "done", "failed"
+
+_ready_paths = set()
+
+def _ensure_schema(path):
+    if path in _ready_paths:
+        return
+    with db.transaction(path) as conn:
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS jobs (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                job_key TEXT UNIQUE NOT NULL,
+                utilisateur TEXT NOT NULL,
+                status TEXT NOT NULL,
+                stage TEXT NOT NULL,
+                params TEXT NOT NULL,
+                state TEXT NOT NULL DEFAULT '{}',
+                attempts INTEGER NOT NULL DEFAULT 0,
+                error TEXT,
+                created_at REAL NOT NULL,
+                updated_at REAL NOT NULL
+            )
+        """)
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_jobs_status_id ON jobs (status, id)")
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_jobs_utilisateur_id ON jobs (utilisateur, id DESC)")
+    _ready_paths.add(path)
+
+_COLUMNS = "job_key, utilisateur, status, stage, params, state, attempts, error, created_at, updated_at"
+
+def _row_to_job(row):
+    return {
+        "key": row[0],
+        "utilisateur": row[1],
+        "status": row[2],
+        "stage": row[3],
+        "params": json.loads(row[4]),
+        "state": json.loads(row[5]),
+        "attempts": row[6],
+        "error": row[7],
+        "created_at": row[8],
+        "updated_at": row[9],
+    }
+
+def enqueue(username, params, stage, job_key=None, path=JOBS_DB_PATH):
+    """Ajoute une tâche en file d'attente et renvoie sa clé."""
+    _ensure_schema(path)
+    job_key = job_key or uuid.uuid4().hex
+    now = time.time()
+    db.execute(f"""
+        INSERT INTO jobs ({_COLUMNS}) VALUES (?, ?, ?, ?, ?, '{{}}', 0, NULL, ?, ?)
+    """, (job_key, username, QUEUED, stage, json.dumps(params, ensure_ascii=False), now, now), path=path)
+    return job_key
+
+def get_job(job_key, path=JOBS_DB_PATH):
+    """Renvoie une tâche par sa clé, ou None."""
+    _ensure_schema(path)
+    row = db.query_one(f"SELECT {_COLUMNS} FROM jobs WHERE job_key = ?", (job_key,), path=path)
+    return _row_to_job(row) if row else None
+
+def list_jobs(username, limit=10, path=JOBS_DB_PATH):
+    """Renvoie les tâches les plus récentes d'un utilisateur."""
+    _ensure_schema(path)
+    rows = db.query(f"SELECT {_COLUMNS} FROM jobs WHERE utilisateur = ? ORDER BY id DESC LIMIT ?",
+                    (username, limit), path=path)
+    return [_row_to_job(row) for row in rows]
+
+def claim_next(path=JOBS_DB_PATH):
+    """Prend la plus ancienne tâche en attente (ou abandonnée) et la passe en cours d'exécution."""
+    _ensure_schema(path)
+    now = time.time()
+    with db.transaction(path) as conn:
+        row = conn.execute(f"""
+            SELECT {_COLUMNS} FROM jobs
+            WHERE status = ? OR (status = ? AND updated_at < ?)
+            ORDER BY id LIMIT 1
+        """, (QUEUED, RUNNING, now - JOB_STALE_SECONDS)).fetchone()
+        if row is None:
+            return None
+        conn.execute("UPDATE jobs SET status = ?, attempts = attempts + 1, updated_at = ? WHERE job_key = ?",
+                     (RUNNING, now, row[0]))
+    job = _row_to_job(row)
+    job["status"] = RUNNING
+    job["attempts"] += 1
+    job["updated_at"] = now
+    return job
+
+def heartbeat(job, path=JOBS_DB_PATH):
+    """Signale qu'une tâche est toujours en cours, pour qu'elle ne soit pas reprise par un autre thread.
+
+    Seule la base est mise à jour : job["updated_at"] reste le début de l'étape, dont
+    advance() mesure la durée.
+    """
+    db.execute("UPDATE jobs SET updated_at = ? WHERE job_key = ? AND status = ?",
+               (time.time(), job["key"], RUNNING), path=path)
+
+def requeue_running(path=JOBS_DB_PATH):
+    """Remet en file les tâches restées en cours d'exécution ; renvoie leur nombre.
+
+    Appelé au démarrage des threads de travail : jobs.db est propre au processus, une
+    tâche encore "running" a donc été interrompue par l'arrêt du processus précédent.
+    """
+    _ensure_schema(path)
+    with db.transaction(path) as conn:
+        return conn.execute("UPDATE jobs SET status = ?, updated_at = ? WHERE status = ?",
+                            (QUEUED, time.time(), RUNNING)).rowcount
+
+def advance(job, stage, path=JOBS_DB_PATH, **state):
+    """Enregistre la fin d'une étape : l'étape suivante et l'état accumulé de la tâche.
+
+    La durée de l'étape terminée (depuis la prise de la tâche ou l'étape précédente) est
+    ajoutée à state["durations"], cumulée sur les tentatives.
+    """
+    now = time.time()
+    elapsed = now - job["updated_at"]
+    instrumentation.metrics.observe("stage_duration_seconds", elapsed, stage=f"job.{job['stage']}")
+    durations = job["state"].setdefault("durations", {})
+    durations[job["stage"]] = durations.get(job["stage"], 0.0) + elapsed
+    job["stage"] = stage
+    job["state"].update(state)
+    job["updated_at"] = now
+    db.execute("UPDATE jobs SET stage = ?, state = ?, updated_at = ? WHERE job_key = ?",
+               (stage, json.dumps(job["state"], ensure_ascii=False), now, job["key"]), path=path)
+
+def save_state(job, path=JOBS_DB_PATH, **state):
+    """Enregistre l'état d'une étape en cours (résultats partiels), sans passer à l'étape suivante."""
+    job["state"].update(state)
+    db.execute("UPDATE jobs SET state = ? WHERE job_key = ?",
+               (json.dumps(job["state"], ensure_ascii=False), job["key"]), path=path)
+
+def finish(job, path=JOBS_DB_PATH):
+    """Marque une tâche comme terminée."""
+    job["status"] = DONE
+    db.execute("UPDATE jobs SET status = ?, error = NULL, updated_at = ? WHERE job_key = ?",
+               (DONE, time.time(), job["key"]), path=path)
+
+def fail(job, error, path=JOBS_DB_PATH):
+    """Remet la tâche en file après une erreur, ou la marque en échec après JOB_MAX_ATTEMPTS tentatives."""
+    job["status"] = QUEUED if job["attempts"] < JOB_MAX_ATTEMPTS else FAILED
+    if job["status"] == QUEUED:
+        instrumentation.increment("retries_total", operation="job", stage=job["stage"])
+    else:
+        instrumentation.increment("failures_total", operation="job", stage=job["stage"])
+    db.execute("UPDATE jobs SET status = ?, error = ?, updated_at = ? WHERE job_key = ?",
+               (job["status"], str(error), time.time(), job["key"]), path=path)
+
+def count_by_status(path=JOBS_DB_PATH):
+    """Renvoie le nombre de tâches par statut."""
+    _ensure_schema(path)
+    counts = dict.fromkeys((QUEUED, RUNNING, DONE, FAILED), 0)
+    counts.update(db.query("SELECT status, COUNT(*) FROM jobs GROUP BY status", path=path))
+    return counts
+
+def retry(job_key, path=JOBS_DB_PATH):
+    """Relance une tâche en échec depuis l'étape où elle s'était arrêtée."""
+    _ensure_schema(path)
+    db.execute("UPDATE jobs SET status = ?, attempts = 0, updated_at = ? WHERE job_key = ? AND status = ?",
+               (QUEUED, time.time(), job_key, FAILED), path=path)
+
+class JobWorkers:
+    """Threads de travail qui exécutent les tâches de la file avec handler(job)."""
+
+    def __init__(self, handler, workers=JOB_WORKERS, path=JOBS_DB_PATH):
+        self.handler = handler
+        self.path = path
+        self._wake = threading.Event()
+        self._threads = [
+            threading.Thread(target=self._run, name=f"job-worker-{index}", daemon=True)
+            for index in range(max(1, workers))
+        ]
+        _ensure_schema(path)
+        requeued = requeue_running(path)
+        if requeued:
+            log.info(f"{requeued} tâche(s) interrompue(s) par un redémarrage remise(s) en file.")
+        instrumentation.register_collector("jobs", lambda: count_by_status(path))
+        for thread in self._threads:
+            thread.start()
+
+    def notify(self):
+        """Réveille les threads après l'ajout d'une tâche."""
+        self._wake.set()
+
+    def _beat(self, job, stop):
+        # Tant que handler(job) s'exécute, y compris pendant une étape plus longue que JOB_STALE_SECONDS
+        while not stop.wait(JOB_HEARTBEAT_SECONDS):
+            try:
+                heartbeat(job, self.path)
+            except Exception as e:
+                log.warning(f"Erreur lors du signal de vie de la tâche {job['key']} : {e}")
+
+    def _run(self):
+        while True:
+            try:
+                job = claim_next(self.path)
+            except Exception as e:
+                log.error(f"Erreur lors de la lecture de la file des tâches : {e}")
+                job = None
+            if job is None:
+                self._wake.wait(JOB_POLL_SECONDS)
+                self._wake.clear()
+                continue
+            log.info(f"Tâche {job['key']} : étape '{job['stage']}', tentative {job['attempts']}.")
+            if job["attempts"] == 1:
+                instrumentation.metrics.observe("job_queue_wait_seconds", time.time() - job["created_at"])
+            stop = threading.Event()
+            beat = threading.Thread(target=self._beat, args=(job, stop), daemon=True,
+                                    name=f"{threading.current_thread().name}-heartbeat")
+            beat.start()
+            try:
+                self.handler(job)
+                finish(job, self.path)
+                durations = job["state"].get("durations", {})
+                log.info(f"Tâche {job['key']} terminée.",
+                         extra={"fields": {stage: f"{seconds:.1f}s" for stage, seconds in durations.items()}})
+            except Exception as e:
+                log.error(f"Erreur lors de la tâche {job['key']} (étape '{job['stage']}') : {e}")
+                fail(job, e, self.path)
+            finally:
+                stop.set()
+                beat.join()
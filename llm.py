@@ -0,0 +1,297 @@
+import asyncio
+import json
+import os
+import queue
+import threading
+import time
+import http_client
+import instrumentation
+import scheduler
+
+log = instrumentation.get_logger("llm")
+
+# Fournisseurs de génération de texte (OpenAI, Grok, et un faux fournisseur local).
+#
+# Chaque fournisseur expose la même interface, synchrone (stream, complete) et asyncio
+# (astream, acomplete). HedgedProvider couvre les ralentissements d'un fournisseur :
+# si le premier n'a produit aucun fragment après LLM_HEDGE_AFTER secondes, le second
+# est lancé et le premier des deux à répondre est retenu.
+
+# Fournisseur principal de l'histoire, et fournisseur de secours (vide : pas de couverture)
+LLM_PROVIDER = os.getenv("LLM_PROVIDER", "openai")
+LLM_HEDGE_PROVIDER = os.getenv("LLM_HEDGE_PROVIDER", "")
+LLM_HEDGE_AFTER = float(os.getenv("LLM_HEDGE_AFTER", "8"))
+
+GROK_API_URL = os.getenv("GROK_API_URL", "https://api.x.ai/v1/chat/completions")
+
+class Provider:
+    """Interface commune : stream() renvoie les fragments de texte au fil de l'eau."""
+
+    name = "provider"
+
+    def stream(self, messages, max_tokens, temperature=0.7):
+        raise NotImplementedError
+
+    def complete(self, messages, max_tokens, temperature=0.7):
+        return "".join(self.stream(messages, max_tokens, temperature))
+
+    async def astream(self, messages, max_tokens, temperature=0.7):
+        # Par défaut, le flux synchrone est lu dans un thread pour ne pas bloquer la boucle asyncio
+        iterator = iter(self.stream(messages, max_tokens, temperature))
+        end = object()
+        while True:
+            chunk = await asyncio.to_thread(next, iterator, end)
+            if chunk is end:
+                return
+            yield chunk
+
+    async def acomplete(self, messages, max_tokens, temperature=0.7):
+        return "".join([chunk async for chunk in self.astream(messages, max_tokens, temperature)])
+
+class OpenAIProvider(Provider):
+    """Chat Completions d'OpenAI, appelées via l'ordonnanceur du processus."""
+
+    name = "openai"
+
+    def __init__(self, model="gpt-4"):
+        self.model = model
+
+    def stream(self, messages, max_tokens, temperature=0.7):
+        # Le créneau de l'ordonnanceur est rendu à la fin du flux, ou si la lecture est abandonnée
+        with scheduler.chat_completion(model=self.model, messages=messages, max_tokens=max_tokens,
+                                       temperature=temperature, stream=True) as response:
+            for chunk in response:
+                content = chunk["choices"][0]["delta"].get("content")
+                if content:
+                    yield content
+
+    def complete(self, messages, max_tokens, temperature=0.7):
+        response = scheduler.chat_completion(model=self.model, messages=messages, max_tokens=max_tokens,
+                                             temperature=temperature)
+        return response.choices[0].message["content"]
+
+class GrokProvider(Provider):
+    """API de Grok (compatible Chat Completions), appelée via la session HTTP partagée."""
+
+    name = "grok"
+
+    def __init__(self, model="grok-beta", api_key=None, url=GROK_API_URL):
+        self.model = model
+        self.api_key = api_key or os.getenv("GROK_API_KEY")
+        self.url = url
+
+    def _post(self, messages, max_tokens, temperature, stream):
+        response = http_client.get_session().post(
+            self.url,
+            headers={
+                "Authorization": f"Bearer {self.api_key}",
+                "Content-Type": "application/json"
+            },
+            json={
+                "model": self.model,
+                "messages": messages,
+                "max_tokens": max_tokens,
+                "temperature": temperature,
+                "stream": stream
+            },
+            stream=stream,
+            timeout=http_client.DEFAULT_TIMEOUT,
+        )
+        if response.status_code != 200:
+            response.close()
+            raise Exception(f"Erreur lors de l'appel à l'API Grok: {response.status_code}")
+        return response
+
+    def stream(self, messages, max_tokens, temperature=0.7):
+        with self._post(messages, max_tokens, temperature, stream=True) as response:
+            for line in response.iter_lines(decode_unicode=True):
+                if not line or not line.startswith("data:"):
+                    continue
+                data = line[len("data:"):].strip()
+                if data == "[DONE]":
+                    return
+                content = json.loads(data)["choices"][0].get("delta", {}).get("content")
+                if content:
+                    yield content
+
+    def complete(self, messages, max_tokens, temperature=0.7):
+        data = self._post(messages, max_tokens, temperature, stream=False).json()
+        return data["choices"][0]["message"]["content"]
+
+FAKE_STORY = "\n\n".join(
+    ["Titre : Le petit renard et la mer"]
+    + [f"Paragraphe {index}. Il était une fois un petit renard curieux qui voulait voir la mer. " * 8
+       for index in range(1, 7)]
+)
+
+class FakeProvider(Provider):
+    """Fournisseur local sans réseau, pour les tests et les mesures : renvoie un texte fixe
+    découpé en fragments, après un délai de premier fragment et un délai par fragment."""
+
+    name = "fake"
+
+    def __init__(self, text=FAKE_STORY, first_token_delay=0.0, chunk_delay=0.0, chunk_size=40, error=None):
+        self.text = text
+        self.first_token_delay = first_token_delay
+        self.chunk_delay = chunk_delay
+        self.chunk_size = chunk_size
+        self.error = error
+
+    def _chunks(self):
+        return [self.text[start:start + self.chunk_size] for start in range(0, len(self.text), self.chunk_size)]
+
+    def stream(self, messages, max_tokens, temperature=0.7):
+        time.sleep(self.first_token_delay)
+        if self.error:
+            raise self.error
+        for index, chunk in enumerate(self._chunks()):
+            if index:
+                time.sleep(self.chunk_delay)
+            yield chunk
+
+    async def astream(self, messages, max_tokens, temperature=0.7):
+        await asyncio.sleep(self.first_token_delay)
+        if self.error:
+            raise self.error
+        for index, chunk in enumerate(self._chunks()):
+            if index:
+                await asyncio.sleep(self.chunk_delay)
+            yield chunk
+
+def _pump(index, provider, args, events, cancelled):
+    """Lit le flux d'un fournisseur dans un thread et transmet ses fragments à events."""
+    try:
+        for chunk in provider.stream(*args):
+            if cancelled.is_set():
+                return
+            events.put((index, "chunk", chunk))
+        events.put((index, "done", None))
+    except Exception as e:
+        events.put((index, "error", e))
+
+class HedgedProvider(Provider):
+    """Lance le fournisseur de secours si le principal n'a rien produit après hedge_after
+    secondes (ou a échoué), et garde le premier des deux qui produit un fragment."""
+
+    def __init__(self, primary, secondary, hedge_after=LLM_HEDGE_AFTER):
+        self.primary = primary
+        self.secondary = secondary
+        self.hedge_after = hedge_after
+        self.name = f"{primary.name}+{secondary.name}"
+
+    def stream(self, messages, max_tokens, temperature=0.7):
+        args = (messages, max_tokens, temperature)
+        providers = (self.primary, self.secondary)
+        events = queue.Queue()
+        cancelled = [threading.Event(), threading.Event()]
+        started = []
+        errors = {}
+
+        def start(index):
+            started.append(index)
+            threading.Thread(target=_pump, args=(index, providers[index], args, events, cancelled[index]),
+                             daemon=True).start()
+
+        start(0)
+        deadline = time.monotonic() + self.hedge_after
+        winner, first = None, None
+        while winner is None:
+            timeout = max(0.0, deadline - time.monotonic()) if len(started) == 1 else None
+            try:
+                index, kind, value = events.get(timeout=timeout)
+            except queue.Empty:
+                log.warning(f"Pas de réponse de {self.primary.name} après {self.hedge_after} s, "
+                            f"appel de {self.secondary.name}.")
+                instrumentation.increment("hedges_total", provider=self.primary.name, reason="timeout")
+                start(1)
+                continue
+            if kind == "error":
+                errors[index] = value
+                if len(started) == 1:
+                    instrumentation.increment("hedges_total", provider=self.primary.name, reason="error")
+                    start(1)
+                elif len(errors) == 2:
+                    raise errors[0]
+                continue
+            winner, first = index, value
+
+        for index in started:
+            if index != winner:
+                cancelled[index].set()
+        if first is None:
+            return
+        yield first
+        while True:
+            index, kind, value = events.get()
+            if index != winner:
+                continue
+            if kind == "chunk":
+                yield value
+            elif kind == "error":
+                raise value
+            else:
+                return
+
+    async def astream(self, messages, max_tokens, temperature=0.7):
+        args = (messages, max_tokens, temperature)
+        streams = [self.primary.astream(*args)]
+        pending = {asyncio.ensure_future(streams[0].__anext__()): 0}
+        winner, first, errors = None, None, []
+        done, _ = await asyncio.wait(pending, timeout=self.hedge_after)
+        while True:
+            for task in done:
+                index = pending.pop(task)
+                error = task.exception()
+                if isinstance(error, StopAsyncIteration):
+                    winner = index if winner is None else winner
+                elif error is not None:
+                    errors.append(error)
+                elif winner is None:
+                    winner, first = index, task.result()
+            if winner is not None:
+                break
+            if len(streams) == 1:
+                if not done:
+                    log.warning(f"Pas de réponse de {self.primary.name} après {self.hedge_after} s, "
+                                f"appel de {self.secondary.name}.")
+                instrumentation.increment("hedges_total", provider=self.primary.name,
+                                          reason="error" if done else "timeout")
+                streams.append(self.secondary.astream(*args))
+                pending[asyncio.ensure_future(streams[1].__anext__())] = 1
+            elif not pending:
+                raise errors[0]
+            done, _ = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+
+        for task in pending:
+            task.cancel()
+        await asyncio.gather(*pending, return_exceptions=True)
+        for index, stream in enumerate(streams):
+            if index != winner:
+                await stream.aclose()
+        if first is None:
+            return
+        yield first
+        async for chunk in streams[winner]:
+            yield chunk
+
+def get_provider(name):
+    """Renvoie le fournisseur nommé ("openai", "grok" ou "fake")."""
+    if name == "openai":
+        return OpenAIProvider()
+    if name == "grok":
+        return GrokProvider()
+    if name == "fake":
+        return FakeProvider()
+    raise ValueError(f"Fournisseur inconnu : {name}")
+
+_story_provider = None
+
+def story_provider():
+    """Renvoie le fournisseur de l'histoire configuré (couvert par LLM_HEDGE_PROVIDER s'il est défini)."""
+    global _story_provider
+    if _story_provider is None:
+        provider = get_provider(LLM_PROVIDER)
+        if LLM_HEDGE_PROVIDER:
+            provider = HedgedProvider(provider, get_provider(LLM_HEDGE_PROVIDER))
+        _story_provider = provider
+    return _story_provider
@@ -0,0 +1,239 @@
+import db
+import instrumentation
+import story_codec
+
+log = instrumentation.get_logger("migrations")
+
+# Migrations du schéma de stories.db.
+#
+# La version du schéma est stockée dans PRAGMA user_version. migrate() applique dans
+# l'ordre, une seule fois et chacune dans sa transaction, les migrations dont le numéro
+# est supérieur à cette version. Les bases créées par les versions précédentes de
+# l'application, aux schémas divergents (db_init.py créait stories_user et personnages
+# sans colonne id, avec d'autres contraintes NOT NULL), sont reconstruites par la
+# migration 7 et convergent ainsi vers le même schéma.
+
+def _columns(conn, table):
+    return [row[1] for row in conn.execute(f'PRAGMA table_info("{table}")')]
+
+def _create_base_tables(conn):
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS stories_user (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            utilisateur TEXT UNIQUE,
+            password TEXT,
+            email TEXT,
+            sexe TEXT,
+            age INTEGER,
+            reset_code TEXT
+        )
+    """)
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS personnages (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            personnage TEXT UNIQUE,
+            description TEXT
+        )
+    """)
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS stories (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            story_id TEXT,
+            titre TEXT NOT NULL,
+            theme TEXT,
+            keywords TEXT,
+            sexe TEXT,
+            age INTEGER,
+            story TEXT NOT NULL,
+            utilisateur TEXT NOT NULL,
+            FOREIGN KEY (utilisateur) REFERENCES stories_user (utilisateur)
+        )
+    """)
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS images (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            story_id INTEGER NOT NULL,
+            image_name TEXT NOT NULL,
+            FOREIGN KEY (story_id) REFERENCES stories (id)
+        )
+    """)
+
+def _add_story_key_column(conn):
+    # Certaines bases existantes ont été créées sans la colonne stories.story_id
+    if "story_id" not in _columns(conn, "stories"):
+        conn.execute("ALTER TABLE stories ADD COLUMN story_id TEXT")
+
+def _create_lookup_indexes(conn):
+    # Historique : filtre par utilisateur, tri par id décroissant, titre lu dans l'index
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_stories_utilisateur_id ON stories (utilisateur, id DESC, titre)")
+    # Images d'une histoire, dans leur ordre d'insertion
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_images_story_id ON images (story_id, id, image_name)")
+    # Recherche d'un compte par empreinte de l'email (création de compte, mot de passe oublié)
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_stories_user_email ON stories_user (email)")
+    conn.execute("ANALYZE")
+
+def _create_story_key_index(conn):
+    # Reprise d'une tâche de génération : retrouver l'histoire déjà enregistrée sous sa clé
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_stories_story_id ON stories (story_id)")
+
+def _compress_stories(conn):
+    # Les triggers de réplication d'une version précédente ne savent pas journaliser un
+    # BLOB : ils sont supprimés ici et recréés par replication.install_change_log() au
+    # démarrage. La conversion n'est pas journalisée, chaque instance migre sa copie.
+    for op in ("insert", "update", "delete"):
+        conn.execute(f'DROP TRIGGER IF EXISTS "_changelog_stories_{op}"')
+    story_codec.create_schema(conn)
+    if story_codec.STORY_COMPRESSION == "none":
+        return
+    # zlib pour les lignes existantes : un dictionnaire zstd n'est créé qu'à la première écriture
+    last_id = 0
+    while True:
+        rows = conn.execute("""
+            SELECT id, story FROM stories WHERE id > ? AND typeof(story) = 'text' ORDER BY id LIMIT 500
+        """, (last_id,)).fetchall()
+        if not rows:
+            break
+        conn.executemany("UPDATE stories SET story = ? WHERE id = ?",
+                         [(story_codec.encode(story, conn, method="zlib"), story_id) for story_id, story in rows])
+        last_id = rows[-1][0]
+    # Le snapshot S3 contient encore le texte non compressé : sans nouveau snapshot, chaque
+    # démarrage à froid le téléchargerait et referait la conversion.
+    _request_snapshot(conn)
+
+def _request_snapshot(conn):
+    # Un snapshot_seq vide fait publier un snapshot au prochain envoi, déclenché dès le démarrage
+    if conn.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = '_replication_state'").fetchone():
+        conn.execute("UPDATE _replication_state SET snapshot_seq = NULL WHERE id = 1")
+
+def _add_image_paragraph_index(conn):
+    # Position du paragraphe illustré : une illustration en échec n'a pas de ligne, les
+    # images suivantes ne peuvent donc pas être associées aux paragraphes par leur rang.
+    # Les lignes existantes gardent NULL et restent affichées dans leur ordre d'insertion.
+    if "paragraph_index" not in _columns(conn, "images"):
+        conn.execute("ALTER TABLE images ADD COLUMN paragraph_index INTEGER")
+    conn.execute("DROP INDEX IF EXISTS idx_images_story_id")
+    conn.execute("CREATE INDEX idx_images_story_id ON images (story_id, id, image_name, paragraph_index)")
+
+# Schéma des tables de base après la migration 6
+_CANONICAL_TABLES = {
+    "stories_user": """
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        utilisateur TEXT UNIQUE,
+        password TEXT,
+        email TEXT,
+        sexe TEXT,
+        age INTEGER,
+        reset_code TEXT
+    """,
+    "personnages": """
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        personnage TEXT UNIQUE,
+        description TEXT
+    """,
+    "stories": """
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        story_id TEXT,
+        titre TEXT NOT NULL,
+        theme TEXT,
+        keywords TEXT,
+        sexe TEXT,
+        age INTEGER,
+        story TEXT NOT NULL,
+        utilisateur TEXT NOT NULL,
+        FOREIGN KEY (utilisateur) REFERENCES stories_user (utilisateur)
+    """,
+    "images": """
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        story_id INTEGER NOT NULL,
+        image_name TEXT NOT NULL,
+        paragraph_index INTEGER,
+        FOREIGN KEY (story_id) REFERENCES stories (id)
+    """,
+}
+
+def _column_definitions(conn, table):
+    # (nom, type, NOT NULL, clé primaire), sans tenir compte de l'ordre des colonnes
+    return {(row[1], row[2].upper(), row[3], row[5]) for row in conn.execute(f'PRAGMA table_info("{table}")')}
+
+def _rebuild_divergent_tables(conn):
+    # CREATE TABLE IF NOT EXISTS (migration 1) laisse telles quelles les tables créées par
+    # db_init.py : stories_user et personnages indexées par leur nom, sans colonne id, et
+    # des NOT NULL différents. Chaque table qui diffère du schéma canonique est recréée
+    # puis ses lignes recopiées. Le rowid est conservé (il devient l'id des tables qui n'en
+    # avaient pas) : les row_id du journal de réplication désignent toujours les mêmes lignes.
+    # Les triggers de réplication disparaissent avec l'ancienne table et sont recréés par
+    # replication.install_change_log() au démarrage.
+    rebuilt = []
+    for table, columns in _CANONICAL_TABLES.items():
+        new_table = f"_rebuild_{table}"
+        conn.execute(f'DROP TABLE IF EXISTS "{new_table}"')
+        conn.execute(f'CREATE TABLE "{new_table}" ({columns})')
+        canonical = _column_definitions(conn, new_table)
+        existing = _column_definitions(conn, table)
+        if existing == canonical:
+            conn.execute(f'DROP TABLE "{new_table}"')
+            continue
+
+        existing_columns = {name: notnull for name, _, notnull, _ in existing}
+        names, values = [], []
+        for name, column_type, notnull, _ in sorted(canonical):
+            if name in existing_columns:
+                value = f'"{name}"'
+                if notnull and not existing_columns[name]:
+                    default = "0" if column_type == "INTEGER" else "''"
+                    value = f"COALESCE({value}, {default})"
+            elif name == "id":
+                value = "rowid"
+            else:
+                continue
+            names.append(f'"{name}"')
+            values.append(value)
+        indexes = [row[0] for row in conn.execute(
+            "SELECT sql FROM sqlite_master WHERE type = 'index' AND tbl_name = ? AND sql IS NOT NULL", (table,))]
+        conn.execute(f'INSERT INTO "{new_table}" ({", ".join(names)}) SELECT {", ".join(values)} FROM "{table}"')
+        conn.execute(f'DROP TABLE "{table}"')
+        conn.execute(f'ALTER TABLE "{new_table}" RENAME TO "{table}"')
+        for sql in indexes:
+            conn.execute(sql)
+        rebuilt.append(table)
+
+    if rebuilt:
+        log.info(f"Tables reconstruites selon le schéma commun : {', '.join(rebuilt)}.")
+        conn.execute("ANALYZE")
+        # Le snapshot S3 a encore l'ancien schéma, que les autres instances téléchargeraient
+        _request_snapshot(conn)
+
+MIGRATIONS = (
+    (1, "tables de base", _create_base_tables),
+    (2, "colonne stories.story_id", _add_story_key_column),
+    (3, "index des recherches fréquentes", _create_lookup_indexes),
+    (4, "index de la clé des histoires", _create_story_key_index),
+    (5, "compression du texte des histoires", _compress_stories),
+    (6, "position des images dans l'histoire", _add_image_paragraph_index),
+    (7, "reconstruction des tables au schéma divergent", _rebuild_divergent_tables),
+)
+
+def schema_version(path=db.LOCAL_DB_PATH):
+    """Renvoie la version du schéma de la base."""
+    return db.query_one("PRAGMA user_version", path=path)[0]
+
+# Migrations qui libèrent beaucoup de place : la base est compactée (VACUUM) après elles
+VACUUM_AFTER = {5}
+
+def migrate(path=db.LOCAL_DB_PATH):
+    """Applique les migrations manquantes et renvoie la version finale du schéma."""
+    version = schema_version(path)
+    vacuum = False
+    for number, description, apply in MIGRATIONS:
+        if number <= version:
+            continue
+        with db.transaction(path) as conn:
+            apply(conn)
+            conn.execute(f"PRAGMA user_version = {number}")
+        log.info(f"Migration {number} appliquée : {description}.")
+        version = number
+        vacuum = vacuum or number in VACUUM_AFTER
+    if vacuum:
+        with db.connection(path) as conn:
+            conn.execute("VACUUM")
+    return version
@@ -0,0 +1,79 @@
+import os
+import threading
+from collections import OrderedDict
+import streamlit as st
+import instrumentation
+
+# Cache de lecture partagé par toutes les sessions du processus.
+#
+# Les profils utilisateurs, les recherches par email, les personnages, l'historique et le texte des histoires
+# ouverts par une session servent aussi aux autres : ils sont gardés une seule fois par
+# processus au lieu d'être copiés dans chaque st.session_state. Les sessions ne gardent
+# que des identifiants (nom d'utilisateur, id d'histoire).
+#
+# Chaque espace (USERS, PERSONNAGES...) a un numéro de version incrémenté par bump()
+# après une écriture : les entrées lues avant l'écriture ne sont plus servies et sont
+# rechargées à la demande. Les valeurs renvoyées sont partagées et ne doivent pas être
+# modifiées par l'appelant.
+
+USERS = "users"
+EMAILS = "emails"  # empreinte d'email -> nom d'utilisateur (None si aucun compte)
+PERSONNAGES = "personnages"
+STORIES = "stories"  # historique par utilisateur : nombre d'histoires et pages de titres
+STORY = "story"  # texte et images d'une histoire, qui ne change plus une fois enregistrée
+
+# Nombre maximal d'entrées gardées (les moins récemment lues sont évincées)
+READ_CACHE_MAX_ENTRIES = int(os.getenv("READ_CACHE_MAX_ENTRIES", "1000"))
+
+class ReadCache:
+    """Entrées (espace, clé) -> valeur, bornées (LRU) et invalidées par version d'espace."""
+
+    def __init__(self, max_entries):
+        self.max_entries = max_entries
+        self._versions = {}
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._counters = {"hits": 0, "misses": 0}
+
+    def get(self, namespace, key, load):
+        """Renvoie la valeur en cache, ou celle de load() gardée pour les lectures suivantes."""
+        with self._lock:
+            version = self._versions.get(namespace, 0)
+            entry = self._entries.get((namespace, key))
+            if entry is not None and entry[0] == version:
+                self._entries.move_to_end((namespace, key))
+                self._counters["hits"] += 1
+                return entry[1]
+            self._counters["misses"] += 1
+
+        value = load()  # hors du verrou : les autres lectures ne l'attendent pas
+
+        with self._lock:
+            # Une écriture pendant le chargement rend la valeur peut-être déjà périmée
+            if self._versions.get(namespace, 0) == version:
+                self._entries[(namespace, key)] = (version, value)
+                self._entries.move_to_end((namespace, key))
+                while len(self._entries) > self.max_entries:
+                    self._entries.popitem(last=False)
+        return value
+
+    def bump(self, *namespaces):
+        """Signale une écriture : les entrées déjà lues de ces espaces sont périmées."""
+        with self._lock:
+            for namespace in namespaces:
+                self._versions[namespace] = self._versions.get(namespace, 0) + 1
+            stale = [entry_key for entry_key, (version, _) in self._entries.items()
+                     if entry_key[0] in namespaces and version != self._versions[entry_key[0]]]
+            for entry_key in stale:
+                del self._entries[entry_key]
+
+    def stats(self):
+        with self._lock:
+            return {"entries": len(self._entries), **self._counters}
+
+@st.cache_resource
+def get_read_cache():
+    """Cache de lecture partagé par toutes les sessions du processus."""
+    cache = ReadCache(READ_CACHE_MAX_ENTRIES)
+    instrumentation.register_collector("read_cache", cache.stats)
+    return cache
@@ -0,0 +1,349 @@
+import atexit
+import json
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+import db
+import instrumentation
+
+log = instrumentation.get_logger("replication")
+
+# Réplication incrémentale de stories.db sur S3.
+#
+# Chaque modification des tables suivies est enregistrée par des triggers dans la table
+# _changelog. Après une écriture, seules les lignes non encore envoyées sont téléversées
+# sous forme de segment JSON (s3://<bucket>/database/log/<premier>-<dernier>.json).
+# Un snapshot compacté de la base remplace périodiquement les segments accumulés.
+# Au démarrage, on restaure le snapshot puis on rejoue les segments plus récents.
+#
+# Les écritures ne téléversent rien elles-mêmes : elles signalent la base comme modifiée
+# et un thread de réplication regroupe les écritures rapprochées en un seul envoi.
+
+TRACKED_TABLES = ("stories_user", "personnages", "stories", "images", "story_dictionaries")
+S3_LOG_PREFIX = "database/log/"
+
+# "incremental" (par défaut) ou "full" pour retrouver le téléversement complet à chaque écriture
+REPLICATION_MODE = os.getenv("DB_REPLICATION_MODE", "incremental")
+# Nombre de segments envoyés avant de publier un nouveau snapshot compacté
+SNAPSHOT_EVERY = int(os.getenv("DB_SNAPSHOT_EVERY", "50"))
+# Fenêtre (s) pendant laquelle les écritures sont regroupées avant un envoi sur S3
+FLUSH_WINDOW = float(os.getenv("DB_FLUSH_WINDOW", "5"))
+# Attente (s) avant une nouvelle tentative après un envoi en échec
+FLUSH_RETRY_DELAY = float(os.getenv("DB_FLUSH_RETRY_DELAY", "30"))
+
+def _table_columns(cursor, table):
+    cursor.execute(f'PRAGMA table_info("{table}")')
+    return [row[1] for row in cursor.fetchall()]
+
+def _row_json(columns, prefix):
+    # JSON ne peut pas contenir de BLOB (histoires compressées) : ils sont transmis en
+    # hexadécimal et leurs colonnes sont listées sous "$blobs"
+    values = {column: f'{prefix}."{column}"' for column in columns}
+    pairs = ", ".join(f"'{column}', CASE WHEN typeof({value}) = 'blob' THEN hex({value}) ELSE {value} END"
+                      for column, value in values.items())
+    blobs = " || ".join(f"CASE WHEN typeof({value}) = 'blob' THEN '{column},' ELSE '' END"
+                        for column, value in values.items())
+    return f"json_object({pairs}, '$blobs', {blobs})"
+
+def install_change_log(db_path):
+    """Crée le journal des modifications et (re)crée les triggers des tables suivies."""
+    with db.transaction(db_path) as conn:
+        cursor = conn.cursor()
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS _changelog (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                tbl TEXT NOT NULL,
+                op TEXT NOT NULL,
+                row_id INTEGER NOT NULL,
+                data TEXT
+            )
+        """)
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS _replication_state (
+                id INTEGER PRIMARY KEY CHECK (id = 1),
+                replaying INTEGER NOT NULL DEFAULT 0,
+                shipped_seq INTEGER NOT NULL DEFAULT 0,
+                snapshot_seq INTEGER,
+                segments_since_snapshot INTEGER NOT NULL DEFAULT 0
+            )
+        """)
+        cursor.execute("INSERT OR IGNORE INTO _replication_state (id) VALUES (1)")
+
+        guard = "WHEN (SELECT replaying FROM _replication_state WHERE id = 1) = 0"
+        for table in TRACKED_TABLES:
+            columns = _table_columns(cursor, table)
+            if not columns:
+                continue
+            for op in ("insert", "update", "delete"):
+                cursor.execute(f'DROP TRIGGER IF EXISTS "_changelog_{table}_{op}"')
+            cursor.execute(f"""
+                CREATE TRIGGER "_changelog_{table}_insert" AFTER INSERT ON "{table}" {guard}
+                BEGIN
+                    INSERT INTO _changelog (tbl, op, row_id, data)
+                    VALUES ('{table}', 'upsert', NEW.rowid, {_row_json(columns, "NEW")});
+                END
+            """)
+            cursor.execute(f"""
+                CREATE TRIGGER "_changelog_{table}_update" AFTER UPDATE ON "{table}" {guard}
+                BEGIN
+                    INSERT INTO _changelog (tbl, op, row_id, data)
+                    SELECT '{table}', 'delete', OLD.rowid, NULL WHERE OLD.rowid <> NEW.rowid;
+                    INSERT INTO _changelog (tbl, op, row_id, data)
+                    VALUES ('{table}', 'upsert', NEW.rowid, {_row_json(columns, "NEW")});
+                END
+            """)
+            cursor.execute(f"""
+                CREATE TRIGGER "_changelog_{table}_delete" AFTER DELETE ON "{table}" {guard}
+                BEGIN
+                    INSERT INTO _changelog (tbl, op, row_id, data)
+                    VALUES ('{table}', 'delete', OLD.rowid, NULL);
+                END
+            """)
+
+def _metadata_path(db_path):
+    return f"{db_path}.meta.json"
+
+def read_snapshot_metadata(db_path):
+    """Renvoie l'ETag et la version du snapshot S3 dont provient la copie locale."""
+    try:
+        with open(_metadata_path(db_path), "r", encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+def write_snapshot_metadata(db_path, etag, version_id):
+    """Mémorise l'ETag et la version du snapshot S3 correspondant à la copie locale."""
+    with open(_metadata_path(db_path), "w", encoding="utf-8") as f:
+        json.dump({"etag": etag, "version_id": version_id}, f)
+
+def _segment_key(first, last):
+    return f"{S3_LOG_PREFIX}{first:012d}-{last:012d}.json"
+
+def _list_segments(s3, bucket):
+    """Renvoie les segments présents sur S3 sous la forme (premier, dernier, clé), triés."""
+    segments = []
+    paginator = s3.get_paginator("list_objects_v2")
+    for page in paginator.paginate(Bucket=bucket, Prefix=S3_LOG_PREFIX):
+        for obj in page.get("Contents", []):
+            name = obj["Key"][len(S3_LOG_PREFIX):].removesuffix(".json")
+            try:
+                first, last = (int(part) for part in name.split("-"))
+            except ValueError:
+                continue
+            segments.append((first, last, obj["Key"]))
+    return sorted(segments)
+
+def _delete_segments(s3, bucket, keys):
+    for start in range(0, len(keys), 1000):
+        batch = [{"Key": key} for key in keys[start:start + 1000]]
+        s3.delete_objects(Bucket=bucket, Delete={"Objects": batch, "Quiet": True})
+
+def upload_snapshot(s3, bucket, db_path, snapshot_key):
+    """Publie un snapshot compacté de la base et supprime les segments qu'il remplace.
+
+    La base locale n'est marquée comme répliquée qu'une fois le snapshot téléversé : un
+    envoi en échec laisse le journal intact et peut être retenté.
+    """
+    # Copie cohérente via l'API de sauvegarde de SQLite plutôt que le fichier vivant :
+    # les écritures concurrentes ne peuvent pas produire un snapshot incohérent
+    fd, backup_path = tempfile.mkstemp(suffix=".db", dir=os.path.dirname(os.path.abspath(db_path)))
+    os.close(fd)
+    try:
+        backup = sqlite3.connect(backup_path, isolation_level=None)
+        try:
+            with db.connection(db_path) as conn:
+                conn.backup(backup)
+            # Le snapshot contient toutes les modifications journalisées au moment de la copie :
+            # il est publié comme déjà répliqué jusqu'à cette séquence
+            backup.execute("BEGIN")
+            pending_seq = backup.execute("SELECT COALESCE(MAX(id), 0) FROM _changelog").fetchone()[0]
+            shipped_seq = backup.execute("SELECT shipped_seq FROM _replication_state WHERE id = 1").fetchone()[0]
+            seq = max(pending_seq, shipped_seq)
+            backup.execute("""
+                UPDATE _replication_state
+                SET shipped_seq = ?, snapshot_seq = ?, segments_since_snapshot = 0
+                WHERE id = 1
+            """, (seq, seq))
+            backup.execute("DELETE FROM _changelog WHERE id <= ?", (seq,))
+            backup.execute("COMMIT")
+        finally:
+            backup.close()
+        with instrumentation.span("s3.upload_snapshot"):
+            s3.upload_file(backup_path, bucket, snapshot_key, ExtraArgs={"Metadata": {"log-seq": str(seq)}})
+    finally:
+        os.remove(backup_path)
+
+    # Les modifications écrites pendant l'envoi (séquence > seq) restent à répliquer
+    with db.transaction(db_path) as conn:
+        conn.execute("""
+            UPDATE _replication_state
+            SET shipped_seq = MAX(shipped_seq, ?), snapshot_seq = ?, segments_since_snapshot = 0
+            WHERE id = 1
+        """, (seq, seq))
+        conn.execute("DELETE FROM _changelog WHERE id <= ?", (seq,))
+    log.info(f"Snapshot de la base téléversé sur S3 : s3://{bucket}/{snapshot_key} (séquence {seq})")
+    # La copie locale correspond désormais au snapshot publié : le prochain démarrage peut la réutiliser
+    head = s3.head_object(Bucket=bucket, Key=snapshot_key)
+    write_snapshot_metadata(db_path, head.get("ETag"), head.get("VersionId"))
+
+    obsolete = [key for first, last, key in _list_segments(s3, bucket) if last <= seq]
+    if obsolete:
+        _delete_segments(s3, bucket, obsolete)
+        log.info(f"{len(obsolete)} segment(s) du journal compacté(s) dans le snapshot.")
+    return seq
+
+def push_changes(s3, bucket, db_path, snapshot_key):
+    """Téléverse les modifications non encore répliquées.
+
+    Envoie un segment contenant uniquement les lignes modifiées, ou un snapshot complet
+    si aucun snapshot n'existe encore, si le mode complet est demandé ou si assez de
+    segments se sont accumulés.
+    """
+    shipped_seq, snapshot_seq, segments_since_snapshot = db.query_one(
+        "SELECT shipped_seq, snapshot_seq, segments_since_snapshot FROM _replication_state WHERE id = 1",
+        path=db_path)
+    rows = db.query("SELECT id, tbl, op, row_id, data FROM _changelog WHERE id > ? ORDER BY id", (shipped_seq,),
+                    path=db_path)
+
+    if (REPLICATION_MODE == "full" or snapshot_seq is None
+            or segments_since_snapshot >= SNAPSHOT_EVERY):
+        return upload_snapshot(s3, bucket, db_path, snapshot_key)
+    if not rows:
+        return shipped_seq
+
+    first, last = rows[0][0], rows[-1][0]
+    changes = [
+        {"id": row_seq, "table": table, "op": op, "rowid": row_id,
+         "data": json.loads(data) if data is not None else None}
+        for row_seq, table, op, row_id, data in rows
+    ]
+    body = json.dumps({"first": first, "last": last, "changes": changes}, ensure_ascii=False)
+    with instrumentation.span("s3.upload_segment"):
+        s3.put_object(Bucket=bucket, Key=_segment_key(first, last), Body=body.encode("utf-8"),
+                      ContentType="application/json")
+
+    with db.transaction(db_path) as conn:
+        conn.execute("""
+            UPDATE _replication_state
+            SET shipped_seq = ?, segments_since_snapshot = segments_since_snapshot + 1
+            WHERE id = 1
+        """, (last,))
+        conn.execute("DELETE FROM _changelog WHERE id <= ?", (last,))
+    log.info(f"Segment {first}-{last} du journal téléversé sur S3 ({len(changes)} modification(s), {len(body)} octets).")
+    return last
+
+def has_pending_changes(db_path):
+    """Indique si le journal contient des modifications pas encore envoyées sur S3, ou si un
+    snapshot doit être publié (aucun encore, ou base convertie par une migration)."""
+    return db.query_one("""
+        SELECT snapshot_seq IS NULL OR EXISTS (SELECT 1 FROM _changelog WHERE id > shipped_seq)
+        FROM _replication_state WHERE id = 1
+    """, path=db_path)[0] == 1
+
+class ReplicationFlusher:
+    """Thread de réplication : regroupe les écritures signalées par mark_dirty() et les
+    envoie sur S3 au plus une fois par fenêtre de FLUSH_WINDOW secondes."""
+
+    def __init__(self, s3, bucket, db_path, snapshot_key, window=FLUSH_WINDOW):
+        self.s3 = s3
+        self.bucket = bucket
+        self.db_path = db_path
+        self.snapshot_key = snapshot_key
+        self.window = window
+        self._dirty = threading.Event()
+        self._lock = threading.Lock()
+        # Des modifications journalisées mais jamais envoyées (processus arrêté avant l'envoi,
+        # envoi en échec) ou un snapshot à publier sont repris dès le démarrage
+        if has_pending_changes(db_path):
+            self._dirty.set()
+        self._thread = threading.Thread(target=self._run, name="db-replication", daemon=True)
+        self._thread.start()
+        # Envoyer les dernières écritures à l'arrêt du processus
+        atexit.register(self.flush)
+
+    def mark_dirty(self):
+        """Signale une écriture à répliquer ; ne bloque pas l'appelant."""
+        self._dirty.set()
+
+    def flush(self):
+        """Envoie immédiatement les modifications en attente ; renvoie False en cas d'échec."""
+        with self._lock:
+            if not self._dirty.is_set():
+                return True
+            self._dirty.clear()
+            try:
+                push_changes(self.s3, self.bucket, self.db_path, self.snapshot_key)
+                return True
+            except Exception as e:
+                instrumentation.increment("failures_total", operation="replication")
+                log.error(f"Erreur lors de l'upload de la base de données sur S3 : {e}")
+                self._dirty.set()
+                return False
+
+    def _run(self):
+        while True:
+            self._dirty.wait()
+            time.sleep(self.window)  # laisser les écritures rapprochées s'accumuler
+            if not self.flush():
+                time.sleep(FLUSH_RETRY_DELAY)
+
+def _apply_change(cursor, change, columns_by_table):
+    table = change["table"]
+    if table not in columns_by_table:
+        columns_by_table[table] = set(_table_columns(cursor, table))
+    known_columns = columns_by_table[table]
+    if not known_columns:
+        log.warning(f"Table '{table}' absente, modification {change['id']} ignorée.")
+        return
+    if change["op"] == "delete":
+        cursor.execute(f'DELETE FROM "{table}" WHERE rowid = ?', (change["rowid"],))
+        return
+    data = dict(change["data"])
+    for column in filter(None, data.pop("$blobs", "").split(",")):
+        data[column] = bytes.fromhex(data[column])
+    data = {column: value for column, value in data.items() if column in known_columns}
+    columns = ", ".join(f'"{column}"' for column in data)
+    placeholders = ", ".join("?" for _ in data)
+    cursor.execute(
+        f'INSERT OR REPLACE INTO "{table}" (rowid, {columns}) VALUES (?, {placeholders})',
+        (change["rowid"], *data.values()),
+    )
+
+def replay_log(s3, bucket, db_path):
+    """Rejoue sur la base locale les segments du journal postérieurs à son état."""
+    shipped_seq = db.query_one("SELECT shipped_seq FROM _replication_state WHERE id = 1", path=db_path)[0]
+
+    segments = [(first, last, key) for first, last, key in _list_segments(s3, bucket) if last > shipped_seq]
+    if not segments:
+        return 0
+
+    applied = 0
+    last_seq = shipped_seq
+    columns_by_table = {}
+    with db.transaction(db_path) as conn:
+        cursor = conn.cursor()
+        cursor.execute("UPDATE _replication_state SET replaying = 1 WHERE id = 1")
+        for first, last, key in segments:
+            segment = json.loads(s3.get_object(Bucket=bucket, Key=key)["Body"].read())
+            for change in segment["changes"]:
+                if change["id"] <= last_seq:
+                    continue
+                _apply_change(cursor, change, columns_by_table)
+                last_seq = change["id"]
+                applied += 1
+        cursor.execute("UPDATE _replication_state SET replaying = 0, shipped_seq = ? WHERE id = 1", (last_seq,))
+        # Les prochaines modifications locales doivent être numérotées après le journal rejoué
+        cursor.execute("UPDATE sqlite_sequence SET seq = MAX(seq, ?) WHERE name = '_changelog'", (last_seq,))
+        if cursor.rowcount == 0:
+            cursor.execute("INSERT INTO sqlite_sequence (name, seq) VALUES ('_changelog', ?)", (last_seq,))
+    log.info(f"{applied} modification(s) rejouée(s) depuis {len(segments)} segment(s) du journal S3.")
+    return applied
+
+def reset_log(s3, bucket):
+    """Supprime tous les segments du journal (avant de publier une base reconstruite)."""
+    keys = [key for _, _, key in _list_segments(s3, bucket)]
+    if keys:
+        _delete_segments(s3, bucket, keys)
+    return len(keys)
@@ -0,0 +1,236 @@
+import heapq
+import itertools
+import json
+import os
+import random
+import threading
+import time
+import openai
+import http_client
+import instrumentation
+
+log = instrumentation.get_logger("scheduler")
+
+# Ordonnanceur des appels OpenAI, partagé par toutes les sessions et tâches du processus.
+#
+# Chaque appel passe par trois étapes :
+#   - des seaux à jetons par modèle, en requêtes et en jetons par minute, qui font
+#     attendre l'appel plutôt que de déclencher une erreur 429 ; l'attente a lieu avant
+#     de prendre un créneau, pour qu'un modèle limité ne bloque pas les autres ;
+#   - un créneau d'exécution (OPENAI_MAX_CONCURRENCY au plus en parallèle), attribué
+#     par priorité : le texte passe avant les images ;
+#   - en cas de limite atteinte ou d'erreur temporaire, de nouvelles tentatives avec un
+#     délai exponentiel aléatoire, ou le délai Retry-After renvoyé par l'API.
+
+TEXT, IMAGE = 0, 1
+
+OPENAI_MAX_CONCURRENCY = int(os.getenv("OPENAI_MAX_CONCURRENCY", "8"))
+OPENAI_MAX_RETRIES = int(os.getenv("OPENAI_MAX_RETRIES", "5"))
+OPENAI_BACKOFF_BASE = float(os.getenv("OPENAI_BACKOFF_BASE", "1"))
+OPENAI_BACKOFF_MAX = float(os.getenv("OPENAI_BACKOFF_MAX", "60"))
+
+# Limites par modèle : requêtes (rpm) et jetons (tpm) par minute, remplaçables par
+# OPENAI_RATE_LIMITS='{"gpt-4": {"rpm": 500, "tpm": 40000}}'
+DEFAULT_RATE_LIMITS = {
+    "gpt-4": {"rpm": 500, "tpm": 40000},
+    "gpt-3.5": {"rpm": 3500, "tpm": 90000},
+    "dall-e-2": {"rpm": 50},
+}
+RATE_LIMITS = {**DEFAULT_RATE_LIMITS, **json.loads(os.getenv("OPENAI_RATE_LIMITS", "{}"))}
+IMAGE_MODEL = "dall-e-2"
+
+RETRYABLE_ERRORS = (
+    openai.error.RateLimitError,
+    openai.error.ServiceUnavailableError,
+    openai.error.APIConnectionError,
+    openai.error.Timeout,
+    openai.error.TryAgain,
+    openai.error.APIError,
+)
+
+class TokenBucket:
+    """Seau à jetons rempli en continu de rate_per_minute jetons par minute."""
+
+    def __init__(self, rate_per_minute):
+        self.capacity = float(rate_per_minute)
+        self.rate = rate_per_minute / 60.0
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def acquire(self, amount):
+        """Prend amount jetons, en attendant qu'ils soient disponibles ; renvoie l'attente (s)."""
+        amount = min(amount, self.capacity)
+        waited = 0.0
+        while True:
+            with self._lock:
+                self._refill()
+                if self.tokens >= amount:
+                    self.tokens -= amount
+                    return waited
+                delay = (amount - self.tokens) / self.rate
+            time.sleep(delay)
+            waited += delay
+
+    def refund(self, amount):
+        """Rend des jetons réservés en trop (estimation supérieure à la consommation réelle)."""
+        with self._lock:
+            self._refill()
+            self.tokens = min(self.capacity, self.tokens + amount)
+
+class StreamedResponse:
+    """Réponse d'un appel en streaming (stream=True) dont le créneau reste pris pendant la lecture.
+
+    Le créneau est rendu et l'estimation des jetons réglée à la fin du flux ou à close()
+    (lecture interrompue) : les flux comptent dans OPENAI_MAX_CONCURRENCY jusqu'au bout.
+    """
+
+    def __init__(self, response, on_close):
+        self._response = response
+        self._on_close = on_close
+        self._completion_chars = 0
+
+    def __iter__(self):
+        try:
+            for chunk in self._response:
+                for choice in chunk.get("choices", []):
+                    self._completion_chars += len(choice.get("delta", {}).get("content") or "")
+                yield chunk
+        finally:
+            self.close()
+
+    def close(self):
+        if self._on_close is None:
+            return
+        on_close, self._on_close = self._on_close, None
+        getattr(self._response, "close", lambda: None)()
+        on_close(self._completion_chars)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def __del__(self):
+        self.close()
+
+class Scheduler:
+    """Attribue les créneaux d'appel par priorité et applique les limites par modèle."""
+
+    def __init__(self, max_concurrency, rate_limits):
+        self.max_concurrency = max(1, max_concurrency)
+        self.rate_limits = rate_limits
+        self._running = 0
+        self._waiting = []
+        self._sequence = itertools.count()
+        self._condition = threading.Condition()
+        self._buckets = {}
+        self._buckets_lock = threading.Lock()
+
+    def _bucket(self, model, kind):
+        limits = self.rate_limits.get(model, {})
+        if not limits.get(kind):
+            return None
+        with self._buckets_lock:
+            key = (model, kind)
+            if key not in self._buckets:
+                self._buckets[key] = TokenBucket(limits[kind])
+            return self._buckets[key]
+
+    def _acquire_slot(self, priority):
+        with self._condition:
+            entry = (priority, next(self._sequence))
+            heapq.heappush(self._waiting, entry)
+            while self._waiting[0] != entry or self._running >= self.max_concurrency:
+                self._condition.wait()
+            heapq.heappop(self._waiting)
+            self._running += 1
+            self._condition.notify_all()
+
+    def _release_slot(self):
+        with self._condition:
+            self._running -= 1
+            self._condition.notify_all()
+
+    def stats(self):
+        """Appels en cours et appels en attente d'un créneau."""
+        with self._condition:
+            return {"running": self._running, "waiting": len(self._waiting)}
+
+    def call(self, func, kwargs, model, priority, estimated_tokens=0):
+        """Exécute func(**kwargs) dans les limites du modèle, avec nouvelles tentatives."""
+        requests_bucket = self._bucket(model, "rpm")
+        tokens_bucket = self._bucket(model, "tpm")
+        for attempt in range(OPENAI_MAX_RETRIES + 1):
+            waited = requests_bucket.acquire(1) if requests_bucket else 0.0
+            if tokens_bucket and estimated_tokens:
+                waited += tokens_bucket.acquire(estimated_tokens)
+            if waited:
+                instrumentation.metrics.observe("rate_limit_wait_seconds", waited, model=model)
+            self._acquire_slot(priority)
+            held = False
+            try:
+                with instrumentation.span(f"openai.{model}"):
+                    response = func(**kwargs)
+            except RETRYABLE_ERRORS as e:
+                if attempt == OPENAI_MAX_RETRIES:
+                    instrumentation.increment("failures_total", operation="openai", model=model)
+                    raise
+                delay = retry_delay(e, attempt)
+                instrumentation.increment("retries_total", operation="openai", model=model, error=type(e).__name__)
+                log.warning(f"Appel {model} limité ou indisponible ({type(e).__name__}), "
+                            f"nouvel essai {attempt + 1}/{OPENAI_MAX_RETRIES} dans {delay:.1f} s.")
+            else:
+                if kwargs.get("stream"):
+                    held = True
+                    return StreamedResponse(response, lambda completion_chars: self._end_stream(
+                        tokens_bucket, estimated_tokens, kwargs["messages"], completion_chars))
+                usage = getattr(response, "get", lambda key: None)("usage")
+                if tokens_bucket and usage and estimated_tokens > usage["total_tokens"]:
+                    tokens_bucket.refund(estimated_tokens - usage["total_tokens"])
+                return response
+            finally:
+                if not held:
+                    self._release_slot()
+            time.sleep(delay)
+
+    def _end_stream(self, tokens_bucket, estimated_tokens, messages, completion_chars):
+        self._release_slot()
+        # Un flux ne renvoie pas d'usage : la réponse reçue est estimée comme le prompt
+        used = estimate_tokens(messages, completion_chars // 4)
+        if tokens_bucket and estimated_tokens > used:
+            tokens_bucket.refund(estimated_tokens - used)
+
+def retry_delay(error, attempt):
+    """Délai avant une nouvelle tentative : Retry-After s'il est fourni, sinon exponentiel aléatoire."""
+    headers = getattr(error, "headers", None) or {}
+    retry_after = headers.get("retry-after") or headers.get("Retry-After")
+    if retry_after:
+        try:
+            return min(float(retry_after), OPENAI_BACKOFF_MAX)
+        except ValueError:
+            pass
+    return random.uniform(0, min(OPENAI_BACKOFF_MAX, OPENAI_BACKOFF_BASE * 2 ** attempt))
+
+def estimate_tokens(messages, max_tokens):
+    """Estimation des jetons d'un appel : environ 4 caractères par jeton du prompt, plus la réponse maximale."""
+    return sum(len(message["content"]) for message in messages) // 4 + max_tokens
+
+_scheduler = Scheduler(OPENAI_MAX_CONCURRENCY, RATE_LIMITS)
+instrumentation.register_collector("openai_scheduler", _scheduler.stats)
+
+def chat_completion(**kwargs):
+    """openai.ChatCompletion.create, ordonnancé avec la priorité du texte."""
+    tokens = estimate_tokens(kwargs["messages"], kwargs.get("max_tokens", 0))
+    kwargs.setdefault("request_timeout", http_client.DEFAULT_TIMEOUT)
+    return _scheduler.call(openai.ChatCompletion.create, kwargs, kwargs["model"], TEXT, tokens)
+
+def image_create_edit(**kwargs):
+    """openai.Image.create_edit, ordonnancé après les appels de texte."""
+    return _scheduler.call(openai.Image.create_edit, kwargs, IMAGE_MODEL, IMAGE)
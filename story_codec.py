@@ -0,0 +1,122 @@
+import os
+import threading
+import zlib
+import db
+
+try:
+    import zstandard
+except ImportError:  # compression zstd optionnelle
+    zstandard = None
+
+# Compression du texte des histoires (colonne stories.story).
+#
+# Les histoires sont enregistrées dans un BLOB dont le premier octet indique le format :
+# zlib par défaut, ou zstd avec STORY_COMPRESSION=zstd (paquet zstandard requis sur
+# toutes les instances). Le dictionnaire zstd est entraîné sur les histoires déjà
+# enregistrées, lors de la première écriture qui en a assez, et stocké dans la table
+# story_dictionaries répliquée avec le reste de la base. Les lignes encore en TEXT
+# (bases non migrées, journal ancien) sont lues telles quelles.
+
+# "zlib", "zstd" ou "none" (texte non compressé)
+STORY_COMPRESSION = os.getenv("STORY_COMPRESSION", "zlib")
+ZLIB_LEVEL = 9
+ZSTD_LEVEL = int(os.getenv("STORY_ZSTD_LEVEL", "19"))
+# Taille (octets) du dictionnaire zstd et nombre d'histoires nécessaires pour l'entraîner
+STORY_DICT_SIZE = int(os.getenv("STORY_DICT_SIZE", str(32 * 1024)))
+STORY_DICT_MIN_SAMPLES = int(os.getenv("STORY_DICT_MIN_SAMPLES", "100"))
+STORY_DICT_MAX_SAMPLES = 2000
+
+ZLIB, ZSTD = b"\x01", b"\x02"
+
+# Dictionnaires zstd déjà chargés, par identifiant (aléatoire, propre à chaque dictionnaire)
+_dictionaries = {}
+# Un seul entraînement à la fois dans le processus
+_training_lock = threading.Lock()
+
+def create_schema(conn):
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS story_dictionaries (
+            dict_id INTEGER PRIMARY KEY,
+            data BLOB NOT NULL
+        )
+    """)
+
+def _require_zstandard():
+    if zstandard is None:
+        raise RuntimeError("Le paquet zstandard est nécessaire pour les histoires compressées avec zstd.")
+
+def _load_dictionary(dict_id, conn=None):
+    dictionary = _dictionaries.get(dict_id)
+    if dictionary is None:
+        sql, params = "SELECT data FROM story_dictionaries WHERE dict_id = ?", (dict_id,)
+        row = conn.execute(sql, params).fetchone() if conn is not None else db.query_one(sql, params)
+        if row is None:
+            raise LookupError(f"Dictionnaire zstd {dict_id} introuvable.")
+        dictionary = _dictionaries[dict_id] = zstandard.ZstdCompressionDict(row[0])
+    return dictionary
+
+def train_dictionary(stories, size=STORY_DICT_SIZE):
+    """Entraîne un dictionnaire zstd sur une liste de textes d'histoires."""
+    _require_zstandard()
+    return zstandard.train_dictionary(size, [story.encode("utf-8") for story in stories])
+
+def _has_dictionary(path):
+    return db.query_one("SELECT EXISTS (SELECT 1 FROM story_dictionaries)", path=path)[0] == 1
+
+def ensure_dictionary(path=db.LOCAL_DB_PATH, method=None):
+    """Entraîne le dictionnaire zstd si la base n'en a pas encore et a assez d'histoires.
+
+    À appeler avant la transaction d'écriture de l'histoire : les histoires sont lues et
+    le dictionnaire entraîné sans verrou d'écriture, puis enregistré dans une transaction
+    courte, journalisée (et répliquée) avant la ligne qui l'utilisera.
+    """
+    if (method or STORY_COMPRESSION) != "zstd" or _has_dictionary(path):
+        return
+    _require_zstandard()
+    with _training_lock:
+        if _has_dictionary(path):
+            return
+        rows = db.query("SELECT story FROM stories ORDER BY id DESC LIMIT ?", (STORY_DICT_MAX_SAMPLES,), path=path)
+        if len(rows) < STORY_DICT_MIN_SAMPLES:
+            return
+        with db.connection(path) as conn:
+            dictionary = train_dictionary([decode(story, conn) for story, in rows])
+        with db.transaction(path) as conn:
+            conn.execute("INSERT OR IGNORE INTO story_dictionaries (dict_id, data) VALUES (?, ?)",
+                         (dictionary.dict_id(), dictionary.as_bytes()))
+        _dictionaries[dictionary.dict_id()] = dictionary
+
+def _active_dictionary(conn):
+    """Renvoie le dictionnaire zstd le plus récent, ou None tant qu'aucun n'a été entraîné."""
+    row = conn.execute("SELECT dict_id FROM story_dictionaries ORDER BY rowid DESC LIMIT 1").fetchone()
+    return _load_dictionary(row[0], conn) if row is not None else None
+
+def encode(text, conn, method=None):
+    """Renvoie la valeur à enregistrer dans stories.story (conn : transaction d'écriture en cours).
+
+    En zstd, le dictionnaire est celui préparé par ensure_dictionary().
+    """
+    method = method or STORY_COMPRESSION
+    if method == "none":
+        return text
+    data = text.encode("utf-8")
+    if method == "zstd":
+        _require_zstandard()
+        dictionary = _active_dictionary(conn)
+        return ZSTD + zstandard.ZstdCompressor(level=ZSTD_LEVEL, dict_data=dictionary).compress(data)
+    return ZLIB + zlib.compress(data, ZLIB_LEVEL)
+
+def decode(value, conn=None):
+    """Renvoie le texte d'une valeur de stories.story, compressée ou non."""
+    if value is None or isinstance(value, str):
+        return value
+    value = bytes(value)
+    tag, payload = value[:1], value[1:]
+    if tag == ZLIB:
+        return zlib.decompress(payload).decode("utf-8")
+    if tag == ZSTD:
+        _require_zstandard()
+        dict_id = zstandard.get_frame_parameters(payload).dict_id
+        dictionary = _load_dictionary(dict_id, conn) if dict_id else None
+        return zstandard.ZstdDecompressor(dict_data=dictionary).decompress(payload).decode("utf-8")
+    raise ValueError(f"Format de stories.story inconnu : {tag!r}")
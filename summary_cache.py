@@ -0,0 +1,96 @@
+import hashlib
+import os
+import threading
+import time
+import db
+import instrumentation
+
+# Cache persistant des résumés de paragraphes utilisés comme prompts d'image.
+#
+# Les résumés sont stockés dans une base SQLite à côté de stories.db, indexés par
+# l'empreinte (modèle, modèle de prompt, texte du paragraphe) : régénérer les
+# illustrations d'une histoire ou relancer une histoire échouée ne repaie pas le résumé.
+# La base n'est pas répliquée sur S3 ; au-delà de SUMMARY_CACHE_MAX_ENTRIES, les
+# résumés les moins récemment utilisés sont supprimés.
+
+SUMMARY_CACHE_PATH = os.path.join(os.path.dirname(db.LOCAL_DB_PATH), "summaries.db")
+SUMMARY_CACHE_MAX_ENTRIES = int(os.getenv("SUMMARY_CACHE_MAX_ENTRIES", "50000"))
+# SUMMARY_CACHE=0 pour toujours redemander les résumés
+SUMMARY_CACHE_ENABLED = os.getenv("SUMMARY_CACHE", "1") != "0"
+
+_lock = threading.Lock()
+_counters = {"hits": 0, "misses": 0, "evictions": 0}
+_ready_paths = set()
+
+def _ensure_schema(path):
+    if path in _ready_paths:
+        return
+    with db.transaction(path) as conn:
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS summaries (
+                key TEXT PRIMARY KEY,
+                summary TEXT NOT NULL,
+                last_used REAL NOT NULL
+            )
+        """)
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_summaries_last_used ON summaries (last_used)")
+    _ready_paths.add(path)
+
+def _count(name, value=1):
+    with _lock:
+        _counters[name] += value
+
+def make_key(model, template, text):
+    """Renvoie la clé de cache d'un résumé : empreinte du modèle, du modèle de prompt et du texte."""
+    return hashlib.sha256("\x1f".join((model, template, text)).encode()).hexdigest()
+
+def get_many(keys, path=SUMMARY_CACHE_PATH):
+    """Renvoie les résumés trouvés en cache, sous la forme {clé: résumé}."""
+    if not SUMMARY_CACHE_ENABLED or not keys:
+        return {}
+    _ensure_schema(path)
+    unique_keys = list(dict.fromkeys(keys))
+    placeholders = ", ".join("?" for _ in unique_keys)
+    found = dict(db.query(f"SELECT key, summary FROM summaries WHERE key IN ({placeholders})", unique_keys,
+                          path=path))
+    if found:
+        # Marque les résumés comme récemment utilisés pour l'éviction LRU
+        with db.transaction(path) as conn:
+            conn.executemany("UPDATE summaries SET last_used = ? WHERE key = ?",
+                             [(time.time(), key) for key in found])
+    _count("hits", sum(1 for key in keys if key in found))
+    _count("misses", sum(1 for key in keys if key not in found))
+    return found
+
+def get(key, path=SUMMARY_CACHE_PATH):
+    """Renvoie le résumé en cache pour cette clé, ou None."""
+    return get_many([key], path).get(key)
+
+def put_many(entries, path=SUMMARY_CACHE_PATH):
+    """Enregistre des résumés {clé: résumé} puis évince les plus anciens au-delà de la taille maximale."""
+    if not SUMMARY_CACHE_ENABLED or not entries:
+        return
+    _ensure_schema(path)
+    now = time.time()
+    with db.transaction(path) as conn:
+        conn.executemany("INSERT OR REPLACE INTO summaries (key, summary, last_used) VALUES (?, ?, ?)",
+                         [(key, summary, now) for key, summary in entries.items()])
+        excess = conn.execute("SELECT COUNT(*) FROM summaries").fetchone()[0] - SUMMARY_CACHE_MAX_ENTRIES
+        if excess > 0:
+            conn.execute("""
+                DELETE FROM summaries WHERE key IN (
+                    SELECT key FROM summaries ORDER BY last_used LIMIT ?
+                )
+            """, (excess,))
+            _count("evictions", excess)
+
+def put(key, summary, path=SUMMARY_CACHE_PATH):
+    """Enregistre un résumé en cache."""
+    put_many({key: summary}, path)
+
+def stats():
+    """Renvoie les compteurs du processus : résumés trouvés, manquants et évincés."""
+    with _lock:
+        return dict(_counters)
+
+instrumentation.register_collector("summary_cache", stats)
@@ -0,0 +1,56 @@
+"""db : les connexions viennent d'un pool du processus, pas d'une connexion par thread.
+
+    python -m pytest tests
+"""
+import os
+import sys
+import threading
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import db  # noqa: E402
+import migrations  # noqa: E402
+
+@pytest.fixture
+def path(tmp_path):
+    path = str(tmp_path / "stories.db")
+    migrations.migrate(path)
+    try:
+        yield path
+    finally:
+        db.close_all()
+
+def test_short_lived_threads_reuse_pooled_connections(path):
+    def work(index):
+        with db.transaction(path) as conn:
+            conn.execute("INSERT INTO personnages (personnage, description) VALUES (?, '')", (f"p{index}",))
+            with db.transaction(path) as inner:
+                assert inner is conn  # SAVEPOINT sur la connexion déjà empruntée
+                assert db.query_one("SELECT COUNT(*) FROM personnages WHERE personnage = ?",
+                                    (f"p{index}",), path=path) == (1,)
+
+    opened = db.pool_stats()["opened"]
+    # Comme les réexécutions Streamlit : chaque vague de requêtes dans de nouveaux threads
+    for wave in range(10):
+        threads = [threading.Thread(target=work, args=(wave * 20 + index,)) for index in range(20)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+    assert db.query_one("SELECT COUNT(*) FROM personnages", path=path) == (200,)
+    stats = db.pool_stats()
+    assert stats["in_use"] == 0
+    assert stats["open"] <= db.POOL_SIZE
+    assert stats["opened"] - opened < 200
+
+def test_failed_transaction_returns_a_clean_connection(path):
+    with pytest.raises(KeyError):
+        with db.transaction(path) as conn:
+            conn.execute("INSERT INTO personnages (personnage, description) VALUES ('annulé', '')")
+            raise KeyError
+    assert db.query_one("SELECT COUNT(*) FROM personnages", path=path) == (0,)
+    with db.connection(path) as conn:
+        assert not conn.in_transaction
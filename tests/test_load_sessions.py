@@ -0,0 +1,35 @@
+"""benchmarks/load_sessions.py : une session suit tout le parcours (connexion, "Lancer", historique).
+
+Le générateur de charge tourne dans son propre processus : il prépare son répertoire de
+travail et ses singletons Streamlit indépendamment des autres tests.
+
+    python -m pytest tests
+"""
+import importlib.util
+import json
+import os
+import subprocess
+import sys
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+pytestmark = pytest.mark.skipif(
+    any(importlib.util.find_spec(module) is None for module in ("streamlit", "openai", "boto3")),
+    reason="streamlit, openai et boto3 sont nécessaires pour démarrer l'application",
+)
+
+def test_one_session_completes(tmp_path):
+    output = tmp_path / "load.json"
+    subprocess.run(
+        [sys.executable, os.path.join(ROOT, "benchmarks", "load_sessions.py"), "--sessions", "1",
+         "--users", "5", "--stories", "20", "--images", "2", "--latency", "0", "--image-latency", "0",
+         "--jitter", "0", "--timeout", "60", "--json", str(output)],
+        check=True, timeout=300, capture_output=True,
+    )
+    (result,) = json.loads(output.read_text(encoding="utf-8"))["rounds"]
+    assert result["errors"] == []
+    assert result["completed"] == 1
+    for interaction in ("login", "lancer", "story_ready", "history", "open_story"):
+        assert result["latency"][interaction]["count"] == 1
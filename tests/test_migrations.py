@@ -0,0 +1,114 @@
+"""migrations.migrate : une base créée par l'ancien db_init.py rejoint le schéma commun.
+
+    python -m pytest tests
+"""
+import os
+import sqlite3
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import db  # noqa: E402
+import migrations  # noqa: E402
+import replication  # noqa: E402
+import story_codec  # noqa: E402
+
+# Schéma créé par db_init.py avant les migrations
+LEGACY_SCHEMA = """
+    CREATE TABLE stories_user (
+        utilisateur TEXT PRIMARY KEY,
+        password TEXT NOT NULL,
+        email TEXT NOT NULL,
+        sexe TEXT NOT NULL,
+        age INTEGER NOT NULL,
+        reset_code TEXT
+    );
+    CREATE TABLE personnages (
+        personnage TEXT PRIMARY KEY,
+        description TEXT NOT NULL
+    );
+    CREATE TABLE stories (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        story_id TEXT,
+        titre TEXT NOT NULL,
+        theme TEXT NOT NULL,
+        keywords TEXT,
+        sexe TEXT NOT NULL,
+        age INTEGER NOT NULL,
+        story TEXT NOT NULL,
+        utilisateur TEXT NOT NULL,
+        FOREIGN KEY (utilisateur) REFERENCES stories_user (utilisateur)
+    );
+    CREATE TABLE images (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        story_id INTEGER NOT NULL,
+        image_name TEXT NOT NULL,
+        FOREIGN KEY (story_id) REFERENCES stories (id)
+    );
+"""
+
+@pytest.fixture
+def legacy_db(tmp_path):
+    path = str(tmp_path / "stories.db")
+    conn = sqlite3.connect(path)
+    conn.executescript(LEGACY_SCHEMA)
+    conn.executemany("INSERT INTO stories_user VALUES (?, ?, ?, ?, ?, NULL)",
+                     [("alice", "pw1", "mail1", "une fille", 6), ("bob", "pw2", "mail2", "un garçon", 8)])
+    conn.execute("INSERT INTO personnages VALUES ('Zouzou', 'un chat')")
+    conn.execute("""
+        INSERT INTO stories (story_id, titre, theme, sexe, age, story, utilisateur)
+        VALUES ('key1', 'Le renard', 'Aventure', 'une fille', 6, 'Il était une fois...', 'alice')
+    """)
+    conn.execute("INSERT INTO images (story_id, image_name) VALUES (1, 'images/key1/paragraph_0.png')")
+    conn.commit()
+    conn.close()
+    try:
+        yield path
+    finally:
+        db.close_all()
+
+def test_legacy_schema_is_rebuilt(legacy_db):
+    replication.install_change_log(legacy_db)
+    migrations.migrate(legacy_db)
+    replication.install_change_log(legacy_db)
+
+    with db.connection(legacy_db) as conn:
+        for table, columns in migrations._CANONICAL_TABLES.items():
+            conn.execute(f'CREATE TEMP TABLE "expected_{table}" ({columns})')
+            expected = {row[1:] for row in conn.execute(f'PRAGMA temp.table_info("expected_{table}")')}
+            assert {row[1:] for row in conn.execute(f'PRAGMA main.table_info("{table}")')} == expected
+    assert migrations.schema_version(legacy_db) == len(migrations.MIGRATIONS)
+
+    # Les lignes gardent leur rowid, qui devient l'id des tables qui n'en avaient pas
+    assert db.query("SELECT id, utilisateur, password FROM stories_user ORDER BY id", path=legacy_db) == \
+        [(1, "alice", "pw1"), (2, "bob", "pw2")]
+    assert db.query("SELECT id, personnage FROM personnages", path=legacy_db) == [(1, "Zouzou")]
+    story = db.query_one("SELECT titre, story FROM stories WHERE id = 1", path=legacy_db)
+    assert story[0] == "Le renard"
+    with db.connection(legacy_db) as conn:
+        assert story_codec.decode(story[1], conn) == "Il était une fois..."
+    assert db.query("SELECT story_id, image_name FROM images", path=legacy_db) == \
+        [(1, "images/key1/paragraph_0.png")]
+
+    # Index, compteurs AUTOINCREMENT et triggers de réplication des tables reconstruites
+    indexes = {row[0] for row in db.query("SELECT name FROM sqlite_master WHERE type = 'index'", path=legacy_db)}
+    assert {"idx_stories_user_email", "idx_stories_utilisateur_id", "idx_images_story_id"} <= indexes
+    with db.transaction(legacy_db) as conn:
+        conn.execute("INSERT INTO stories_user (utilisateur, password) VALUES ('carol', 'pw3')")
+    assert db.query_one("SELECT id FROM stories_user WHERE utilisateur = 'carol'", path=legacy_db) == (3,)
+    assert db.query_one("SELECT tbl, row_id FROM _changelog ORDER BY id DESC LIMIT 1", path=legacy_db) == \
+        ("stories_user", 3)
+    assert db.query_one("SELECT snapshot_seq FROM _replication_state", path=legacy_db) == (None,)
+
+def test_canonical_schema_is_left_alone(tmp_path):
+    path = str(tmp_path / "stories.db")
+    try:
+        migrations.migrate(path)
+        before = db.query("SELECT name, sql FROM sqlite_master ORDER BY name", path=path)
+        db.execute("PRAGMA user_version = 6", path=path)
+        migrations.migrate(path)
+        assert db.query("SELECT name, sql FROM sqlite_master ORDER BY name", path=path) == before
+    finally:
+        db.close_all()
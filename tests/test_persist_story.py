@@ -0,0 +1,73 @@
+"""persist_story : une génération écrit une histoire, ses images et déclenche une seule réplication.
+
+L'application tourne hors ligne comme dans les benchmarks (benchmarks/stand_ins.py) :
+S3 est un répertoire local et les API OpenAI un serveur HTTP local.
+
+    python -m pytest tests
+"""
+import importlib.util
+import os
+import sys
+
+import pytest
+
+# Les modules ne sont pas importés ici : streamlit lit l'emplacement de .streamlit/secrets.toml
+# dans le répertoire courant à son import, qui doit avoir lieu après offline_environment()
+pytestmark = pytest.mark.skipif(
+    any(importlib.util.find_spec(module) is None for module in ("streamlit", "openai", "boto3")),
+    reason="streamlit, openai et boto3 sont nécessaires pour démarrer l'application",
+)
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "benchmarks"))
+
+from stand_ins import FAKE_STORY, offline_environment, sqlite_counts  # noqa: E402
+
+IMAGES_PER_STORY = 3
+
+@pytest.fixture(scope="module")
+def offline_app(tmp_path_factory):
+    cwd = os.getcwd()
+    s3, server = offline_environment(str(tmp_path_factory.mktemp("app")), n_users=5, n_stories=20,
+                                     images_per_story=IMAGES_PER_STORY, latency=0, image_latency=0, jitter=0)
+    import app  # démarre l'application : téléchargement de la base, journal, thread de réplication
+    import db
+    try:
+        yield app, s3
+    finally:
+        server.stop()
+        db.close_all()
+        os.chdir(cwd)
+
+def test_persist_story_writes_once_and_replicates_once(offline_app, monkeypatch):
+    app, s3 = offline_app
+    import bootstrap
+
+    flusher = bootstrap.get_replication_flusher()
+    assert flusher.flush()  # rien ne reste en attente du démarrage
+    marks = []
+    mark_dirty = flusher.mark_dirty
+    monkeypatch.setattr(flusher, "mark_dirty", lambda: (marks.append(1), mark_dirty()))
+
+    story_key = app.reserve_story_key()
+    image_paths = [f"images/{story_key}/paragraph_{index}.png" for index in range(IMAGES_PER_STORY)]
+    rows_before = sqlite_counts(bootstrap.LOCAL_DB_PATH)
+
+    # Le deuxième paragraphe n'a pas pu être illustré
+    paragraph_images = image_paths[:1] + [None] + image_paths[1:]
+    story_id = app.persist_story(FAKE_STORY, "Aventure", "mer, renard", {"sexe": "une fille", "age": 7},
+                                 "user0", paragraph_images, story_key)
+
+    rows_after = sqlite_counts(bootstrap.LOCAL_DB_PATH)
+    assert rows_after["stories"] - rows_before["stories"] == 1
+    assert rows_after["images"] - rows_before["images"] == IMAGES_PER_STORY
+    assert len(marks) == 1
+
+    calls_before = s3.snapshot_counters()["calls"]
+    assert flusher.flush()
+    calls = {operation: count - calls_before.get(operation, 0)
+             for operation, count in s3.snapshot_counters()["calls"].items()}
+    assert calls.get("put_object", 0) == 1  # un seul segment du journal
+    assert calls.get("upload_file", 0) == 0  # pas de snapshot complet
+
+    # L'historique retrouve chaque image à la position de son paragraphe
+    assert app.fetch_story(story_id)["images"] == paragraph_images
@@ -1,203 +1,157 @@
 import streamlit as st
 import os
 import sqlite3
+import db
 import hashlib
+import json
 import smtplib
 import string
 import random
 from email.mime.text import MIMEText
 from email.mime.multipart import MIMEMultipart
-import boto3
-
-# Configuration de boto3 pour S3
-AWS_ACCESS_KEY_ID = os.getenv("AWS_ACCESS_KEY_ID")
-AWS_SECRET_ACCESS_KEY = os.getenv("AWS_SECRET_ACCESS_KEY")
-AWS_REGION = os.getenv("AWS_DEFAULT_REGION", "eu-north-1")
-S3_BUCKET_NAME = "jujul"
-
-try:
-    s3 = boto3.client(
-        "s3",
-        region_name=AWS_REGION,
-        aws_access_key_id=AWS_ACCESS_KEY_ID,
-        aws_secret_access_key=AWS_SECRET_ACCESS_KEY,
-    )
-    s3.head_bucket(Bucket=S3_BUCKET_NAME)
-except Exception as e:
-    st.error(f"Erreur de configuration S3 : {e}. Vérifiez vos credentials et le bucket.")
-    st.stop()
-
-LOCAL_DB_PATH = "stories.db"
-S3_DB_KEY = "database/stories.db"
+import migrations
+import instrumentation
+import read_cache
+import story_codec
+from bootstrap import get_replication_flusher
+
+log = instrumentation.get_logger("users")
+
+# Recherche par email via le cache de lecture partagé (SHARED_EMAIL_INDEX=0 pour ne passer que par la base)
+SHARED_EMAIL_INDEX = os.getenv("SHARED_EMAIL_INDEX", "1") != "0"
 
 def upload_db_to_s3():
-    """Téléverse stories.db sur S3 après une modification."""
-    try:
-        s3.upload_file(LOCAL_DB_PATH, "jujul", S3_DB_KEY)
-        print(f"Base de données téléversée sur S3 : s3://jujul/{S3_DB_KEY}")
-    except Exception as e:
-        print(f"Erreur lors de l'upload de la base de données sur S3 : {e}")
-
-def initialize_db():
-    """Crée les tables nécessaires si la base de données est nouvelle."""
-    conn = sqlite3.connect(LOCAL_DB_PATH)
-    cursor = conn.cursor()
-    cursor.execute("""
-        CREATE TABLE IF NOT EXISTS stories_user (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            utilisateur TEXT UNIQUE,
-            password TEXT,
-            email TEXT,
-            sexe TEXT,
-            age INTEGER,
-            reset_code TEXT
-        )
-    """)
-    cursor.execute("""
-        CREATE TABLE IF NOT EXISTS personnages (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            personnage TEXT UNIQUE,
-            description TEXT
-        )
-    """)
-    cursor.execute("""
-        CREATE TABLE IF NOT EXISTS stories (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            titre TEXT,
-            theme TEXT,
-            keywords TEXT,
-            sexe TEXT,
-            age INTEGER,
-            story TEXT,
-            utilisateur TEXT,
-            FOREIGN KEY (utilisateur) REFERENCES stories_user (utilisateur)
-        )
-    """)
-    cursor.execute("""
-        CREATE TABLE IF NOT EXISTS images (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            story_id INTEGER NOT NULL,
-            image_name TEXT NOT NULL,
-            FOREIGN KEY (story_id) REFERENCES stories (id)
-        )
-    """)
-    conn.commit()
-    conn.close()
-    print("Tables de la base de données créées ou vérifiées.")
+    """Programme la réplication sur S3 des modifications de stories.db (envoi groupé en arrière-plan)."""
+    get_replication_flusher().mark_dirty()
 
 def hash(element):
     return hashlib.sha256(element.encode()).hexdigest()
 
-def load_users():
-    try:
-        conn = sqlite3.connect(LOCAL_DB_PATH)
-        cursor = conn.cursor()
-        cursor.execute("SELECT utilisateur, password, email, sexe, age, reset_code FROM stories_user")
-        rows = cursor.fetchall()
-        users = {row[0]: {
-            "password": row[1],
-            "email": row[2],
-            "sexe": row[3],
-            "age": row[4],
-            "reset_code": row[5] if row[5] else None
-        } for row in rows}
-        conn.close()
-        return users
-    except sqlite3.OperationalError as e:
-        if "no such table" in str(e):
-            print("Table 'stories_user' non trouvée, initialisation de la base de données.")
-            initialize_db()
-            return {}
-        raise e
+def _row_to_user(row):
+    return {
+        "password": row[0],
+        "email": row[1],
+        "sexe": row[2],
+        "age": row[3],
+        "reset_code": row[4] if row[4] else None
+    }
+
+def _query_user(username):
+    row = db.query_one("SELECT password, email, sexe, age, reset_code FROM stories_user WHERE utilisateur = ?",
+                       (username,))
+    return _row_to_user(row) if row else None
+
+def get_user(username):
+    """Renvoie le profil d'un utilisateur (recherche par nom, indexée), ou None.
+
+    Le profil passe par le cache de lecture partagé, invalidé à chaque écriture dans stories_user.
+    """
+    return read_cache.get_read_cache().get(read_cache.USERS, username, lambda: _query_user(username))
+
+def _query_username_by_email_hash(email_hash):
+    row = db.query_one("SELECT utilisateur FROM stories_user WHERE email = ? LIMIT 1", (email_hash,))
+    return row[0] if row else None
+
+def find_username_by_email_hash(email_hash):
+    """Renvoie le nom d'utilisateur associé à une empreinte d'email, ou None.
+
+    La recherche passe par l'index idx_stories_user_email ; le résultat, même absent, est
+    gardé dans le cache de lecture partagé (espace EMAILS, invalidé à chaque création de compte)
+    si SHARED_EMAIL_INDEX est actif.
+    """
+    if not SHARED_EMAIL_INDEX:
+        return _query_username_by_email_hash(email_hash)
+    return read_cache.get_read_cache().get(read_cache.EMAILS, email_hash,
+                                           lambda: _query_username_by_email_hash(email_hash))
+
+def current_user():
+    """Renvoie le profil de l'utilisateur connecté ; la session ne garde que son nom."""
+    username = st.session_state.get("username")
+    return get_user(username) if username else None
 
 def load_personnages():
     try:
-        conn = sqlite3.connect(LOCAL_DB_PATH)
-        cursor = conn.cursor()
-        cursor.execute("SELECT personnage, description FROM personnages")
-        rows = cursor.fetchall()
+        rows = db.query("SELECT personnage, description FROM personnages")
         personnages = {row[0]: {"description": row[1]} for row in rows}
-        conn.close()
         return personnages
     except sqlite3.OperationalError as e:
         if "no such table" in str(e):
-            print("Table 'personnages' non trouvée, initialisation de la base de données.")
-            initialize_db()
+            log.warning("Table 'personnages' non trouvée, initialisation de la base de données.")
+            migrations.migrate()
             return {}
         raise e
 
+def get_personnages():
+    """Renvoie les personnages depuis le cache de lecture partagé (à ne pas modifier)."""
+    return read_cache.get_read_cache().get(read_cache.PERSONNAGES, None, load_personnages)
+
+def iter_stories_with_images():
+    """Parcourt les histoires avec leurs images en une seule requête groupée (une ligne par histoire).
+
+    Les images sont regroupées par histoire en un tableau JSON, dans leur ordre d'insertion.
+    """
+    return db.iter_query("""
+        SELECT s.id, s.titre, s.theme, s.keywords, s.sexe, s.age, s.story, s.utilisateur, img.names
+        FROM stories AS s
+        LEFT JOIN (
+            SELECT story_id, json_group_array(image_name) AS names
+            FROM (SELECT story_id, image_name FROM images ORDER BY story_id, id)
+            GROUP BY story_id
+        ) AS img ON img.story_id = s.id
+        ORDER BY s.id
+    """)
+
 def load_all_stories():
+    """Charge toutes les histoires, indexées par id, avec la liste de leurs images."""
     try:
-        conn = sqlite3.connect(LOCAL_DB_PATH)
-        cursor = conn.cursor()
-        cursor.execute("SELECT titre, theme, keywords, sexe, age, story, utilisateur FROM stories")
-        rows = cursor.fetchall()
-        stories = {row[0]: {
-            "theme": row[1],
-            "keywords": row[2],
-            "sexe": row[3],
-            "age": row[4],
-            "story": row[5],
-            "utilisateur": row[6],
-            "images": []
-        } for row in rows}
-        cursor.execute("SELECT story_id, image_name FROM images")
-        images = cursor.fetchall()
-        for story_id, image_name in images:
-            cursor.execute("SELECT titre FROM stories WHERE id = ?", (story_id,))
-            titre = cursor.fetchone()[0]
-            stories[titre]["images"].append(image_name)
-        conn.close()
-        return stories
+        return {
+            story_id: {
+                "titre": titre,
+                "theme": theme,
+                "keywords": keywords,
+                "sexe": sexe,
+                "age": age,
+                "story": story_codec.decode(story),
+                "utilisateur": utilisateur,
+                "images": json.loads(images) if images else []
+            }
+            for story_id, titre, theme, keywords, sexe, age, story, utilisateur, images in iter_stories_with_images()
+        }
     except sqlite3.OperationalError as e:
         if "no such table" in str(e):
-            print("Table 'stories' ou 'images' non trouvée, initialisation de la base de données.")
-            initialize_db()
+            log.warning("Table 'stories' ou 'images' non trouvée, initialisation de la base de données.")
+            migrations.migrate()
             return {}
         raise e
 
 def create_account(username, password, email, sexe, age, description=None):
-    users = st.session_state["users"]
-    personnages = st.session_state["personnages"]
-
-    if username in users:
+    if get_user(username) is not None:
         st.error("Un compte avec ce nom d'utilisateur existe déjà.")
         return False
 
-    if any(user_data["email"] == hash(email) for user_data in users.values()):
+    if find_username_by_email_hash(hash(email)) is not None:
         st.error("Un compte avec cet email existe déjà.")
         return False
 
-    conn = sqlite3.connect(LOCAL_DB_PATH)
-    cursor = conn.cursor()
-    cursor.execute("""
-        INSERT INTO stories_user (utilisateur, password, email, sexe, age)
-        VALUES (?, ?, ?, ?, ?)
-    """, (username, hash(password), hash(email), sexe, age))
-    conn.commit()
+    with db.transaction() as conn:
+        conn.execute("""
+            INSERT INTO stories_user (utilisateur, password, email, sexe, age)
+            VALUES (?, ?, ?, ?, ?)
+        """, (username, hash(password), hash(email), sexe, age))
 
-    if st.session_state["creer_perso"] == "oui":
-        cursor.execute("""
-            INSERT INTO personnages (personnage, description)
-            VALUES (?, ?)
-        """, (username, description))
-        conn.commit()
-        personnages[username] = {"description": description}
-
-    conn.close()
-    upload_db_to_s3()  # Synchroniser avec S3 après modification
+        if st.session_state["creer_perso"] == "oui":
+            conn.execute("""
+                INSERT INTO personnages (personnage, description)
+                VALUES (?, ?)
+            """, (username, description))
+    read_cache.get_read_cache().bump(read_cache.USERS, read_cache.PERSONNAGES, read_cache.EMAILS)
 
-    users[username] = {
-        "password": hash(password),
-        "email": hash(email),
-        "sexe": sexe,
-        "age": age,
-    }
+    upload_db_to_s3()  # Synchroniser avec S3 après modification
     return True
 
 def verify_password(username, password):
-    users = st.session_state["users"]
-    if username in users and users[username]["password"] == hash(password):
+    user = get_user(username)
+    if user is not None and user["password"] == hash(password):
         return True
     return False
 
@@ -245,14 +199,13 @@ def forgot_password_page():
         reinit_password()
 
 def verify_reset_code(username, reset_code):
-    users = st.session_state["users"]
-    return username in users and users[username].get("reset_code") == reset_code
+    user = get_user(username)
+    return user is not None and user.get("reset_code") == reset_code
 
 def reinit_code_validation():
     reset_code = st.text_input("Entrez le code de réinitialisation envoyé par email")
     if st.button("Valider le code"):
-        users = st.session_state["users"]
-        username = next((user for user, data in users.items() if data["email"] == st.session_state.reset_email), None)
+        username = find_username_by_email_hash(st.session_state.reset_email)
         if username and verify_reset_code(username, reset_code):
             st.session_state.reset_step = "new_password"
             st.success("Code validé avec succès. Veuillez entrer un nouveau mot de passe.")
@@ -281,17 +234,12 @@ def generate_reset_code():
 def send_reinit_mail():
     receiver_email = st.text_input("Entrez votre email")
     if st.button("Envoyer un code de réinitialisation"):
-        users = st.session_state["users"]
-        username = next((user for user, data in users.items() if data["email"] == hash(receiver_email)), None)
+        username = find_username_by_email_hash(hash(receiver_email))
         if username:
             reset_code = generate_reset_code()
-            conn = sqlite3.connect(LOCAL_DB_PATH)
-            cursor = conn.cursor()
-            cursor.execute("UPDATE stories_user SET reset_code = ? WHERE utilisateur = ?", (reset_code, username))
-            conn.commit()
-            conn.close()
+            db.execute("UPDATE stories_user SET reset_code = ? WHERE utilisateur = ?", (reset_code, username))
+            read_cache.get_read_cache().bump(read_cache.USERS)
             upload_db_to_s3()  # Synchroniser avec S3 après modification
-            users[username]["reset_code"] = reset_code
 
             subject = "Code de réinitialisation de mot de passe"
             body = f"Bonjour {username},\n\nVotre code de réinitialisation est : {reset_code}\n\nCordialement."
@@ -308,9 +256,10 @@ def send_reinit_mail():
                     server.starttls()
                     server.login(st.secrets["gmail"]["sender_email"], st.secrets["gmail"]["sender_password"])
                     server.sendmail(st.secrets["gmail"]["sender_email"], receiver_email, msg.as_string())
-                    print("E-mail envoyé avec succès.")
+                    log.info("E-mail envoyé avec succès.")
             except smtplib.SMTPException as e:
-                print(f"Erreur SMTP : {e}")
+                instrumentation.increment("failures_total", operation="smtp")
+                log.error(f"Erreur SMTP : {e}")
 
             st.session_state.reset_email = hash(receiver_email)
             st.session_state.reset_step = "code"
@@ -320,18 +269,12 @@ def send_reinit_mail():
             st.error("Aucun utilisateur trouvé avec cet email.")
 
 def reset_user_password(email, new_password):
-    users = st.session_state["users"]
-    username = next((user for user, data in users.items() if data["email"] == email), None)
+    username = find_username_by_email_hash(email)
     if username:
         hashed_password = hash(new_password)
-        conn = sqlite3.connect(LOCAL_DB_PATH)
-        cursor = conn.cursor()
-        cursor.execute("UPDATE stories_user SET password = ?, reset_code = NULL WHERE utilisateur = ?",
-                       (hashed_password, username))
-        conn.commit()
-        conn.close()
+        db.execute("UPDATE stories_user SET password = ?, reset_code = NULL WHERE utilisateur = ?",
+                   (hashed_password, username))
+        read_cache.get_read_cache().bump(read_cache.USERS)
         upload_db_to_s3()  # Synchroniser avec S3 après modification
-        users[username]["password"] = hashed_password
-        users[username]["reset_code"] = None
         return True
     return False
\ No newline at end of file